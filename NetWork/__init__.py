@@ -7,4 +7,7 @@ from .semaphore import NWSemaphore as Semaphore
 from .netprint import netPrint
 from .netobject import NetObject
 from .autodiscovery import discoverWorkers
-__all__=[Workgroup, Event, Queue, Lock, Manager, Semaphore, netPrint, NetObject, discoverWorkers]
\ No newline at end of file
+from .executor import NWExecutor as Executor
+from .broadcastvalue import BroadcastValue
+from .objectstore import ObjectRef, put
+__all__=[Workgroup, Event, Queue, Lock, Manager, Semaphore, netPrint, NetObject, discoverWorkers, Executor, BroadcastValue, ObjectRef, put]
\ No newline at end of file
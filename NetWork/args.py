@@ -13,13 +13,13 @@ def getArgs():
                              help="Key used to authenticate incomming messages with HMAC")
     
     networkArgs.add_argument("--master_hmac_key",
-                             help="Key used to authenticate messages sent to master with HMAC")
+                             help="Not used anymore, messages to the master are authenticated with the incomming key")
     
     networkArgs.add_argument("--incomming_aes_key", 
                              help="Key used to decrypt incomming messages")
     
     networkArgs.add_argument("--master_aes_key", 
-                             help="Key used to encrypt messages sent to master")
+                             help="Not used anymore, messages to the master are encrypted with the incomming key")
 
     networkArgs.add_argument("--master_ssl_cert",
                              help="Certificate file used to identify the master")
@@ -32,6 +32,27 @@ def getArgs():
 
     networkArgs.add_argument("--local_key_password",
                              help="Password used to decrypt private key")
+    networkArgs.add_argument("--framing", default="BINARY", choices=["BINARY", "ASCII"],
+                             help="How message lengths are sent, must be the same as on the master")
+
+    networkArgs.add_argument("--read_size", type=int,
+                             help="Maximum number of bytes received from the network in one call")
+
+    networkArgs.add_argument("--max_message_length", type=int,
+                             help="Longest message accepted from the network in megabytes, 1024 by default, "
+                                  "longer messages close the connection")
+    argumentParser.add_argument("--handler_threads", type=int, default=16,
+                                help="Number of threads that handle requests from the master")
+    argumentParser.add_argument("--handler_queue_length", type=int, default=256,
+                                help="Number of requests from one connection that can wait to be handled, when the "
+                                     "queue is full the server stops reading from that connection until it empties")
+    argumentParser.add_argument("--pool_size", type=int,
+                                help="Number of idle processes kept ready to run tasks, number of CPUs by default")
+    argumentParser.add_argument("--pool_max_tasks", type=int, default=0,
+                                help="Replace a task process after it runs this many tasks, 0 means never")
+    argumentParser.add_argument("--pool_max_rss", type=int, default=0,
+                                help="Replace a task process when it uses this many megabytes of memory, "
+                                     "0 means never")
     argumentParser.add_argument("--auto_discovery", "-a", action="store_true",
                                 help="Enable this worker to be automatically discovered by the master")
     argumentParser.add_argument("--auto_discovery_method", default="UDP",
@@ -64,6 +85,14 @@ def getArgs():
 
     if args.local_key_password:
         netArgs["LocalKeyPassword"] = args.local_key_password
+
+    netArgs["Framing"] = args.framing
+
+    if args.read_size:
+        netArgs["ReadSize"] = args.read_size
+
+    if args.max_message_length:
+        netArgs["MaxMessageLength"] = args.max_message_length * 1024 * 1024
     
     args.netArgs = netArgs
     return args
\ No newline at end of file
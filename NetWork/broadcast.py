@@ -0,0 +1,108 @@
+"""
+Sending the same request to every worker, used by tools that keep a copy of their
+state on all workers (NetObject classes).
+
+By default the master sends the request to every worker itself, the request is
+pickled once and every worker's outbox sends it in parallel with the others.
+
+With a relay fanout (the ``relayFanout`` argument of Workgroup) a broadcast to more
+workers than the fanout goes through a tree of workers: the master sends it to
+``relayFanout`` workers and each of them handles it and passes it on to up to
+``relayFanout`` other workers, so a broadcast reaches N workers in about
+log(N) steps. Workers that the relay failed to reach get the request directly from
+the master. Workers relay only the requests in :py:data:`relayedRequests`, which
+tools that broadcast add their requests to. Every level of the tree waits for the levels below it a shorter time
+than it is waited for, so a worker that hangs is reported by the worker above it
+instead of making the workers above it look unreachable. Relaying needs workers to connect to each other, so it's only
+used with the default (unprotected TCP) sockets.
+"""
+import pickle
+from threading import Event
+
+from .commcodes import CMD_RELAY, CMD_SET_PEERS
+from .cntcodes import CNT_WORKERS, CNT_RELAY_FANOUT
+import NetWork.networking
+
+RELAY_TIMEOUT = 30.0
+RELAY_TIMEOUT_SHRINK = 0.8
+
+#requests that workers pass on to other workers
+relayedRequests = set()
+
+
+def splitRoute(route, fanout):
+    #Split a list into at most fanout groups of nearly the same size
+    groupCount = min(fanout, len(route))
+    groups = []
+    start = 0
+    for i in range(groupCount):
+        end = start + (len(route) - start) // (groupCount - i)
+        groups.append(route[start:end])
+        start = end
+    return groups
+
+
+class RelayGate:
+    #Held in the outboxes of workers that a broadcast reaches through a relay,
+    #so requests queued after the broadcast don't reach them before it
+    def __init__(self, type, payload, route):
+        self.type = type
+        self.payload = payload
+        self.route = route
+        self.failed = set()
+        self.done = Event()
+
+    def complete(self, response, error):
+        #Called with the addresses that the relay couldn't reach
+        if error:
+            self.failed = set(self.route)
+        else:
+            self.failed = set(response)
+        self.done.set()
+
+    def __call__(self, worker):
+        self.done.wait()
+        if worker.address in self.failed:
+            worker.deliver(self.type, self.payload, None, True)
+
+
+def relayAvailable():
+    return NetWork.networking.NWSocket is NetWork.networking.NWSocketTCP
+
+
+def setUpRelays(controls, fanout):
+    #Tell every worker its ID, which other workers may connect to it (see NetWork.peers)
+    #and whether they may ask it to relay broadcasts
+    controls[CNT_RELAY_FANOUT] = fanout if relayAvailable() else 0
+    peers = []
+    if relayAvailable():
+        peers = [worker.address for worker in controls[CNT_WORKERS]]
+    for worker in controls[CNT_WORKERS]:
+        worker.sendRequest(CMD_SET_PEERS, {"PEERS": peers, "SELF": worker.id,
+                                           "RELAY": controls[CNT_RELAY_FANOUT] > 0})
+
+
+def broadcast(controls, type, contents):
+    #Send a request to all live workers, doesn't wait for it to be delivered
+    workers = [worker for worker in controls[CNT_WORKERS] if worker.alive]
+    payload = pickle.dumps(contents, pickle.HIGHEST_PROTOCOL)
+    fanout = controls.get(CNT_RELAY_FANOUT, 0)
+    if not fanout or len(workers) <= fanout:
+        for worker in workers:
+            worker.sendRawRequest(type, payload)
+        return
+    for group in splitRoute(workers, fanout):
+        root = group[0]
+        route = [worker.address for worker in group[1:]]
+        gate = RelayGate(type, payload, route)
+        root.sendRequestWithResponse(CMD_RELAY,
+                                     {
+                                         "TYPE": type,
+                                         "PAYLOAD": payload,
+                                         "ROUTE": route,
+                                         "FANOUT": fanout,
+                                         "TIMEOUT": RELAY_TIMEOUT
+                                     },
+                                     gate.complete)
+        for worker in group[1:]:
+            worker.hold(gate)
@@ -0,0 +1,200 @@
+"""
+Broadcast values are big read-only objects (lookup tables, models, arrays...) that many tasks
+need. Passing such an object in the arguments of every task sends it over the network with every
+task, a broadcast value is sent to every worker once and tasks get only a small handle.
+
+.. code-block:: python
+
+    from NetWork import Workgroup
+
+    def lookup(table, key):
+        return table.value[key]
+
+    with Workgroup(workerList....) as w:
+        table = w.broadcast(bigDictionary)
+        handlers = [w.submit(lookup, (table, key)) for key in keys]
+
+The value is pickled once on the master. Every worker keeps it in a file in shared memory
+(``/dev/shm`` where it exists), the processes that run tasks map that file and unpickle the value
+the first time a task uses it, then keep it for later tasks. Objects that support out-of-band
+pickling (like numpy arrays) are not copied, they use the mapped memory directly, so all task
+processes on a worker share a single read-only copy.
+
+:py:meth:`BroadcastValue.release` deletes the value from the workers when it's not needed anymore.
+"""
+import atexit
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import uuid
+from threading import Lock
+
+from .broadcast import broadcast, relayedRequests
+from .request import sendRequest
+import NetWork.workerprocess as workerprocess
+
+CMD_BROADCAST_VALUE = b"BVL"
+CMD_RELEASE_VALUE = b"BVR"
+#files start with the number of out-of-band buffers and the lengths of the pickle and the buffers
+COUNT = struct.Struct("!Q")
+SHARED_MEMORY_DIRECTORY = "/dev/shm"
+
+#key -> file holding the value, on workers and task processes
+paths = {}
+#key -> value unpickled in this process
+loaded = {}
+lock = Lock()
+
+
+class BroadcastValue:
+    """
+    Handle of a value that was sent to all workers, pass it to tasks instead of the value.
+    Usually created with :py:meth:`Workgroup.broadcast <NetWork.workgroup.Workgroup.broadcast>`.
+
+    :type value: object
+    :param value: the value, it must be picklable
+
+    :type workgroup: NetWork.workgroup.Workgroup
+    :param workgroup: workgroup whose workers get the value
+    """
+
+    def __init__(self, value, workgroup):
+        self.key = uuid.uuid4().hex
+        self.localValue = value
+        self.isLoaded = True
+        buffers = []
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        #the buffers are copied only once, when the broadcast is pickled with protocol 5
+        sendRequest(CMD_BROADCAST_VALUE,
+                    {
+                        "KEY": self.key,
+                        "DATA": data,
+                        "BUFFERS": buffers
+                    })
+
+    @property
+    def value(self):
+        """
+        The value, on workers it's loaded from the copy kept on the worker
+        """
+        if not self.isLoaded:
+            self.localValue = loadValue(self.key)
+            self.isLoaded = True
+        return self.localValue
+
+    def release(self):
+        """
+        Delete the value from the workers, tasks that already loaded it can still use it
+        """
+        sendRequest(CMD_RELEASE_VALUE, {"KEY": self.key})
+
+    def __getstate__(self):
+        return {"KEY": self.key}
+
+    def __setstate__(self, state):
+        self.key = state["KEY"]
+        self.localValue = None
+        self.isLoaded = False
+
+
+def loadValue(key):
+    #Unpickle a value from the file the worker wrote it to, once per process
+    lock.acquire()
+    try:
+        if key in loaded:
+            return loaded[key]
+        if not key in paths:
+            raise KeyError("Broadcast value " + key + " is not on this worker")
+        with open(paths[key], "rb") as valueFile:
+            mapped = mmap.mmap(valueFile.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        count = COUNT.unpack_from(view)[0]
+        lengths = struct.unpack_from("!" + str(count + 1) + "Q", view, COUNT.size)
+        offset = COUNT.size * (count + 2)
+        parts = []
+        for length in lengths:
+            parts.append(view[offset:offset + length])
+            offset += length
+        loaded[key] = pickle.loads(parts[0], buffers=parts[1:])
+        return loaded[key]
+    finally:
+        lock.release()
+
+
+def writeValue(data, buffers):
+    #Write a value to a new file and return its path
+    directory = SHARED_MEMORY_DIRECTORY if os.path.isdir(SHARED_MEMORY_DIRECTORY) else None
+    descriptor, path = tempfile.mkstemp(prefix="network-value-", dir=directory)
+    with os.fdopen(descriptor, "wb") as valueFile:
+        valueFile.write(COUNT.pack(len(buffers)))
+        valueFile.write(struct.pack("!" + str(len(buffers) + 1) + "Q", len(data), *[len(buffer) for buffer in buffers]))
+        valueFile.write(data)
+        for buffer in buffers:
+            valueFile.write(buffer)
+    return path
+
+
+def removeFiles():
+    for path in list(paths.values()):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def addValue(request):
+    paths[request["KEY"]] = request["PATH"]
+
+
+def dropValue(request):
+    paths.pop(request["KEY"], None)
+    loaded.pop(request["KEY"], None)
+
+
+def broadcastValueMaster(request, controls):
+    broadcast(controls, CMD_BROADCAST_VALUE, request.getContents())
+
+
+def releaseValueMaster(request, controls):
+    broadcast(controls, CMD_RELEASE_VALUE, request.getContents())
+
+
+def broadcastValueWorker(request):
+    path = writeValue(request["DATA"], request["BUFFERS"])
+    paths[request["KEY"]] = path
+    workerprocess.shareWithProcesses(addValue, {"KEY": request["KEY"], "PATH": path})
+
+
+def releaseValueWorker(request):
+    path = paths.pop(request["KEY"], None)
+    if path:
+        workerprocess.shareWithProcesses(dropValue, {"KEY": request["KEY"]})
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+masterHandlers = {CMD_BROADCAST_VALUE: broadcastValueMaster, CMD_RELEASE_VALUE: releaseValueMaster}
+
+workerHandlers = {CMD_BROADCAST_VALUE: broadcastValueWorker, CMD_RELEASE_VALUE: releaseValueWorker}
+
+
+def processForked():
+    #A server thread may have held the lock when a pool process was forked
+    global lock
+    lock = Lock()
+
+
+workerprocess.afterForkHandlers.append(processForked)
+
+
+def masterInit(workgroup):
+    pass
+
+
+def workerInit():
+    relayedRequests.update((CMD_BROADCAST_VALUE, CMD_RELEASE_VALUE))
+    atexit.register(removeFiles)
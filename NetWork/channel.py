@@ -0,0 +1,281 @@
+"""
+A channel carries all communication between two sides over a single connection.
+Every frame sent on a channel starts with a header that holds the frame kind and
+a request ID, responses carry the ID of the request they answer so many requests
+can be in flight at the same time and their responses can arrive in any order.
+
+Frame kinds:
+
+  * ``FRAME_REQUEST`` a request that expects a response
+  * ``FRAME_NOTIFY`` a request that doesn't expect a response
+  * ``FRAME_RESPONSE`` a response to an earlier request
+  * ``FRAME_ERROR`` the other side failed to handle an earlier request
+  * ``FRAME_PING`` asks the other side to show that it's alive
+  * ``FRAME_PONG`` the answer to a ping, sent by the reader without a handler
+
+Requests and notifications carry a 3 letter code (see commcodes.py) followed by pickled
+contents, responses carry only the pickled response.
+
+The master keeps one channel to each worker, the same channel carries requests from
+the master to the worker and from the worker (and the tasks running on it) to the master.
+The master pings a worker that didn't send anything for a while (see NetWork.worker), a worker
+that stopped without closing the connection is noticed when the pings go unanswered.
+"""
+import pickle
+import struct
+import time
+from itertools import count
+from threading import Thread, Lock, Event
+
+FRAME_REQUEST = 1
+FRAME_NOTIFY = 2
+FRAME_RESPONSE = 3
+FRAME_ERROR = 4
+FRAME_PING = 5
+FRAME_PONG = 6
+FRAME_HEADER = struct.Struct("!BQ")
+TYPE_LENGTH = 3
+
+class ChannelClosed(OSError): pass
+
+
+class ResponseTimeout(OSError): pass
+
+
+class RemoteError(Exception): pass
+
+
+class ProtocolError(OSError): pass
+
+
+class PendingResponse:
+    #Holds the place of a response that hasn't arrived yet, a thread can
+    #wait for it or a callback can be run when it arrives
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.arrived = Event()
+        self.payload = None
+        self.error = None
+
+    def complete(self, payload, error=None):
+        self.payload = payload
+        self.error = error
+        self.arrived.set()
+        if self.callback:
+            self.callback(payload, error)
+
+    def wait(self, timeout=None):
+        if not self.arrived.wait(timeout):
+            raise ResponseTimeout("No response arrived in " + str(timeout) + " seconds")
+        if self.error:
+            raise self.error
+        return self.payload
+
+
+class Channel:
+    #A full-duplex connection that carries many requests at the same time
+    #requestHandler is called for every incoming request or notification as
+    #requestHandler(channel, responseExpected, requestId, type, payload)
+    #where payload holds the pickled contents of the request
+    def __init__(self, socket, requestHandler=None, closeHandler=None):
+        self.socket = socket
+        self.address = socket.address
+        self.requestHandler = requestHandler
+        self.closeHandler = closeHandler
+        self.sendLock = Lock()
+        self.pendingLock = Lock()
+        self.pending = {}
+        self.requestIds = count(1)
+        self.closed = False
+        self.reader = None
+        self.transport = None
+        #when the last frame arrived, any frame shows that the other side is alive
+        self.lastReceived = time.monotonic()
+
+    def start(self):
+        #Start receiving frames
+        self.reader = Thread(target=self.readerThread)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def readerThread(self):
+        while not self.closed:
+            try:
+                message = self.socket.recv()
+            except OSError as error:
+                self.close(error)
+                return
+            self.frameReceived(message)
+
+    def frameReceived(self, message):
+        #Pass a received frame to whoever is waiting for it, a frame that doesn't follow
+        #the protocol closes the channel because nothing after it can be trusted
+        self.lastReceived = time.monotonic()
+        if len(message) < FRAME_HEADER.size:
+            self.close(ProtocolError("Received a truncated frame from " + str(self.address)))
+            return
+        kind, requestId = FRAME_HEADER.unpack_from(message)
+        body = memoryview(message)[FRAME_HEADER.size:]
+        if kind == FRAME_RESPONSE or kind == FRAME_ERROR:
+            self.pendingLock.acquire()
+            pending = self.pending.pop(requestId, None)
+            self.pendingLock.release()
+            if pending is None:
+                #the requester stopped waiting
+                return
+            if kind == FRAME_ERROR:
+                try:
+                    error = RemoteError(pickle.loads(body))
+                except Exception as failure:
+                    error = ProtocolError("Received a broken error frame from " + str(self.address), failure)
+                    pending.complete(None, error)
+                    self.close(error)
+                    return
+                pending.complete(None, error)
+            else:
+                pending.complete(body)
+        elif kind == FRAME_REQUEST or kind == FRAME_NOTIFY:
+            if len(body) < TYPE_LENGTH:
+                self.close(ProtocolError("Received a truncated request from " + str(self.address)))
+                return
+            type = bytes(body[:TYPE_LENGTH])
+            if self.requestHandler:
+                self.handleRequest(kind == FRAME_REQUEST, requestId, type, body[TYPE_LENGTH:])
+            elif kind == FRAME_REQUEST:
+                self.respondError(requestId, "Requests are not accepted on this channel")
+        elif kind == FRAME_PING:
+            try:
+                self.sendFrame(FRAME_PONG, requestId)
+            except OSError:
+                pass
+        elif kind != FRAME_PONG:
+            self.close(ProtocolError("Received a frame of unknown kind " + str(kind) + " from " +
+                                     str(self.address)))
+
+    def handleRequest(self, responseExpected, requestId, type, payload):
+        #A request that can't be handled (usually one that can't be unpickled)
+        #gets an error response, the reader goes on with the next frame
+        try:
+            self.requestHandler(self, responseExpected, requestId, type, payload)
+        except Exception as error:
+            print("Failed to handle a request", type, "from", self.address, repr(error))
+            if responseExpected:
+                try:
+                    self.respondError(requestId, repr(error))
+                except OSError:
+                    pass
+
+    def sendFrame(self, kind, requestId, *parts):
+        #the header and the parts are handed to the socket as separate buffers
+        message = [FRAME_HEADER.pack(kind, requestId)]
+        message.extend(parts)
+        self.sendLock.acquire()
+        try:
+            if self.closed:
+                raise ChannelClosed("Channel to " + str(self.address) + " is closed")
+            self.socket.send(message)
+        except ChannelClosed:
+            raise
+        except OSError as error:
+            failure = error
+        else:
+            failure = None
+        finally:
+            self.sendLock.release()
+        if failure:
+            self.close(failure)
+            raise ChannelClosed("Sending to " + str(self.address) + " failed", failure)
+
+    def requestRaw(self, type, payload, callback=None):
+        #Send a request with already pickled contents, return an object
+        #that can be used to wait for the response, the callback if given
+        #is called as callback(payload, error) when the response arrives
+        #Raises ChannelClosed only if the request wasn't sent, if the channel closed
+        #while it was being sent the response is completed with the error instead
+        pending = PendingResponse(callback)
+        self.pendingLock.acquire()
+        requestId = next(self.requestIds)
+        self.pending[requestId] = pending
+        self.pendingLock.release()
+        try:
+            self.sendFrame(FRAME_REQUEST, requestId, type, payload)
+        except OSError:
+            if self.forget(requestId):
+                raise
+        return requestId, pending
+
+    def request(self, type, contents, timeout=None):
+        #Send a request and wait for the response
+        return pickle.loads(self.exchangeRaw(type, pickle.dumps(contents), timeout))
+
+    def exchangeRaw(self, type, payload, timeout=None):
+        #Send a request with already pickled contents and wait for the pickled response
+        requestId, pending = self.requestRaw(type, payload)
+        try:
+            return pending.wait(timeout)
+        except ResponseTimeout:
+            self.forget(requestId)
+            raise
+
+    def forget(self, requestId):
+        #Stop waiting for a response, False if it was already completed
+        self.pendingLock.acquire()
+        pending = self.pending.pop(requestId, None)
+        self.pendingLock.release()
+        return pending is not None
+
+    def ping(self):
+        #The answer only updates lastReceived, nothing is sent while another frame
+        #is being sent because that send may be stalled on a dead connection
+        if not self.sendLock.acquire(blocking=False):
+            return
+        try:
+            if not self.closed:
+                self.socket.send([FRAME_HEADER.pack(FRAME_PING, 0)])
+        finally:
+            self.sendLock.release()
+
+    def notifyRaw(self, type, *payload):
+        #The payload can be given in parts, they are sent without being joined
+        self.sendFrame(FRAME_NOTIFY, 0, type, *payload)
+
+    def notify(self, type, contents):
+        #Send a request that doesn't expect a response
+        self.notifyRaw(type, pickle.dumps(contents))
+
+    def respondRaw(self, requestId, payload):
+        self.sendFrame(FRAME_RESPONSE, requestId, payload)
+
+    def respond(self, requestId, response):
+        self.respondRaw(requestId, pickle.dumps(response))
+
+    def respondError(self, requestId, message):
+        self.sendFrame(FRAME_ERROR, requestId, pickle.dumps(message))
+
+    def abort(self, error):
+        #Close a connection that may be stalled, shutting the socket down first
+        #makes a send that is blocked on it fail instead of holding the send lock
+        self.socket.shutdown()
+        self.close(error)
+
+    def close(self, error=None):
+        #Close the connection, everyone waiting for a response gets ChannelClosed
+        self.sendLock.acquire()
+        alreadyClosed = self.closed
+        self.closed = True
+        self.sendLock.release()
+        if alreadyClosed:
+            return
+        if self.transport:
+            self.transport.detach(self)
+        self.socket.shutdown()
+        self.socket.close()
+        self.pendingLock.acquire()
+        pending = list(self.pending.values())
+        self.pending.clear()
+        self.pendingLock.release()
+        reason = ChannelClosed("Channel to " + str(self.address) + " got closed", error)
+        for waiter in pending:
+            waiter.complete(None, reason)
+        if self.closeHandler:
+            self.closeHandler(self)
@@ -6,4 +6,10 @@ CNT_LISTEN_SOCKET = "LISTEN_SOCKET"
 CNT_WORKER_COUNT = "WORKER_COUNT"
 CNT_TASK_COUNT = "TASK_COUNT"
 CNT_TASK_EXECUTORS = "EXECUTORS"
-CNT_DEAD_WORKERS = "DEAD_WORKERS"
\ No newline at end of file
+CNT_DEAD_WORKERS = "DEAD_WORKERS"
+CNT_RELAY_FANOUT = "RELAY_FANOUT"
+CNT_PLACEMENT = "PLACEMENT"
+CNT_PENDING_TASKS = "PENDING_TASKS"
+CNT_BYTES_MOVED = "BYTES_MOVED"
+CNT_WAITING_TASKS = "WAITING_TASKS"
+CNT_NET_CLASSES = "NET_CLASSES"
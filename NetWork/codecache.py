@@ -0,0 +1,186 @@
+"""
+Caching the code of task targets.
+
+The code of a task's target is marshalled once on the master and identified by its hash.
+The master keeps the marshalled code while the code object is alive, remembers which
+workers already got the code of a target and sends them only the hash with later tasks.
+Workers keep the last :py:const:`MAX_CACHED_CODE` codes they received, a worker that gets
+a hash it doesn't know (the code was dropped from its cache or the worker was restarted)
+asks the master for the code. Processes that run the tasks
+keep the functions made from the code, so a function isn't made again for every task.
+"""
+import hashlib
+import marshal
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+from types import FunctionType
+from weakref import WeakKeyDictionary, finalize
+
+from .request import sendRequestWithCallback
+import NetWork.workerprocess as workerprocess
+
+CMD_GET_CODE = b"COD"
+MAX_CACHED_CODE = 256
+
+#code object -> (hash, marshalled code), filled where the code is marshalled
+marshalled = WeakKeyDictionary()
+#hash -> marshalled code for the live code marshalled on the master, workers ask for it
+masterCode = {}
+#hash -> number of live code objects with that hash, equal code compiled twice has one hash
+masterCodeUsers = {}
+#id of a code object -> finalizer that forgets its code, for every live code object counted above
+liveCode = {}
+#hash -> marshalled code received from the other side, the most recently used last
+receivedCode = OrderedDict()
+#hash -> function made from the code, the most recently used last
+functions = OrderedDict()
+#worker id -> hashes of code that the worker got
+knownCode = {}
+lock = Lock()
+
+
+def remember(cache, key, value):
+    #Put a value in an LRU cache, must be called while holding the lock
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > MAX_CACHED_CODE:
+        cache.popitem(last=False)
+
+
+def codeOf(function):
+    #Return the hash and the marshalled code of a function, the code is marshalled only once
+    #equal code objects are one key of marshalled, liveCode tells them apart
+    code = function.__code__
+    lock.acquire()
+    try:
+        info = marshalled.get(code)
+        if info and id(code) in liveCode:
+            return info
+    finally:
+        lock.release()
+    if not info:
+        codeBytes = marshal.dumps(code)
+        info = (hashlib.blake2b(codeBytes, digest_size=16).digest(), codeBytes)
+    codeHash, codeBytes = info
+    lock.acquire()
+    try:
+        marshalled.setdefault(code, info)
+        if not id(code) in liveCode:
+            masterCode[codeHash] = codeBytes
+            masterCodeUsers[codeHash] = masterCodeUsers.get(codeHash, 0) + 1
+            liveCode[id(code)] = finalize(code, forgetCode, id(code), codeHash)
+            liveCode[id(code)].atexit = False
+    finally:
+        lock.release()
+    return info
+
+
+def forgetCode(codeId, codeHash):
+    #Called when a code object marshalled on the master is collected, the code is
+    #dropped once no live code has its hash, workers that got it are told again
+    lock.acquire()
+    del liveCode[codeId]
+    masterCodeUsers[codeHash] -= 1
+    if not masterCodeUsers[codeHash]:
+        del masterCodeUsers[codeHash]
+        del masterCode[codeHash]
+        for known in knownCode.values():
+            known.discard(codeHash)
+    lock.release()
+
+
+def storeCode(codeHash, codeBytes):
+    lock.acquire()
+    remember(receivedCode, codeHash, codeBytes)
+    lock.release()
+
+
+def lookupCode(codeHash):
+    #Return the marshalled code with the hash or None if it isn't known here
+    lock.acquire()
+    try:
+        if codeHash in receivedCode:
+            receivedCode.move_to_end(codeHash)
+            return receivedCode[codeHash]
+        return masterCode.get(codeHash)
+    finally:
+        lock.release()
+
+
+def fetchCode(codeHash, callback):
+    #Ask the master for code that isn't known on this worker, callback(codeBytes, error)
+    #is called when the code arrives, the caller doesn't wait for it
+    sendRequestWithCallback(CMD_GET_CODE, {"HASH": codeHash}, partial(codeReceived, codeHash, callback))
+
+
+def codeReceived(codeHash, callback, codeBytes, error):
+    if not error:
+        storeCode(codeHash, codeBytes)
+    callback(codeBytes, error)
+
+
+def getFunction(codeHash, codeBytes, functionGlobals):
+    lock.acquire()
+    try:
+        if codeHash in functions:
+            functions.move_to_end(codeHash)
+            return functions[codeHash]
+    finally:
+        lock.release()
+    function = FunctionType(code=marshal.loads(codeBytes), globals=functionGlobals)
+    lock.acquire()
+    remember(functions, codeHash, function)
+    lock.release()
+    return function
+
+
+def prepareTask(task, workerId):
+    #Called on the master before a task is sent to a worker, the code
+    #is sent only if the worker didn't get it with an earlier task
+    codeHash = task.codeInfo()[0]
+    lock.acquire()
+    task.shipCode = not codeHash in knownCode.get(workerId, ())
+    lock.release()
+    return task
+
+
+def codeSent(task, workerId):
+    #Called after a task prepared for the worker was sent, from then on the worker
+    #gets only the hash, a task that wasn't sent leaves the code unknown
+    if not task.shipCode:
+        return
+    lock.acquire()
+    if task.codeHash in masterCode:
+        knownCode.setdefault(workerId, set()).add(task.codeHash)
+    lock.release()
+
+
+def getCodeMaster(request, controls):
+    codeBytes = lookupCode(request["HASH"])
+    if codeBytes is None:
+        request.respondError("The code isn't on the master anymore")
+    else:
+        request.respond(codeBytes)
+
+
+masterHandlers = {CMD_GET_CODE: getCodeMaster}
+
+workerHandlers = {}
+
+
+def processForked():
+    #A server thread may have held the lock when a pool process was forked
+    global lock
+    lock = Lock()
+
+
+workerprocess.afterForkHandlers.append(processForked)
+
+
+def masterInit(workgroup):
+    knownCode.clear()
+
+
+def workerInit():
+    pass
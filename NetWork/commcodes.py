@@ -3,4 +3,8 @@
 which handler should be used for that message
 """
 CMD_HALT = b"HLT"
-CMD_WORKER_DIED = b"DWR"
\ No newline at end of file
+CMD_WORKER_DIED = b"DWR"
+CMD_WORKER_JOINED = b"JWR"
+CMD_RELAY = b"RLY"
+CMD_SET_PEERS = b"PRS"
+CMD_WORKER_INFO = b"WIN"
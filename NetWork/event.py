@@ -26,31 +26,28 @@ of the same event the first task is waken up and continues it's work
 For more info about events see `Python documentation page
 <http://docs.python.org/3.3/library/threading.html#event-objects>`_
 """
-from multiprocessing import Event
-
-from .request import sendRequest
-from .cntcodes import CNT_WORKERS
+from .request import sendRequest, sendRequestWithResponse, getRunningTask
+from .task import taskKilledHandlers
 
 
 CMD_SET_EVENT = b"EVS"
-CMD_REGISTER_EVENT = b"EVR"
+CMD_WAIT_EVENT = b"EVW"
 CNT_EVENT_COUNT = "EVENT_COUNT"
 
 runningOnMaster = None
 masterAddress = None
-events = None
+eventHandlers = None
 
 
 def masterInit(workgroup):
-    global events, runningOnMaster
-    events = {-1: None}
+    global eventHandlers, runningOnMaster
+    eventHandlers = {-1: None}
     runningOnMaster = True
     workgroup.controls[CNT_EVENT_COUNT] = 0
 
 
 def workerInit():
-    global events, runningOnMaster
-    events = {-1: None}
+    global runningOnMaster
     runningOnMaster = False
 
 
@@ -69,11 +66,7 @@ class NWEvent:
         self.workgroup = workgroup
         self.workgroup.controls[CNT_EVENT_COUNT] += 1
         self.id = self.workgroup.controls[CNT_EVENT_COUNT]
-        events[self.id] = Event()
-        sendRequest(CMD_REGISTER_EVENT,
-                    {
-                        "ID": self.id
-                    })
+        eventHandlers[self.id] = MasterEventHandler()
 
     def set(self):
         """
@@ -88,7 +81,11 @@ class NWEvent:
         """
         Sleep until some task calls the :py:meth:`set` method
         """
-        return events[self.id].wait()
+        return sendRequestWithResponse(CMD_WAIT_EVENT,
+                                       {
+                                           "ID": self.id,
+                                           "TASK": getRunningTask()
+                                       })
 
     def __setstate__(self, state):
         self.id = state["id"]
@@ -98,27 +95,46 @@ class NWEvent:
         return {"id": self.id, "workgroup": None}
 
 
-def setEventMaster(request, controls):
-    id = request["ID"]
-    for worker in controls[CNT_WORKERS]:
-        worker.sendRequest(CMD_SET_EVENT, {"ID": id})
-    events[id].set()
+class MasterEventHandler:
+    #Holds the state of an event on the master, wait requests that arrive
+    #before the event is set are answered when it gets set
+    def __init__(self):
+        self.isSet = False
+        self.waiters = []
 
+    def wait(self, request):
+        if self.isSet:
+            request.respond(True)
+        else:
+            self.waiters.append(request)
+
+    def set(self):
+        self.isSet = True
+        for waiter in self.waiters:
+            if not waiter.abandoned():
+                waiter.respond(True)
+        self.waiters = []
+
+    def taskKilled(self, taskId):
+        self.waiters = [waiter for waiter in self.waiters if waiter["TASK"] != taskId]
 
-def registerEventMaster(request, controls):
-    id = request["ID"]
-    for worker in controls[CNT_WORKERS]:
-        worker.sendRequest(CMD_REGISTER_EVENT, {"ID": id})
 
+def releaseKilledTask(taskId):
+    if eventHandlers:
+        for handler in list(eventHandlers.values()):
+            if handler:
+                handler.taskKilled(taskId)
 
-def setEventWorker(request):
-    events[request["ID"]].set()
+
+def setEventMaster(request, controls):
+    eventHandlers[request["ID"]].set()
 
 
-def registerEventWorker(request):
-    id = request["ID"]
-    events[id] = Event()
+def waitEventMaster(request, controls):
+    request.defer()
+    eventHandlers[request["ID"]].wait(request)
 
 
-masterHandlers = {CMD_SET_EVENT: setEventMaster, CMD_REGISTER_EVENT: registerEventMaster}
-workerHandlers = {CMD_SET_EVENT: setEventWorker, CMD_REGISTER_EVENT: registerEventWorker}
\ No newline at end of file
+masterHandlers = {CMD_SET_EVENT: setEventMaster, CMD_WAIT_EVENT: waitEventMaster}
+workerHandlers = {}
+taskKilledHandlers.append(releaseKilledTask)
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+An executor that runs functions on the workgroup, it implements the
+:py:class:`concurrent.futures.Executor` interface so code written for
+:py:class:`ThreadPoolExecutor <concurrent.futures.ThreadPoolExecutor>` or
+:py:class:`ProcessPoolExecutor <concurrent.futures.ProcessPoolExecutor>` can run
+on many computers without changes.
+
+:py:meth:`submit <NWExecutor.submit>` returns a regular :py:class:`concurrent.futures.Future`,
+so :py:func:`concurrent.futures.wait`, :py:func:`concurrent.futures.as_completed` and
+:py:meth:`Future.add_done_callback <concurrent.futures.Future.add_done_callback>` work as usual.
+Futures are completed when the workers report that their tasks finished, nothing is polled.
+Callbacks added to the futures are run by a thread of the executor.
+
+The executor can only be used on the master. Tasks start running as soon as they are
+submitted so their futures can't be cancelled. Shutting down the executor doesn't stop
+the workgroup.
+
+::
+
+    #Usage example
+    from concurrent.futures import as_completed
+    from NetWork import Workgroup, Executor
+
+    def square(x):
+        return x * x
+
+    with Workgroup(addresses) as w:
+        with Executor(w) as executor:
+            futures = [executor.submit(square, i) for i in range(10)]
+            for future in as_completed(futures):
+                print(future.result())
+            print(list(executor.map(square, range(10))))
+
+"""
+from concurrent.futures import Executor, Future
+from threading import Thread, Lock
+from queue import Queue
+
+from .task import getTaskState
+
+
+class NWExecutor(Executor):
+    """
+    Runs submitted functions as tasks of the workgroup.
+
+    :type workgroup: NetWork.workgroup.Workgroup
+    :param workgroup: workgroup that runs the tasks
+    """
+
+    def __init__(self, workgroup):
+        self.workgroup = workgroup
+        self.finishedTasks = Queue()
+        self.outstanding = set()
+        self.shutdownLock = Lock()
+        self.isShutdown = False
+        self.completer = Thread(target=self.completerThread)
+        self.completer.daemon = True
+        self.completer.start()
+
+    def submit(self, fn, /, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` as a task of the workgroup.
+
+        :rtype: concurrent.futures.Future
+        :return: future that gets the return value or the exception of the task
+        """
+        self.shutdownLock.acquire()
+        try:
+            if self.isShutdown:
+                raise RuntimeError("Cannot submit new tasks after shutdown")
+            handler = self.workgroup.submit(fn, args, kwargs)
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self.outstanding.add(future)
+        finally:
+            self.shutdownLock.release()
+        getTaskState(handler.id).addCallback(lambda: self.finishedTasks.put((future, handler)))
+        return future
+
+    def completerThread(self):
+        #Complete the futures of finished tasks, getting a big result means
+        #asking the worker so it's not done by the dispatcher thread
+        while True:
+            finished = self.finishedTasks.get()
+            if finished is None:
+                return
+            future, handler = finished
+            try:
+                if handler.exceptionRaised():
+                    future.set_exception(handler.exception())
+                else:
+                    future.set_result(handler.result())
+            except Exception as error:
+                future.set_exception(error)
+            self.shutdownLock.acquire()
+            self.outstanding.discard(future)
+            done = self.isShutdown and not self.outstanding
+            self.shutdownLock.release()
+            if done:
+                return
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """
+        Stop accepting new tasks, tasks that were already submitted keep running
+        and their futures are completed.
+
+        :type wait: bool
+        :param wait: wait until all submitted tasks finish
+        :type cancel_futures: bool
+        :param cancel_futures: ignored, submitted tasks are always running
+        """
+        self.shutdownLock.acquire()
+        self.isShutdown = True
+        if not self.outstanding:
+            self.finishedTasks.put(None)
+        self.shutdownLock.release()
+        if wait:
+            self.completer.join()
@@ -4,43 +4,40 @@ Each function is associated with a 3 letter code from commcodes.py
 """
 import pickle
 
-from NetWork import event, lock, manager, queue, semaphore, netprint, netobject, task
+from NetWork import event, lock, manager, queue, semaphore, netprint, netobject, task, pull, codecache, broadcastvalue, objectstore
 from .commcodes import *
 from .cntcodes import *
 from .request import Request
+from .broadcast import setUpRelays
+from .placement import askWorkerInfo
 
 
-plugins = [event, lock, manager, queue, semaphore, netprint, netobject, task]
+plugins = [event, lock, manager, queue, semaphore, netprint, netobject, task, pull, codecache, broadcastvalue, objectstore]
 
 
 class NoWorkersError(Exception): pass
 
 
-def receiveSocketData(socket, commqueue, controls):
-    workerId = -1
-    for worker in controls[CNT_WORKERS]:
-        if socket.address == worker.realAddress:
-            workerId = worker.id
-    if workerId == -1:
+def receiveWorkerRequest(commqueue, worker, channel, responseExpected, requestId, type, payload):
+    #Called for every request that arrives on a worker's channel
+    if not type in handlerList:
+        print("Request came with an invalid identifier code", type)
+        if responseExpected:
+            channel.respondError(requestId, "Invalid identifier code " + str(type))
         return
-    try:
-        receivedData = socket.recv()
-    except OSError as error:
-        print("Network communication failed from address", socket.address, error)
-        return
-    if not receivedData[:3] in handlerList:
-        print("Request came with an invalid identifier code", receivedData[:3])
-        return
-    commqueue.put(Request(receivedData[:3],
-                          pickle.loads(receivedData[3:]), workerId, socket))
+    commqueue.put(Request(type, pickle.loads(payload), worker.id, channel, requestId,
+                          responseExpected=responseExpected))
+
+
+def reportDeadWorker(commqueue, worker):
+    #Called by a worker that stopped responding
+    commqueue.put(Request(CMD_WORKER_DIED, {"WORKER": worker.id}, overNetwork=False))
 
 
 def deathHandler(request, controls):
     deadWorkerSet = controls[CNT_DEAD_WORKERS]
-    for worker in deadWorkerSet:
-        if worker.id == request["WORKER"].id:
-            break
-    else:
+    if not request["WORKER"] in deadWorkerSet:
+        task.failTasksOfWorker(request["WORKER"], controls)
         controls[CNT_WORKER_COUNT] -= 1
         deadWorkerSet.add(request["WORKER"])
         controls[CNT_DEAD_WORKERS] = deadWorkerSet
@@ -48,7 +45,20 @@ def deathHandler(request, controls):
             raise NoWorkersError("All workers died, unable to continue working")
 
 
-handlerList = {CMD_WORKER_DIED: deathHandler}
+def joinHandler(request, controls):
+    #A worker added to a running workgroup, the others learn its address
+    worker = request["WORKER"]
+    controls[CNT_WORKERS].append(worker)
+    controls[CNT_WORKER_COUNT] += 1
+    setUpRelays(controls, controls[CNT_RELAY_FANOUT])
+    askWorkerInfo(controls[CNT_PLACEMENT], worker)
+    netobject.sendClasses(worker, controls)
+    if CNT_PENDING_TASKS in controls:
+        worker.sendRequest(pull.CMD_START_PULLING, {})
+    request.respond(worker.id)
+
+
+handlerList = {CMD_WORKER_DIED: deathHandler, CMD_WORKER_JOINED: joinHandler}
 
 for plugin in plugins:
     handlerList.update(plugin.masterHandlers)
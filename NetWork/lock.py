@@ -7,6 +7,8 @@ method of the lock. If another task tries to acquire the same lock, it will be
 put to sleep. When the first task finishes the critical section it calls 
 :py:meth:`release <NWLock.release>` method of the lock and waiting task is waken up.
 
+If a task that holds the lock gets terminated or its worker dies the lock is released.
+
 For more info about locks see `Python documentation page
 <http://docs.python.org/3.3/library/threading.html#lock-objects>`_
 
@@ -45,24 +47,21 @@ For more info about locks see `Python documentation page
 """
 
 from multiprocessing import Lock
-from .request import sendRequest
-from .cntcodes import CNT_WORKERS
+from .request import sendRequest, sendRequestWithResponse, getRunningTask
+from .task import taskKilledHandlers
 
-CMD_REGISTER_LOCK = b"LCR"
 CMD_ACQUIRE_LOCK = b"LCA"
 CMD_RELEASE_LOCK = b"LCU"
 CNT_LOCK_COUNT = "LOCK_COUNT"
 
 runningOnMaster = None
-locks = None
 lockHandlers = None
 lockLocks = None
 masterAddress = None
 
 
 def masterInit(workgroup):
-    global locks, lockHandlers, lockLocks, runningOnMaster
-    locks = {-1: None}
+    global lockHandlers, lockLocks, runningOnMaster
     lockHandlers = {-1: None}
     lockLocks = {-1: None}
     runningOnMaster = True
@@ -70,8 +69,7 @@ def masterInit(workgroup):
 
 
 def workerInit():
-    global locks, runningOnMaster
-    locks = {-1: None}
+    global runningOnMaster
     runningOnMaster = False
 
 
@@ -88,16 +86,8 @@ class NWLock:
         self.workgroup = workgroup
         self.workgroup.controls[CNT_LOCK_COUNT] += 1
         self.id = self.workgroup.controls[CNT_LOCK_COUNT]
-        if runningOnMaster:
-            lockLocks[self.id] = Lock()
-            lockHandlers[self.id] = MasterLockHandler(self.id)
-        locks[self.id] = Lock()
-        locks[self.id].acquire()
-
-        sendRequest(CMD_REGISTER_LOCK,
-                    {
-                        "ID": self.id
-                    })
+        lockLocks[self.id] = Lock()
+        lockHandlers[self.id] = MasterLockHandler(self.id)
 
     def acquire(self):
         """
@@ -105,11 +95,11 @@ class NWLock:
         :py:meth:`acquire` on this lock will be put to sleep until :py:meth:`release`
         is called.
         """
-        sendRequest(CMD_ACQUIRE_LOCK,
-                    {
-                        "ID": self.id
-                    })
-        locks[self.id].acquire()
+        sendRequestWithResponse(CMD_ACQUIRE_LOCK,
+                                {
+                                    "ID": self.id,
+                                    "TASK": getRunningTask()
+                                })
 
     def release(self):
         """
@@ -131,75 +121,82 @@ class NWLock:
 
 class MasterLockHandler:
     #A class used to hold information about locks on the master
-    #It has a waiters list that holds a list of workers waiting to acquire
-    #the lock, when the lock is released a message is send to the first waiter
-    #in the list
+    #It has a waiters list that holds acquire requests waiting for the lock,
+    #when the lock is released the first waiter in the list gets the response,
+    #owner is the ID of the task that holds the lock (None for the master)
     def __init__(self, id):
         lockLocks[id].acquire()
         self.id = id
         self.locked = False
+        self.owner = None
         self.waiters = []
         lockLocks[id].release()
 
-    def acquire(self, requester, controlls):
+    def acquire(self, request):
         #Acquire lock or wait for release
         lockLocks[self.id].acquire()
         if self.locked:
-            self.waiters.append(requester)
+            self.waiters.append(request)
         else:
             self.locked = True
-            if requester == -1:
-                locks[self.id].release()
-            else:
-                controlls[CNT_WORKERS][requester].sendRequest(CMD_RELEASE_LOCK,
-                                                              {
-                                                                  "ID": self.id
-                                                              })
+            self.owner = request["TASK"]
+            if not request.respond(True):
+                self.wakeNext()
         lockLocks[self.id].release()
 
-    def release(self, controlls):
-        #Release lock and wake up the first from the waiting list
+    def release(self):
         lockLocks[self.id].acquire()
-        if self.waiters:
-            id = self.waiters.pop(0)
-            if id == -1:
-                locks[self.id].release()
-            else:
-                controlls[CNT_WORKERS][id].sendRequest(CMD_RELEASE_LOCK,
-                                                       {
-                                                           "ID": self.id
-                                                       })
-        else:
-            self.locked = False
+        self.wakeNext()
+        lockLocks[self.id].release()
+
+    def wakeNext(self):
+        #Give the lock to the first from the waiting list that is still
+        #there to take it, a waiter that can't be told it got the lock
+        #doesn't get it, must hold the lock
+        while self.waiters:
+            waiter = self.waiters.pop(0)
+            if waiter.abandoned():
+                continue
+            self.owner = waiter["TASK"]
+            if waiter.respond(True):
+                return
+        self.locked = False
+        self.owner = None
+
+    def taskKilled(self, taskId):
+        lockLocks[self.id].acquire()
+        forgetWaiters(self.waiters, taskId)
+        if self.locked and self.owner == taskId:
+            self.wakeNext()
         lockLocks[self.id].release()
 
 
-def registerLockMaster(request, controlls):
-    #A handler used by Workgroup.dispatcher
-    id = request["ID"]
-    for worker in controlls[CNT_WORKERS]:
-        worker.sendRequest(CMD_REGISTER_LOCK, {"ID": id})
+def forgetWaiters(waiters, taskId):
+    #Take out the requests of a killed task, the answer goes nowhere
+    #but the worker stops waiting for it
+    for waiter in [waiter for waiter in waiters if waiter["TASK"] == taskId]:
+        waiters.remove(waiter)
+        waiter.respondError("The task was killed")
+
+
+def releaseKilledTask(taskId):
+    if lockHandlers:
+        for handler in list(lockHandlers.values()):
+            if handler:
+                handler.taskKilled(taskId)
 
 
 def acquireLockMaster(request, controlls):
     #A handler used by Workgroup.dispatcher
-    lockHandlers[request["ID"]].acquire(request.requester, controlls)
+    request.defer()
+    lockHandlers[request["ID"]].acquire(request)
 
 
 def releaseLockMaster(request, controlls):
     #A handler used by Workgroup.dispatcher
-    lockHandlers[request["ID"]].release(controlls)
-
-
-def registerLockWorker(request):
-    locks[request["ID"]] = Lock()
-    locks[request["ID"]].acquire()
-
-
-def releaseLockWorker(request):
-    locks[request["ID"]].release()
+    lockHandlers[request["ID"]].release()
 
 
-masterHandlers = {CMD_REGISTER_LOCK: registerLockMaster, CMD_ACQUIRE_LOCK: acquireLockMaster,
-                  CMD_RELEASE_LOCK: releaseLockMaster}
-workerHandlers = {CMD_RELEASE_LOCK: releaseLockWorker, CMD_REGISTER_LOCK: registerLockWorker}
\ No newline at end of file
+masterHandlers = {CMD_ACQUIRE_LOCK: acquireLockMaster, CMD_RELEASE_LOCK: releaseLockMaster}
+workerHandlers = {}
+taskKilledHandlers.append(releaseKilledTask)
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+Running a function over many items, used by :py:meth:`Workgroup.map <NetWork.workgroup.Workgroup.map>`,
+:py:meth:`Workgroup.imap <NetWork.workgroup.Workgroup.imap>` and
+:py:meth:`Workgroup.imap_unordered <NetWork.workgroup.Workgroup.imap_unordered>`.
+
+Items are grouped in chunks and every chunk is run as one task, so a million items
+don't need a million tasks. At most ``window`` chunks are running or waiting for their
+results to be used, a new chunk is taken from the iterable when the results of one are
+used, so the iterable can be endless and a slow chunk doesn't make the ordered results
+pile up behind it.
+If the chunk size isn't given it's adapted to the function: every chunk measures how
+long the function took per item and the next chunks are made big enough to run for
+about :py:const:`CHUNK_DURATION` seconds.
+"""
+from functools import partial
+from itertools import islice
+from queue import Queue
+
+from .task import Task, getTaskState, runChunk
+from .cntcodes import CNT_WORKERS
+
+#seconds that a chunk should run when the chunk size is adapted
+CHUNK_DURATION = 0.1
+MAX_CHUNK_SIZE = 100000
+#running chunks per live worker when the window isn't given
+CHUNKS_PER_WORKER = 2
+
+
+class ChunkedMap:
+    #Runs a function over the items of an iterable in chunks, yields (index, results)
+    #for every chunk as it finishes, the chunk index is its position in the iterable
+    def __init__(self, workgroup, function, iterable, chunksize=None, window=None):
+        if chunksize is not None and chunksize < 1:
+            raise ValueError("Chunk size must be at least 1")
+        if window is not None and window < 1:
+            raise ValueError("Window must be at least 1")
+        self.workgroup = workgroup
+        self.function = Task(target=function)
+        self.items = iter(iterable)
+        self.adaptive = chunksize is None
+        self.chunksize = chunksize or 1
+        self.itemDuration = None
+        if window is None:
+            liveWorkers = [worker for worker in workgroup.controls[CNT_WORKERS] if worker.alive]
+            window = CHUNKS_PER_WORKER * max(len(liveWorkers), 1)
+        self.window = window
+        self.finishedChunks = Queue()
+        self.running = 0
+        #chunks that are running or whose results weren't used yet
+        self.outstanding = 0
+        self.nextIndex = 0
+
+    def submitChunk(self):
+        #Start the next chunk, return False if there are no more items
+        chunk = list(islice(self.items, self.chunksize))
+        if not chunk:
+            return False
+        handler = self.workgroup.submit(runChunk, (self.function, chunk))
+        getTaskState(handler.id).addCallback(partial(self.finishedChunks.put, (self.nextIndex, handler)))
+        self.nextIndex += 1
+        self.running += 1
+        self.outstanding += 1
+        return True
+
+    def fill(self):
+        #Start chunks until the window is full
+        while self.outstanding < self.window and self.submitChunk():
+            pass
+
+    def release(self):
+        #The results of a chunk are being used, make room for the next chunk
+        self.outstanding -= 1
+        self.fill()
+
+    def adapt(self, itemCount, duration):
+        #Choose the size of the next chunks from the measured time per item
+        if not self.adaptive:
+            return
+        itemDuration = duration / itemCount
+        if self.itemDuration is None:
+            self.itemDuration = itemDuration
+        else:
+            self.itemDuration = (self.itemDuration + itemDuration) / 2
+        if self.itemDuration > 0:
+            self.chunksize = int(CHUNK_DURATION / self.itemDuration)
+        else:
+            self.chunksize = MAX_CHUNK_SIZE
+        self.chunksize = max(1, min(self.chunksize, MAX_CHUNK_SIZE))
+
+    def chunks(self):
+        #A yielded chunk keeps its place in the window until release is called,
+        #callers release it before they use the results so the next chunk runs meanwhile
+        self.fill()
+        while self.running:
+            index, handler = self.finishedChunks.get()
+            self.running -= 1
+            if handler.exceptionRaised():
+                raise handler.exception()
+            results, duration = handler.result()
+            self.adapt(len(results), duration)
+            yield index, results
+
+    def ordered(self):
+        #Yield results in the order of the items, chunks that finish early wait in
+        #the window, so no more than window chunks are ever kept here
+        waiting = {}
+        nextIndex = 0
+        for index, results in self.chunks():
+            waiting[index] = results
+            while nextIndex in waiting:
+                results = waiting.pop(nextIndex)
+                nextIndex += 1
+                self.release()
+                yield from results
+
+    def unordered(self):
+        #Yield results as their chunks finish
+        for index, results in self.chunks():
+            self.release()
+            yield from results
@@ -36,8 +36,10 @@ Without the wrapping part, an exception would get raised in task1 about failed u
 from types import FunctionType
 import inspect
 import marshal
-from .cntcodes import CNT_WORKERS
+from .broadcast import broadcast, relayedRequests
 from .request import sendRequest
+from .cntcodes import CNT_NET_CLASSES
+import NetWork.workerprocess as workerprocess
 
 CMD_REGISTER_NETCLASS = b"NCR"
 classCount = 0
@@ -182,17 +184,30 @@ def masterInit(workgroup):
 
 
 def workerInit():
-    pass
+    relayedRequests.add(CMD_REGISTER_NETCLASS)
 
 
 def registerClassMaster(request, controlls):
-    for worker in controlls[CNT_WORKERS]:
-        worker.sendRequest(CMD_REGISTER_NETCLASS, {"CLS": request["CLS"]})
+    #kept for workers that join later
+    controlls[CNT_NET_CLASSES].append(request["CLS"])
+    broadcast(controlls, CMD_REGISTER_NETCLASS, {"CLS": request["CLS"]})
 
 
-def registerClassWorker(request):
+def sendClasses(worker, controlls):
+    #A worker that joined gets the classes registered before it
+    for netClass in controlls[CNT_NET_CLASSES]:
+        worker.sendRequest(CMD_REGISTER_NETCLASS, {"CLS": netClass})
+
+
+def addClass(request):
     classMethods[request["CLS"].id] = request["CLS"].methodDict
     staticMethods[request["CLS"].id] = request["CLS"].staticMethodDict
 
+
+def registerClassWorker(request):
+    #Tasks run in separate processes, they need the class too
+    addClass(request)
+    workerprocess.shareWithProcesses(addClass, request.getContents())
+
 masterHandlers = {CMD_REGISTER_NETCLASS: registerClassMaster}
 workerHandlers = {CMD_REGISTER_NETCLASS: registerClassWorker}
\ No newline at end of file
@@ -3,9 +3,9 @@ This module implements a socket classes used to safely handle
 network messaging, message length and security.
 """
 import socket
+import struct
 import hmac
 import hashlib
-from multiprocessing import Lock
 
 try:
     from Crypto.Cipher import AES
@@ -16,7 +16,7 @@ except ImportError:
     cryptoAvailable = False
 
 try:
-    from ssl import SSLContext, PROTOCOL_TLSv1, CERT_REQUIRED, SSLError, SSLSocket
+    from ssl import SSLContext, PROTOCOL_TLSv1, CERT_REQUIRED, SSLError
 
     SSLAvailable = True
 except ImportError:
@@ -24,9 +24,10 @@ except ImportError:
 
 COMCODE_CHECKALIVE = b"ALV"
 COMCODE_ISALIVE = b"IMALIVE"
+COMCODE_CHECKPEER = b"PEER"
 ISALIVE_TIMEOUT = 10
 DEFAULT_TCP_PORT = 32151
-BUFFER_READ_LENGTH = 4096
+BUFFER_READ_LENGTH = 256 * 1024
 MESSAGE_LENGTH_DELIMITER = b"MLEN"
 MAX_MESSAGELENGTH_LENGTH = 10
 DEFAULT_LISTENING_ADDRESS = "0.0.0.0"
@@ -35,6 +36,13 @@ DEFAULT_SOCKET_TIMEOUT = 5.0
 AES_KEY_LENGTH = 16
 AES_IV_LENGTH = 16
 MAX_MESSAGELENGTH_LENGTH += len(MESSAGE_LENGTH_DELIMITER)
+FRAMING_BINARY = "BINARY"
+FRAMING_ASCII = "ASCII"
+BINARY_LENGTH_HEADER = struct.Struct("!Q")
+MAX_MESSAGE_LENGTH = 2 ** 30
+HEADER_TAG_LENGTH = 16
+HEADER_TAG_PREFIX = b"LENGTH"
+MAX_SEND_BUFFERS = 1024
 workgroup = None
 masterAddress = None
 
@@ -45,6 +53,9 @@ class InvalidMessageFormatError(OSError): pass
 class MessageNotCompleteError(OSError): pass
 
 
+class ConnectionClosed(MessageNotCompleteError): pass
+
+
 class UnauthenticatedMessage(OSError): pass
 
 
@@ -64,6 +75,12 @@ masterAddress = None
 class NWSocketTCP:
     #Currently the default socket class that implements a
     #classic TCP communication
+    receiveBuffer = b""
+    framing = FRAMING_BINARY
+    readSize = BUFFER_READ_LENGTH
+    maxMessageLength = MAX_MESSAGE_LENGTH
+    headerTagLength = 0
+
     def __init__(self, socketToUse=None, address=None):
         if socketToUse:
             self.internalSocket = socketToUse
@@ -73,6 +90,11 @@ class NWSocketTCP:
 
         self.internalSocket.setsockopt(socket.SOL_SOCKET,
                                        socket.SO_REUSEADDR, 1)
+        try:
+            #messages are written with a single call, no need to wait for more data
+            self.internalSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
         self.internalSocket.settimeout(DEFAULT_SOCKET_TIMEOUT)
         self.address = address
 
@@ -87,14 +109,82 @@ class NWSocketTCP:
 
     def recv(self):
         #safely receive all sent data
-        receivedData = b""
+        if self.framing == FRAMING_BINARY:
+            return self.decode(self.recvBinary())
+        else:
+            return self.decode(self.recvASCII())
+
+    def decode(self, message):
+        #check or decrypt a received message, used by secure sockets
+        return message
+
+    def headerTag(self, header):
+        #secure sockets send a tag after the binary length header so the length can be
+        #checked before a buffer for the message is allocated
+        return b""
+
+    def checkHeader(self, header, tag):
+        pass
+
+    def checkLength(self, messageLength):
+        if messageLength > self.maxMessageLength:
+            raise LengthIndicatorTooLong("Message length " + str(messageLength) + " is too big")
+
+    def recvAvailable(self):
+        #receive whatever data has arrived, used when the socket is read by an
+        #event loop that knows the socket is readable, returns b"" if it got closed
+        data = self.internalSocket.recv(self.readSize)
+        if data and hasattr(self.internalSocket, "pending"):
+            #SSL sockets can hold decrypted data that the event loop doesn't know about
+            while self.internalSocket.pending():
+                data += self.internalSocket.recv(self.readSize)
+        return data
+
+    def fileno(self):
+        return self.internalSocket.fileno()
+
+    def recvBinary(self):
+        #receive a message that starts with a fixed size binary length, the
+        #message is received directly into one preallocated buffer
+        header = bytearray(BINARY_LENGTH_HEADER.size + self.headerTagLength)
+        if not self.recvInto(memoryview(header)):
+            raise ConnectionClosed("Socket got closed before a new message started")
+        self.checkHeader(bytes(header[:BINARY_LENGTH_HEADER.size]), bytes(header[BINARY_LENGTH_HEADER.size:]))
+        messageLength = BINARY_LENGTH_HEADER.unpack_from(header)[0]
+        self.checkLength(messageLength)
+        message = bytearray(messageLength)
+        if self.recvInto(memoryview(message)) < messageLength:
+            raise MessageNotCompleteError("socket got closed before receiving the entire message")
+        return message
+
+    def recvInto(self, buffer):
+        #fill the buffer with received data, return how much was received
+        #less than the buffer size is received only if the socket got closed
+        received = 0
+        while received < len(buffer):
+            newData = self.internalSocket.recv_into(buffer[received:],
+                                                    min(len(buffer) - received, self.readSize))
+            if newData == 0:
+                if received:
+                    raise MessageNotCompleteError("socket got closed before receiving the entire message")
+                return 0
+            received += newData
+        return received
+
+    def recvASCII(self):
+        #receive a message that starts with its length written in ASCII followed by
+        #MESSAGE_LENGTH_DELIMITER, bytes that arrive after the end of the message
+        #belong to the next message and are kept for the next call
+        receivedData = self.receiveBuffer
         while receivedData.find(MESSAGE_LENGTH_DELIMITER) == -1:
             if len(receivedData) > MAX_MESSAGELENGTH_LENGTH:
                 raise LengthIndicatorTooLong
             if not NWSocketTCP.checkMessageFormat(receivedData):
                 raise InvalidMessageFormatError("Received string not formatted properly")
-            newData = self.internalSocket.recv(BUFFER_READ_LENGTH)
+            newData = self.internalSocket.recv(self.readSize)
             if len(newData) == 0:
+                if not receivedData:
+                    raise ConnectionClosed("Socket got closed before a new message started")
                 raise MessageNotCompleteError(
                     b"Socket got closed before receiving the entire message, got only: " + receivedData)
             receivedData += newData
@@ -102,19 +192,40 @@ class NWSocketTCP:
             raise InvalidMessageFormatError("Received string not formatted properly")
         sizelen = receivedData.find(MESSAGE_LENGTH_DELIMITER)
         messageLength = int(receivedData[0:sizelen])
+        self.checkLength(messageLength)
         receivedData = receivedData[sizelen + len(MESSAGE_LENGTH_DELIMITER):]
         while len(receivedData) < messageLength:
-            newData = self.internalSocket.recv(BUFFER_READ_LENGTH)
+            newData = self.internalSocket.recv(self.readSize)
             if len(newData) == 0:
                 raise MessageNotCompleteError("socket got closed before receiving the entire message")
             receivedData += newData
-        return receivedData
+        self.receiveBuffer = receivedData[messageLength:]
+        return receivedData[:messageLength]
 
     def send(self, data):
-        #send given data
-        dataLength = str(len(data)).encode(encoding="ASCII")
-        message = dataLength + MESSAGE_LENGTH_DELIMITER + data
-        self.internalSocket.sendall(message)
+        #send given data, data can also be a list of buffers, they are sent
+        #as a single message without being joined first
+        buffers = NWSocketTCP.bufferList(data)
+        dataLength = sum(len(buffer) for buffer in buffers)
+        if self.framing == FRAMING_BINARY:
+            header = BINARY_LENGTH_HEADER.pack(dataLength)
+            header += self.headerTag(header)
+        else:
+            header = str(dataLength).encode(encoding="ASCII") + MESSAGE_LENGTH_DELIMITER
+        self.sendBuffers([header] + buffers)
+
+    def sendBuffers(self, buffers):
+        #write all buffers to the socket with as few calls as possible
+        try:
+            while buffers:
+                sent = self.internalSocket.sendmsg(buffers[:MAX_SEND_BUFFERS])
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                if sent:
+                    buffers[0] = buffers[0][sent:]
+        except NotImplementedError:
+            #SSL sockets can't send multiple buffers at once
+            self.internalSocket.sendall(b"".join(buffers))
 
     def connect(self, address, port=DEFAULT_TCP_PORT):
         #connect to the address
@@ -130,6 +241,14 @@ class NWSocketTCP:
         #close the socket
         self.internalSocket.close()
 
+    def shutdown(self):
+        #stop all communication on the socket, unlike close this also
+        #wakes up a thread that is blocked receiving from the socket
+        try:
+            self.internalSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     @staticmethod
     def checkAvailability(address):
         #check if there's a worker on the address     
@@ -143,6 +262,13 @@ class NWSocketTCP:
 
         return response == COMCODE_ISALIVE, testSocket.address
 
+    @staticmethod
+    def bufferList(data):
+        #turn data (one buffer or a list of buffers) into a list of byte memoryviews
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        return [memoryview(buffer).cast("B") for buffer in data]
+
     @staticmethod
     def checkMessageFormat(message):
         #check if a message fits the format
@@ -170,9 +296,66 @@ class NWSocketTCP:
         pass
 
 
+class MessageAssembler:
+    #Puts together messages from data that arrives in pieces of any size,
+    #used when a socket is read by an event loop instead of recv
+    def __init__(self, socket, initialData=b""):
+        self.socket = socket
+        self.framing = socket.framing
+        self.buffer = bytearray(initialData)
+
+    def feed(self, data):
+        #add received data, return a list of all messages that are now complete
+        self.buffer += data
+        messages = []
+        position = 0
+        while True:
+            if self.framing == FRAMING_BINARY:
+                lengthEnd = position + BINARY_LENGTH_HEADER.size
+                headerEnd = lengthEnd + self.socket.headerTagLength
+                if len(self.buffer) < headerEnd:
+                    break
+                self.socket.checkHeader(bytes(self.buffer[position:lengthEnd]), bytes(self.buffer[lengthEnd:headerEnd]))
+                messageLength = BINARY_LENGTH_HEADER.unpack_from(self.buffer, position)[0]
+            else:
+                headerEnd = self.buffer.find(MESSAGE_LENGTH_DELIMITER, position,
+                                             position + MAX_MESSAGELENGTH_LENGTH)
+                if headerEnd == -1:
+                    if len(self.buffer) - position >= MAX_MESSAGELENGTH_LENGTH:
+                        raise LengthIndicatorTooLong
+                    if not NWSocketTCP.checkMessageFormat(bytes(self.buffer[position:])):
+                        raise InvalidMessageFormatError("Received string not formatted properly")
+                    break
+                headerEnd += len(MESSAGE_LENGTH_DELIMITER)
+                header = bytes(self.buffer[position:headerEnd])
+                if not NWSocketTCP.checkMessageFormat(header):
+                    raise InvalidMessageFormatError("Received string not formatted properly")
+                messageLength = int(header[:-len(MESSAGE_LENGTH_DELIMITER)])
+            self.socket.checkLength(messageLength)
+            if len(self.buffer) < headerEnd + messageLength:
+                break
+            messages.append(self.buffer[headerEnd:headerEnd + messageLength])
+            position = headerEnd + messageLength
+        if position:
+            del self.buffer[:position]
+        return messages
+
+
+def lengthTag(key, header):
+    #Authenticates the length of a message, the prefix keeps it from matching the HMAC of a message
+    return hmac.new(key=key, msg=HEADER_TAG_PREFIX + header, digestmod=hashlib.sha256).digest()[:HEADER_TAG_LENGTH]
+
+
+def checkLengthTag(key, header, tag):
+    if not hmac.compare_digest(lengthTag(key, header), tag):
+        raise UnauthenticatedMessage("Bad HMAC of the message length")
+
+
 class NWSocketHMAC(NWSocketTCP):
     #A socket class that implements HMAC message verification
+    #the length of a message is verified before the message is received
     listenerHMAC = None
+    headerTagLength = HEADER_TAG_LENGTH
 
     def __init__(self, socketToUse=None, parameters=None):
         if socketToUse:
@@ -191,11 +374,11 @@ class NWSocketHMAC(NWSocketTCP):
         self.address = parameters[0]
         self.HMACKey = parameters[1]
 
-    def recv(self):
-        receivedData = NWSocketTCP.recv(self)
+    def decode(self, receivedData):
+        receivedData = memoryview(receivedData)
         hashLength = hashlib.sha256().digest_size
         message = receivedData[:-hashLength]
-        receivedHash = receivedData[-hashLength:]
+        receivedHash = bytes(receivedData[-hashLength:])
         messageHash = hmac.new(key=self.HMACKey, msg=message, digestmod=hashlib.sha256)
 
         try:
@@ -210,11 +393,18 @@ class NWSocketHMAC(NWSocketTCP):
         else:
             raise UnauthenticatedMessage("Bad HMAC")
 
+    def headerTag(self, header):
+        return lengthTag(self.HMACKey, header)
+
+    def checkHeader(self, header, tag):
+        checkLengthTag(self.HMACKey, header, tag)
+
     def send(self, data):
-        messageHash = hmac.new(key=self.HMACKey, msg=data, digestmod=hashlib.sha256)
-        hash = messageHash.digest()
-        message = data + hash
-        NWSocketTCP.send(self, message)
+        buffers = NWSocketTCP.bufferList(data)
+        messageHash = hmac.new(key=self.HMACKey, digestmod=hashlib.sha256)
+        for buffer in buffers:
+            messageHash.update(buffer)
+        NWSocketTCP.send(self, buffers + [messageHash.digest()])
 
     def accept(self):
         requestData = self.internalSocket.accept()
@@ -266,6 +456,7 @@ if cryptoAvailable:
     class NWSocketAES(NWSocketTCP):
         #A socket class that implements AES message encryption
         listenerAES = None
+        headerTagLength = HEADER_TAG_LENGTH
 
         def __init__(self, socketToUse=None, parameters=None):
             if socketToUse:
@@ -288,13 +479,17 @@ if cryptoAvailable:
             requestData = self.internalSocket.accept()
             return NWSocketAES(requestData[0], (requestData[1][0], self.listenerAES))
 
-        def recv(self):
-            receivedData = NWSocketTCP.recv(self)
-            decryptedData = AESDecrypt(receivedData, self.AESKey)
-            return decryptedData
+        def decode(self, receivedData):
+            return AESDecrypt(receivedData, self.AESKey)
+
+        def headerTag(self, header):
+            return lengthTag(self.AESKey, header)
+
+        def checkHeader(self, header, tag):
+            checkLengthTag(self.AESKey, header, tag)
 
         def send(self, data):
-            encryptedData = AESEncrypt(data, self.AESKey)
+            encryptedData = AESEncrypt(b"".join(NWSocketTCP.bufferList(data)), self.AESKey)
             NWSocketTCP.send(self, encryptedData)
 
         @staticmethod
@@ -330,13 +525,11 @@ if cryptoAvailable:
             self.address = parameters[0]
             self.AESKey = parameters[2]
 
-        def recv(self):
-            receivedData = NWSocketHMAC.recv(self)
-            decryptedData = AESDecrypt(receivedData, self.AESKey)
-            return decryptedData
+        def decode(self, receivedData):
+            return AESDecrypt(NWSocketHMAC.decode(self, receivedData), self.AESKey)
 
         def send(self, data):
-            encryptedData = AESEncrypt(data, self.AESKey)
+            encryptedData = AESEncrypt(b"".join(NWSocketTCP.bufferList(data)), self.AESKey)
             NWSocketHMAC.send(self, encryptedData)
 
         @staticmethod
@@ -362,8 +555,6 @@ if SSLAvailable:
         peerCertFile = None
         peerCertDir = None
         context = None
-        sockets = []
-        socketLock = Lock()
 
         def __init__(self, socketToUse=None, address=None):
             if socketToUse:
@@ -389,17 +580,6 @@ if SSLAvailable:
             except SSLError as error:
                 raise SSLProblem("Bad request received ", error)
 
-        def __getstate__(self):
-            self.socketLock.acquire()
-            self.sockets.append(self.internalSocket)
-            sockId = len(self.sockets) - 1
-            self.socketLock.release()
-            return {"address": self.address, "sockId": sockId}
-
-        def __setstate__(self, state):
-            self.address = state["address"]
-            self.internalSocket = self.sockets[state["sockId"]]
-
         @staticmethod
         def setUp(params):
             NWSocketSSL.localCertFile = params["LocalCert"]
@@ -430,7 +610,18 @@ sockets.update({"AES": NWSocketAES, "AES+HMAC": NWSocketHMACandAES,
                 "SSL": NWSocketSSL})
 
 
-def setUp(socketType, params):
+def setUp(socketType, params, listening=True):
+    #A master only connects, the listener keys are required where listener sockets are made
+    if not listening:
+        params = dict({"ListenerHMAC": None, "ListenerAES": None}, **params)
+    if "Framing" in params:
+        if not params["Framing"] in (FRAMING_BINARY, FRAMING_ASCII):
+            raise ValueError("Unknown framing " + str(params["Framing"]))
+        NWSocketTCP.framing = params["Framing"]
+    if "ReadSize" in params:
+        NWSocketTCP.readSize = int(params["ReadSize"])
+    if "MaxMessageLength" in params:
+        NWSocketTCP.maxMessageLength = int(params["MaxMessageLength"])
     if socketType:
         try:
             sockets[socketType].setUp(params)
@@ -0,0 +1,251 @@
+"""
+An object store that keeps data on the workers that produced it. Instead of returning a big
+result to the master and passing it to the next task, a task can :py:func:`put` it in the store
+of its worker and return the :py:class:`ObjectRef` it gets, or the master can take a reference
+to a task's result with :py:meth:`TaskHandler.ref <NetWork.task.TaskHandler.ref>`. A task that gets
+a reference reads the object with :py:meth:`ObjectRef.get`, its worker fetches the object directly
+from the worker that holds it, the master only passes the small reference around.
+
+.. code-block:: python
+
+    from NetWork import Workgroup, put
+
+    def load(path):
+        return put(readHugeFile(path))
+
+    def count(data):
+        return len(data.get())
+
+    with Workgroup(workerList....) as w:
+        data = w.submit(load, ("/data/input",)).result()
+        print(w.submit(count, (data,)).result())
+        #or keep the result of a task on its worker
+        parsed = w.submit(parse, ("/data/input",)).ref()
+        print(w.submit(count, (parsed,)).result())
+
+Workers fetch objects from each other only with the default (unprotected TCP) sockets, with
+other socket types objects go through the master. Objects put on the master are kept on the master.
+Objects stay in the store until they are deleted with :py:meth:`ObjectRef.delete`.
+
+Submitted tasks are placed close to their data: references given in the arguments of a task
+(directly or in lists, tuples and dicts) tell the master where its inputs are, and the task
+goes to the worker that holds most of them unless that worker is much busier than the others,
+see :py:mod:`NetWork.placement`. :py:meth:`TaskHandler.bytesMoved <NetWork.task.TaskHandler.bytesMoved>`
+and :py:meth:`Workgroup.bytesMoved <NetWork.workgroup.Workgroup.bytesMoved>` show how much
+of the inputs had to be fetched from other computers.
+"""
+import pickle
+import uuid
+from threading import Lock
+
+from .request import sendRequest, sendRequestWithResponse, forwardRaw
+from .cntcodes import *
+import NetWork.request
+import NetWork.peers as peers
+import NetWork.task as task
+import NetWork.workerprocess as workerprocess
+
+CMD_PUT_OBJECT = b"OPT"
+CMD_GET_OBJECT = b"OGT"
+CMD_DELETE_OBJECT = b"ODL"
+CMD_RESULT_REF = b"ORF"
+FETCH_TIMEOUT = 60.0
+#keys of references to results of tasks start with this
+RESULT_KEY = "task-"
+MASTER_ID = -1
+
+#key -> pickled object, on the master and on worker servers
+objects = {}
+lock = Lock()
+
+
+class ObjectRef:
+    """
+    Reference to an object in the store of a worker (or of the master), it can be passed to
+    tasks and returned from them, only the reference is sent.
+
+    :ivar key: key of the object in the store
+    :ivar owner: ID of the worker that holds the object, -1 for the master
+    :ivar size: size of the pickled object in bytes
+    """
+
+    def __init__(self, key, owner, size=None):
+        self.key = key
+        self.owner = owner
+        self.size = size
+
+    def get(self):
+        """
+        Get the object, it's fetched from the worker that holds it every time this is called
+        """
+        if NetWork.request.runningOnMaster and self.owner == MASTER_ID:
+            return pickle.loads(getPickled(self.key))
+        return sendRequestWithResponse(CMD_GET_OBJECT, {"REF": self})
+
+    def delete(self):
+        """
+        Remove the object from the store, deleting the result of a task removes it from the
+        worker, the task's :py:meth:`TaskHandler.result <NetWork.task.TaskHandler.result>`
+        won't work anymore if the result was too big to be sent to the master
+        """
+        sendRequest(CMD_DELETE_OBJECT, {"REF": self})
+
+    def __repr__(self):
+        return "ObjectRef(" + repr(self.key) + ", owner=" + str(self.owner) + ", size=" + str(self.size) + ")"
+
+
+def put(value):
+    """
+    Put an object in the store, in a task it's put in the store of the worker running the task.
+
+    :type value: object
+    :param value: a picklable object
+
+    :rtype: :py:class:`ObjectRef`
+    :return: reference to the object
+    """
+    pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if NetWork.request.runningOnMaster:
+        return storeObject(pickled, MASTER_ID)
+    return sendRequestWithResponse(CMD_PUT_OBJECT, {"DATA": pickled})
+
+
+def inputLocation(args, kwargs):
+    #Bytes of the objects referenced in the arguments of a task held by each owner
+    location = {}
+    pending = [args, kwargs]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, task.TaskOutput):
+            value = value.ref
+        if isinstance(value, ObjectRef):
+            location[value.owner] = location.get(value.owner, 0) + (value.size or 0)
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+    return location
+
+
+def storeObject(pickled, owner):
+    key = uuid.uuid4().hex
+    lock.acquire()
+    objects[key] = pickled
+    lock.release()
+    return ObjectRef(key, owner, len(pickled))
+
+
+def getPickled(key):
+    #Pickled object from this store, results of tasks are read from the tasks of the worker
+    if key.startswith(RESULT_KEY) and int(key[len(RESULT_KEY):]) in task.tasks:
+        return task.tasks[int(key[len(RESULT_KEY):])].getPickledResult()
+    lock.acquire()
+    try:
+        if not key in objects:
+            raise KeyError("Object " + key + " is not in the store")
+        return objects[key]
+    finally:
+        lock.release()
+
+
+def deleteObject(key):
+    if key.startswith(RESULT_KEY):
+        task.tasks.pop(int(key[len(RESULT_KEY):]), None)
+        return
+    lock.acquire()
+    objects.pop(key, None)
+    lock.release()
+
+
+def resultRef(taskId):
+    #Reference to the result of a finished task, used by TaskHandler.ref
+    return sendRequestWithResponse(CMD_RESULT_REF, {"ID": taskId})
+
+
+def taskResultRef(taskId, controls):
+    #Used on the master, None if the task didn't run on a worker
+    if not taskId in controls[CNT_TASK_EXECUTORS]:
+        return None
+    #the worker keeps the result until the reference is deleted
+    task.getTaskState(taskId).referenced = True
+    return ObjectRef(RESULT_KEY + str(taskId), controls[CNT_TASK_EXECUTORS][taskId],
+                     task.getTaskState(taskId).resultSize)
+
+
+def getObjectMaster(request, controls):
+    #A worker that can't fetch an object directly gets it through the master
+    ref = request["REF"]
+    if ref.owner == MASTER_ID:
+        try:
+            request.respondRaw(getPickled(ref.key))
+        except KeyError as error:
+            request.respondError(error)
+        return
+    worker = controls[CNT_WORKERS][ref.owner]
+    if not worker.alive:
+        request.respondError(KeyError("Worker " + str(ref.owner) + " that held the object is dead"))
+        return
+    request.defer()
+    worker.sendRequestWithResponse(CMD_GET_OBJECT, {"REF": ref}, request.completeRawResponse, True)
+
+
+def deleteObjectMaster(request, controls):
+    ref = request["REF"]
+    if ref.owner == MASTER_ID:
+        deleteObject(ref.key)
+    elif controls[CNT_WORKERS][ref.owner].alive:
+        controls[CNT_WORKERS][ref.owner].sendRequest(CMD_DELETE_OBJECT, {"REF": ref})
+
+
+def resultRefMaster(request, controls):
+    taskId = request["ID"]
+    ref = taskResultRef(taskId, controls)
+    if ref:
+        request.respond(ref)
+    else:
+        request.respondError(KeyError("Task " + str(taskId) + " wasn't started on a worker"))
+
+
+def putObjectWorker(request):
+    request.respond(storeObject(request["DATA"], peers.selfId))
+
+
+def getObjectWorker(request):
+    #From tasks of this worker, from other workers and from the master, an object
+    #that is somewhere else is answered when it arrives, the handler doesn't wait for it
+    ref = request["REF"]
+    if ref.owner == peers.selfId:
+        request.respondRaw(getPickled(ref.key))
+    elif peers.available() and ref.owner != MASTER_ID:
+        channel = peers.getPeerChannel(peers.addresses[ref.owner])
+        forwardRaw(request, channel, CMD_GET_OBJECT, pickle.dumps({"REF": ref}), FETCH_TIMEOUT)
+    else:
+        forwardRaw(request, NetWork.request.channel, CMD_GET_OBJECT, pickle.dumps({"REF": ref}), FETCH_TIMEOUT)
+
+
+def deleteObjectWorker(request):
+    deleteObject(request["REF"].key)
+
+
+masterHandlers = {CMD_GET_OBJECT: getObjectMaster, CMD_DELETE_OBJECT: deleteObjectMaster,
+                  CMD_RESULT_REF: resultRefMaster}
+
+workerHandlers = {CMD_GET_OBJECT: getObjectWorker, CMD_DELETE_OBJECT: deleteObjectWorker}
+
+
+def processForked():
+    #A server thread may have held the lock when a pool process was forked
+    global lock
+    lock = Lock()
+
+
+workerprocess.afterForkHandlers.append(processForked)
+
+
+def masterInit(workgroup):
+    objects.clear()
+
+
+def workerInit():
+    workerprocess.localHandlers.update({CMD_PUT_OBJECT: putObjectWorker, CMD_GET_OBJECT: getObjectWorker})
+    peers.acceptedRequests.add(CMD_GET_OBJECT)
@@ -0,0 +1,65 @@
+"""
+Connections between workers, used on worker computers.
+
+The master tells every worker its own ID and the addresses of the other workers
+(:py:const:`NetWork.commcodes.CMD_SET_PEERS`), only those workers may connect to it.
+Workers connect to each other to relay broadcasts (see NetWork.broadcast) and to fetch
+objects from each other's object store (see NetWork.objectstore). A worker connects to
+another one when it first needs it and keeps the channel open. Other workers can send
+only the requests in :py:data:`acceptedRequests`, relaying is accepted only when the
+master enables it.
+
+Workers can connect to each other only with the default (unprotected TCP) sockets, with
+other socket types the master doesn't send the addresses and workers talk only to the master.
+"""
+from threading import Lock
+
+from .networking import COMCODE_CHECKPEER, COMCODE_ISALIVE
+from .channel import Channel
+import NetWork.networking
+
+#addresses of the workers, indexed by worker ID
+addresses = []
+allowed = set()
+#ID of this worker in the workgroup
+selfId = None
+acceptedRequests = set()
+channels = {}
+channelsLock = Lock()
+
+
+def setPeers(peerAddresses, workerId):
+    global addresses, allowed, selfId
+    addresses = list(peerAddresses)
+    allowed = set(addresses)
+    selfId = workerId
+
+
+def available():
+    return bool(addresses)
+
+
+def getPeerChannel(address):
+    #Channels to other workers are opened when they are first needed
+    channelsLock.acquire()
+    try:
+        channel = channels.get(address)
+        if channel is None or channel.closed:
+            connection = NetWork.networking.NWSocket()
+            try:
+                connection.connect(address)
+                connection.send(COMCODE_CHECKPEER)
+                response = connection.recv()
+            except OSError:
+                connection.close()
+                raise
+            if response != COMCODE_ISALIVE:
+                connection.close()
+                raise ConnectionRefusedError("Worker " + str(address) + " refused the connection")
+            connection.setTimeout(None)
+            channel = Channel(connection)
+            channel.start()
+            channels[address] = channel
+        return channel
+    finally:
+        channelsLock.release()
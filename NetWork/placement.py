@@ -0,0 +1,235 @@
+"""
+A placement policy decides which worker runs the next submitted task, it's chosen
+with the ``placement`` argument of Workgroup.
+
+Available policies:
+
+  * ``"round-robin"`` (default) workers get tasks in turn, regardless of their size and load
+  * ``"least-outstanding"`` the worker with the fewest unfinished tasks
+  * ``"capacity"`` the worker with the fewest unfinished tasks per slot, a worker
+    with 64 slots gets 8 times more tasks than one with 8
+  * ``"two-choices"`` two random workers are compared the same way as with ``"capacity"``
+    and the less busy one gets the task, cheaper than looking at every worker and it
+    doesn't send all tasks to the same worker when the information is stale
+
+Tasks that get :py:class:`references <NetWork.objectstore.ObjectRef>` to objects in the object
+store are placed with every policy by comparing the workers: the data that would have to be
+moved to a worker counts as :py:const:`BYTES_PER_QUEUED_TASK` bytes for every task waiting on
+one of its slots, and the task goes to the worker where the sum of both is the smallest. The
+ratio can be changed with the ``bytesPerQueuedTask`` attribute of a policy.
+
+Tasks submitted with an ``affinity`` key don't use the policy, all tasks with the same key
+go to the same worker so they can use what earlier tasks left there (loaded models, open
+files...). Keys are assigned to workers by consistent hashing: every worker has
+:py:const:`RING_REPLICAS` points on a ring of hashes and a key goes to the worker with the
+first point after the key's hash. When a worker dies only its keys go to other workers, and
+a worker that joins (see :py:meth:`Workgroup.addWorker <NetWork.workgroup.Workgroup.addWorker>`)
+takes only the keys of its own points, the other keys stay where they were. Points are made
+from the addresses of workers, so a worker that comes back at the same address gets its keys back.
+
+The master counts unfinished tasks of every worker itself. When the workgroup is created
+every worker reports its number of slots (the size of its process pool, see ``--pool_size``
+of server.py), and every finished task carries the load of the worker that ran it (load
+average per CPU), so a worker that is busy with other work gets fewer tasks. Until a worker
+reports its slots it's treated as having one.
+"""
+import bisect
+import hashlib
+import os
+import random
+from threading import Lock
+
+from .commcodes import CMD_WORKER_INFO
+from .cntcodes import CNT_WORKERS, CNT_PLACEMENT
+
+#moving this much input data to a worker costs about as much as waiting behind one more task
+BYTES_PER_QUEUED_TASK = 16 * 1024 * 1024
+#points of every worker on the ring of affinity keys
+RING_REPLICAS = 100
+
+
+def currentLoad():
+    #Load average of this computer per CPU, 0 where it's not available
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def ringHash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def keyBytes(key):
+    #Hashes of keys must be the same in every run, hash() of strings isn't
+    if isinstance(key, bytes):
+        return key
+    if isinstance(key, str):
+        return key.encode("utf-8")
+    return repr(key).encode("utf-8")
+
+
+class HashRing:
+    #Consistent hashing of affinity keys to workers, the ring follows the live workers
+    #given to select, points of dead workers are removed and points of new ones added
+    def __init__(self, replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        self.members = set()
+
+    def add(self, worker):
+        for replica in range(self.replicas):
+            point = ringHash(keyBytes(worker.address) + b"#" + str(replica).encode())
+            position = bisect.bisect(self.points, point)
+            self.points.insert(position, point)
+            self.owners.insert(position, worker.id)
+        self.members.add(worker.id)
+
+    def remove(self, workerId):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != workerId]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+        self.members.discard(workerId)
+
+    def select(self, workers, key):
+        live = set(worker.id for worker in workers)
+        for workerId in self.members - live:
+            self.remove(workerId)
+        for worker in workers:
+            if not worker.id in self.members:
+                self.add(worker)
+        position = bisect.bisect(self.points, ringHash(keyBytes(key))) % len(self.points)
+        return self.owners[position]
+
+
+class Placement:
+    #Base of the policies, keeps what is known about the workers, select is called
+    #by the workgroup and the other methods by the dispatcher thread
+    def __init__(self):
+        self.lock = Lock()
+        self.outstanding = {}
+        self.slots = {}
+        self.load = {}
+        self.bytesPerQueuedTask = BYTES_PER_QUEUED_TASK
+        self.turn = -1
+        self.ring = HashRing()
+
+    def select(self, workers):
+        #Return the id of the worker that gets the next task, workers are the live ones
+        raise NotImplementedError()
+
+    def selectByKey(self, workers, key):
+        #The worker for tasks with an affinity key
+        return self.ring.select(workers, key)
+
+    def selectFor(self, workers, inputLocation):
+        #Like select for a task whose inputs are held by workers, inputLocation maps
+        #ids of the workers to bytes they hold, data on the master is the same for all
+        if not any(inputLocation.get(worker.id) for worker in workers):
+            return self.select(workers)
+        total = sum(inputLocation.values())
+        self.turn += 1
+        start = self.turn % len(workers)
+        workers = workers[start:] + workers[:start]
+
+        def cost(worker):
+            #ties go to the worker that holds more of the data
+            moved = total - inputLocation.get(worker.id, 0)
+            return self.score(worker.id) + moved / self.bytesPerQueuedTask, moved
+        return min(workers, key=cost).id
+
+    def score(self, workerId):
+        #How busy a worker is, lower is better
+        busy = (self.outstanding.get(workerId, 0) + 1) / self.slots.get(workerId, 1)
+        return max(busy, self.load.get(workerId, 0.0))
+
+    def taskStarted(self, workerId):
+        self.lock.acquire()
+        self.outstanding[workerId] = self.outstanding.get(workerId, 0) + 1
+        self.lock.release()
+
+    def taskFinished(self, workerId, load=None):
+        self.lock.acquire()
+        self.outstanding[workerId] = max(self.outstanding.get(workerId, 0) - 1, 0)
+        if load is not None:
+            self.load[workerId] = load
+        self.lock.release()
+
+    def workerInfo(self, workerId, info):
+        self.lock.acquire()
+        self.slots[workerId] = max(info["SLOTS"], 1)
+        self.load[workerId] = info["LOAD"]
+        self.lock.release()
+
+
+class RoundRobin(Placement):
+    def __init__(self):
+        Placement.__init__(self)
+        self.current = -1
+
+    def select(self, workers):
+        self.current += 1
+        return workers[self.current % len(workers)].id
+
+
+class LeastOutstanding(Placement):
+    def __init__(self):
+        Placement.__init__(self)
+        self.current = -1
+
+    def select(self, workers):
+        #ties are broken in turn so idle workers are all used
+        self.current += 1
+        start = self.current % len(workers)
+        workers = workers[start:] + workers[:start]
+        return min(workers, key=lambda worker: self.outstanding.get(worker.id, 0)).id
+
+
+class CapacityWeighted(LeastOutstanding):
+    def select(self, workers):
+        self.current += 1
+        start = self.current % len(workers)
+        workers = workers[start:] + workers[:start]
+        return min(workers, key=lambda worker: self.score(worker.id)).id
+
+
+class PowerOfTwoChoices(Placement):
+    def select(self, workers):
+        if len(workers) == 1:
+            return workers[0].id
+        first, second = random.sample(workers, 2)
+        if self.score(second.id) < self.score(first.id):
+            return second.id
+        return first.id
+
+
+placements = {"round-robin": RoundRobin, "least-outstanding": LeastOutstanding,
+              "capacity": CapacityWeighted, "two-choices": PowerOfTwoChoices}
+
+
+def getPlacement(name):
+    #A policy can also be given as an instance of a Placement subclass
+    if isinstance(name, Placement):
+        return name
+    if not name in placements:
+        raise ValueError("Unknown placement policy " + str(name))
+    return placements[name]()
+
+
+def setUpPlacement(controls, placement):
+    #Ask every worker how many tasks it runs at once
+    controls[CNT_PLACEMENT] = placement
+    for worker in controls[CNT_WORKERS]:
+        askWorkerInfo(placement, worker)
+
+
+def askWorkerInfo(placement, worker):
+    worker.sendRequestWithResponse(CMD_WORKER_INFO, {}, workerInfoReceived(placement, worker.id))
+
+
+def workerInfoReceived(placement, workerId):
+    def callback(response, error):
+        if error is None:
+            placement.workerInfo(workerId, response)
+    return callback
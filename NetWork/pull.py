@@ -0,0 +1,223 @@
+"""
+Pull scheduling, chosen with ``scheduling="pull"`` of Workgroup.
+
+With the default push scheduling a task is sent to a worker when it's submitted (see
+:py:mod:`NetWork.placement`) and it stays there even if the worker is busy with long tasks
+while others are idle. With pull scheduling submitted tasks wait in a queue on the master
+and workers ask for them when they have free slots. Every worker keeps up to
+:py:const:`PREFETCH` times its slots tasks, the extra ones wait on the worker so its
+processes don't wait for the master between tasks.
+
+When a worker asks for tasks and the master has none, the master takes tasks that haven't
+started yet from the worker with most of them queued and gives them to the idle worker,
+so long tasks at the end of a job are spread over all workers.
+
+A worker keeps pulling when the connection to the master breaks, it asks again
+when the master connects again or after a delay that grows up to
+:py:const:`PULL_RETRY_MAX_DELAY`. It stops only when the master refuses to give it tasks.
+"""
+from collections import deque
+from functools import partial
+from threading import Thread, Lock, Event
+
+from .request import sendRequestWithResponse
+from .cntcodes import *
+from .channel import RemoteError
+from .placement import currentLoad
+from .workerprocess import getPool
+import NetWork.task as task
+import NetWork.codecache as codecache
+
+CMD_START_PULLING = b"PLS"
+CMD_PULL_TASKS = b"PLT"
+CMD_QUEUE_TASKS = b"PLQ"
+CMD_STEAL_TASKS = b"PLX"
+CMD_RETURN_TASKS = b"PLR"
+
+#a worker keeps up to PREFETCH times its slots tasks
+PREFETCH = 2
+#delays before a worker asks the master for tasks again after a failed pull
+PULL_RETRY_DELAY = 0.5
+PULL_RETRY_MAX_DELAY = 30.0
+
+workgroup = None
+puller = None
+pullerLock = Lock()
+#set when the master connects, a puller that waits to ask again asks right away
+masterConnected = Event()
+
+
+class PendingTasks:
+    #Tasks waiting on the master and pull requests of workers waiting for tasks,
+    #used only by the dispatcher thread
+    def __init__(self):
+        self.tasks = deque()
+        self.pullers = deque()
+        #workers that were asked for tasks and didn't answer yet or had none
+        self.victims = set()
+
+    def taskFinished(self, workerId, controls):
+        #A worker that is waiting for tasks may have got an idle slot
+        if not self.tasks and any(request.requester == workerId for request in self.pullers):
+            steal(controls)
+
+    def cancel(self, taskId):
+        for pendingTask in self.tasks:
+            if pendingTask.id == taskId:
+                self.tasks.remove(pendingTask)
+                return True
+        return False
+
+
+def setUpPulling(controls):
+    controls[CNT_PENDING_TASKS] = PendingTasks()
+    for worker in controls[CNT_WORKERS]:
+        worker.sendRequest(CMD_START_PULLING, {})
+
+
+def serve(controls):
+    #Give waiting tasks to workers that asked for them
+    pending = controls[CNT_PENDING_TASKS]
+    while pending.pullers and pending.tasks:
+        request = pending.pullers.popleft()
+        if request.abandoned():
+            continue
+        given = [pending.tasks.popleft() for i in range(min(request["COUNT"], len(pending.tasks)))]
+        for givenTask in given:
+            codecache.prepareTask(givenTask, request.requester)
+            controls[CNT_TASK_EXECUTORS][givenTask.id] = request.requester
+            controls[CNT_PLACEMENT].taskStarted(request.requester)
+        if request.respond(given):
+            for givenTask in given:
+                codecache.codeSent(givenTask, request.requester)
+        else:
+            #the worker will ask again once it's connected
+            for givenTask in given:
+                controls[CNT_TASK_EXECUTORS].pop(givenTask.id, None)
+                controls[CNT_PLACEMENT].taskFinished(request.requester)
+            pending.tasks.extendleft(reversed(given))
+    if pending.pullers and not pending.tasks:
+        steal(controls)
+
+
+def steal(controls):
+    #Ask the worker with most queued tasks to give half of them back, only for workers
+    #with idle slots, a worker that asks for tasks to prefetch doesn't take them from others
+    pending = controls[CNT_PENDING_TASKS]
+    placement = controls[CNT_PLACEMENT]
+    pulling = set(request.requester for request in pending.pullers)
+    idleSlots = sum(max(placement.slots.get(workerId, 1) - placement.outstanding.get(workerId, 0), 0)
+                    for workerId in pulling)
+    if not idleSlots:
+        return
+    victim = None
+    mostQueued = 0
+    for worker in controls[CNT_WORKERS]:
+        if not worker.alive or worker.id in pending.victims:
+            continue
+        queued = placement.outstanding.get(worker.id, 0) - placement.slots.get(worker.id, 1)
+        if queued > mostQueued:
+            victim = worker
+            mostQueued = queued
+    if victim:
+        pending.victims.add(victim.id)
+        victim.sendRequestWithResponse(CMD_STEAL_TASKS, {"COUNT": min((mostQueued + 1) // 2, idleSlots)},
+                                       partial(tasksStolen, victim.id))
+
+
+def tasksStolen(victimId, response, error):
+    #Called when the victim responds, the tasks are handled by the dispatcher
+    workgroup.sendRequest(CMD_RETURN_TASKS, {"WORKER": victimId, "TASKS": response or []})
+
+
+def queueTasksMaster(request, controls):
+    pending = controls[CNT_PENDING_TASKS]
+    pending.tasks.extend(request["TASKS"])
+    pending.victims.clear()
+    serve(controls)
+
+
+def pullTasksMaster(request, controls):
+    request.defer()
+    pending = controls[CNT_PENDING_TASKS]
+    controls[CNT_PLACEMENT].workerInfo(request.requester, request.getContents())
+    pending.pullers.append(request)
+    pending.victims.clear()
+    serve(controls)
+
+
+def returnTasksMaster(request, controls):
+    pending = controls[CNT_PENDING_TASKS]
+    returned = request["TASKS"]
+    for returnedTask in returned:
+        controls[CNT_TASK_EXECUTORS].pop(returnedTask.id, None)
+        controls[CNT_PLACEMENT].taskFinished(request["WORKER"])
+    pending.tasks.extendleft(reversed(returned))
+    if returned:
+        pending.victims.discard(request["WORKER"])
+    serve(controls)
+
+
+def startPullingWorker(request):
+    #One puller pulls from whichever master is connected
+    global puller
+    pullerLock.acquire()
+    masterConnected.set()
+    if puller is None or not puller.is_alive():
+        puller = Thread(target=pullerThread)
+        puller.daemon = True
+        puller.start()
+    pullerLock.release()
+
+
+def pullerThread():
+    #Ask the master for tasks whenever there is room for them
+    pool = getPool()
+    delay = PULL_RETRY_DELAY
+    while True:
+        count = pool.waitForFreeSlots(PREFETCH * pool.size)
+        try:
+            newTasks = sendRequestWithResponse(CMD_PULL_TASKS,
+                                               {
+                                                   "COUNT": count,
+                                                   "SLOTS": pool.size,
+                                                   "LOAD": currentLoad()
+                                               })
+        except RemoteError as error:
+            #the master that is connected now doesn't use pull scheduling
+            print("Stopped pulling tasks from the master", error)
+            return
+        except Exception as error:
+            print("Failed to pull tasks from the master, trying again in", delay, "seconds", error)
+            masterConnected.wait(delay)
+            masterConnected.clear()
+            delay = min(delay * 2, PULL_RETRY_MAX_DELAY)
+            continue
+        delay = PULL_RETRY_DELAY
+        try:
+            task.startTasks(newTasks, True)
+        except Exception as error:
+            print("Failed to start pulled tasks", error)
+            task.failTasks(newTasks, error)
+
+
+def stealTasksWorker(request):
+    stolen = getPool().steal(request["COUNT"])
+    for workerProcess in stolen:
+        task.tasks.pop(workerProcess.task.id, None)
+    request.respond([workerProcess.task for workerProcess in stolen])
+
+
+masterHandlers = {CMD_QUEUE_TASKS: queueTasksMaster, CMD_PULL_TASKS: pullTasksMaster,
+                  CMD_RETURN_TASKS: returnTasksMaster}
+
+workerHandlers = {CMD_START_PULLING: startPullingWorker, CMD_STEAL_TASKS: stealTasksWorker}
+
+
+def masterInit(newWorkgroup):
+    global workgroup
+    workgroup = newWorkgroup
+
+
+def workerInit():
+    pass
@@ -9,6 +9,10 @@ until another task puts something on the queue.
 The items are aranged in FIFO order, first item given to the :py:meth:`put <NWQueue.put>` method
 is the first item returned by the :py:meth:`get <NWQueue.get>` method.
 
+To pass the result of one task to the next, it's simpler to submit the next
+task with the :py:meth:`output <NetWork.task.TaskHandler.output>` of the first one,
+it doesn't hold a process while it waits, see :py:mod:`NetWork.task`.
+
 For more info about queues see `Python documentation page <http://docs.python.org/3.3/library/queue.html#module-queue>`_
 ::
     
@@ -37,18 +41,17 @@ For more info about queues see `Python documentation page <http://docs.python.or
         print(queue5.get())    #Prints '5'
 
 """
-from multiprocessing import Lock, Queue
+from multiprocessing import Lock
 
-from .request import sendRequest, sendRequestWithResponse
-from .cntcodes import CNT_WORKERS
+from .request import sendRequest, sendRequestWithResponse, getRunningTask
+from .task import taskKilledHandlers
+from .lock import forgetWaiters
 
-CMD_REGISTER_QUEUE = b"QUR"
 CMD_PUT_ON_QUEUE = b"QUP"
 CMD_GET_FROM_QUEUE = b"QUG"
 CMD_GET_QUEUE_SIZE = b"QSZ"
 CNT_QUEUE_COUNT = "QUEUE_COUNT"
 
-queues = None
 queueHandlers = None
 queueLocks = None
 runningOnMaster = None
@@ -56,8 +59,7 @@ masterAddress = None
 
 
 def masterInit(workgroup):
-    global queues, queueHandlers, queueLocks, runningOnMaster
-    queues = {-1: None}
+    global queueHandlers, queueLocks, runningOnMaster
     queueHandlers = {-1: None}
     queueLocks = {-1: None}
     runningOnMaster = True
@@ -65,8 +67,7 @@ def masterInit(workgroup):
 
 
 def workerInit():
-    global queues, runningOnMaster
-    queues = {-1: None}
+    global runningOnMaster
     runningOnMaster = False
 
 
@@ -74,6 +75,8 @@ class NWQueue:
     """
     The queue class used for inter-process communication.
     To put data on the queue call :py:meth:`put` and call :py:meth:`get` to get it.
+    The items are kept on the master, workers don't need to know about the queue
+    until a task uses it.
 
     :type workgroup: NetWork.workgroup.Workgroup
     :param workgroup: workgroup that will be using this Queue
@@ -83,14 +86,8 @@ class NWQueue:
         self.workgroup = workgroup
         self.workgroup.controls[CNT_QUEUE_COUNT] += 1
         self.id = self.workgroup.controls[CNT_QUEUE_COUNT]
-        if runningOnMaster:
-            queueHandlers[self.id] = MasterQueueHandler(self.id)
-            queueLocks[self.id] = Lock()
-        queues[self.id] = Queue()
-        sendRequest(CMD_REGISTER_QUEUE,
-                    {
-                        "ID": self.id
-                    })
+        queueLocks[self.id] = Lock()
+        queueHandlers[self.id] = MasterQueueHandler(self.id)
 
     def put(self, data):
         """
@@ -112,11 +109,11 @@ class NWQueue:
         
         :return: next item in the queue
         """
-        sendRequest(CMD_GET_FROM_QUEUE,
-                    {
-                        "ID": self.id
-                    })
-        return queues[self.id].get()
+        return sendRequestWithResponse(CMD_GET_FROM_QUEUE,
+                                       {
+                                           "ID": self.id,
+                                           "TASK": getRunningTask()
+                                       })
 
     def size(self):
         """
@@ -149,8 +146,8 @@ class NWQueue:
 
 class MasterQueueHandler:
     #A class used on the master to hold information about the queue
-    #It has two a list of workers waiting for an item and a list of items waiting
-    #to be sent
+    #It has two a list of get requests waiting for an item and a list of items waiting
+    #to be sent, the get requests are answered when an item is available
     def __init__(self, id):
         self.id = id
         self.items = []
@@ -164,16 +161,18 @@ class MasterQueueHandler:
         #get the first item from the items list
         return self.items.pop(0)
 
-    def putWaiter(self, id):
+    def putWaiter(self, request):
         #add a waiter to the waiter list
-        self.waiters.append(id)
+        self.waiters.append(request)
 
     def getWaiter(self):
         #get the first waiter from the waiters list
         return self.waiters.pop(0)
 
     def hasWaiters(self):
-        #check if queue has waiters
+        #check if queue has waiters, forget the ones that went away
+        while self.waiters and self.waiters[0].abandoned():
+            self.waiters.pop(0)
         return self.waiters
 
     def hasItems(self):
@@ -187,31 +186,28 @@ class MasterQueueHandler:
         #if there are both items and waiters, send items to the waiters
         #print("DISTRIBUTING", self.id, self.items, self.waiters)#used for debuging
         while self.hasItems() and self.hasWaiters():
-            waiter = self.getWaiter()
             item = self.getItem()
-            if waiter == -1:
-                queues[self.id].put(item)
-            else:
-                controlls[CNT_WORKERS][waiter].sendRequest(CMD_PUT_ON_QUEUE,
-                                                           {
-                                                               "ID": self.id,
-                                                               "DATA": item
-                                                           })
+            if not self.getWaiter().respond(item):
+                #the waiter went away, the item goes to the next one
+                self.items.insert(0, item)
 
 
-def registerQueueMaster(request, controlls):
-    #A handler used by Workgroup.dispatcher
-    id = request["ID"]
-    for worker in controlls[CNT_WORKERS]:
-        worker.sendRequest(CMD_REGISTER_QUEUE, {"ID": id})
+def releaseKilledTask(taskId):
+    #A killed task must not take items off the queue
+    if queueHandlers:
+        for id, handler in list(queueHandlers.items()):
+            if handler:
+                queueLocks[id].acquire()
+                forgetWaiters(handler.waiters, taskId)
+                queueLocks[id].release()
 
 
 def getFromQueueMaster(request, controlls):
     #A handler used by Workgroup.dispatcher
     id = request["ID"]
+    request.defer()
     queueLocks[id].acquire()
-    workerId = request.requester
-    queueHandlers[id].putWaiter(workerId)
+    queueHandlers[id].putWaiter(request)
     queueHandlers[id].distributeContents(controlls)
     queueLocks[id].release()
 
@@ -226,20 +222,12 @@ def putOnQueueMaster(request, controlls):
     queueLocks[id].release()
 
 
-def putOnQueueWorker(request):
-    id = request["ID"]
-    queues[id].put(request["DATA"])
-
-
-def registerQueueWorker(request):
-    queues[request["ID"]] = Queue()
-
-
 def queueSize(request, controls):
     id = request["ID"]
     request.respond(queueHandlers[id].size())
 
 
 masterHandlers = {CMD_GET_FROM_QUEUE: getFromQueueMaster, CMD_PUT_ON_QUEUE: putOnQueueMaster,
-                  CMD_REGISTER_QUEUE: registerQueueMaster, CMD_GET_QUEUE_SIZE: queueSize}
-workerHandlers = {CMD_REGISTER_QUEUE: registerQueueWorker, CMD_PUT_ON_QUEUE: putOnQueueWorker}
\ No newline at end of file
+                  CMD_GET_QUEUE_SIZE: queueSize}
+workerHandlers = {}
+taskKilledHandlers.append(releaseKilledTask)
\ No newline at end of file
@@ -1,20 +1,51 @@
 import pickle
-from NetWork import networking
+from functools import partial
+from threading import Event, Timer
+
+from .channel import ResponseTimeout
 
 runningOnMaster = False
 workgroup = None
+channel = None
+runningTask = None
+
+
+class LocalResponse:
+    #Carries the response to a request that the master sent to its own dispatcher
+    def __init__(self):
+        self.arrived = Event()
+        self.response = None
+        self.error = None
+
+    def put(self, response):
+        self.response = response
+        self.arrived.set()
+
+    def fail(self, error):
+        self.error = error
+        self.arrived.set()
+
+    def get(self):
+        self.arrived.wait()
+        if self.error:
+            raise self.error
+        return self.response
 
 
 class Request:
     #A class used to send commands to the Workgroup.dispatcher thread
     #Used internaly by workgroup, not by user
-    def __init__(self, type, contents, requester=-1, socket=None, commqueue=None, overNetwork=True):
+    def __init__(self, type, contents, requester=-1, channel=None, requestId=None, commqueue=None,
+                 overNetwork=True, responseExpected=True):
         self.contents = contents
         self.requester = requester
-        self.socket = socket
+        self.channel = channel
+        self.requestId = requestId
         self.type = type
         self.responseSent = False
+        self.deferred = False
         self.overNetwork = overNetwork
+        self.responseExpected = responseExpected
         self.commqueue = commqueue
 
     def getContents(self):
@@ -37,63 +68,189 @@ class Request:
         if self.requester == -1:
             s += " -1 (master)\n"
         else:
-            s += " worker #" + str(self.requester) + " (" + str(self.socket.address) + ")\n"
+            s += " worker #" + str(self.requester) + " (" + str(self.channel.address) + ")\n"
         s += "Request contents:\n"
         for item in self.contents:
             s += str(item) + " : " + str(self.contents[item]) + "\n"
         return s[:-1]   # Strip last newline character
 
     def close(self):
-        if self.socket:
-            if not self.responseSent:
-                self.respond(b"DEFAULT_RESPONSE")
-            self.socket.close()
+        if self.channel and self.responseExpected and not self.responseSent and not self.deferred:
+            self.respond(b"DEFAULT_RESPONSE")
 
-    def getResponse(self):
-        if self.overNetwork:
-            return pickle.loads(self.socket.recv())
+    def defer(self):
+        #The handler returns before the response is ready, it will be sent
+        #later from another thread, usually with completeResponse
+        self.deferred = True
+
+    def abandoned(self):
+        #True if the requester can't receive a response anymore
+        return self.overNetwork and (not self.channel or self.channel.closed)
+
+    def completeResponse(self, response, error=None):
+        #Used as a callback by Worker.sendRequestWithResponse
+        if error:
+            self.respondError(error)
+        else:
+            self.respond(response)
+
+    def completeRawResponse(self, payload, error=None):
+        #Same as completeResponse for responses that are still pickled
+        if error:
+            self.respondError(error)
         else:
-            return self.commqueue.get()
+            self.respondRaw(payload)
+
+    def getResponse(self):
+        return self.commqueue.get()
 
     def respond(self, response):
+        #Returns False if the response couldn't be sent
         if self.overNetwork:
             self.responseSent = True
+            if not self.channel:
+                print("Failed to send response, the connection to the requester is closed")
+                return False
             try:
-                self.socket.send(pickle.dumps(response))
+                self.channel.respond(self.requestId, response)
             except OSError as error:
-                print("Failed to send response to", self.socket.address, error)
+                print("Failed to send response to", self.channel.address, error)
+                return False
         else:
             self.commqueue.put(response)
+        return True
+
+    def respondRaw(self, payload):
+        #Respond with an already pickled response, it's unpickled only
+        #if the requester is on this side
+        if self.overNetwork:
+            self.responseSent = True
+            if not self.channel:
+                print("Failed to send response, the connection to the requester is closed")
+                return
+            try:
+                self.channel.respondRaw(self.requestId, payload)
+            except OSError as error:
+                print("Failed to send response to", self.channel.address, error)
+        else:
+            self.commqueue.put(pickle.loads(payload))
+
+    def respondError(self, error):
+        #Let the requester know that the request couldn't be handled
+        if self.overNetwork:
+            self.responseSent = True
+            if not self.channel:
+                return
+            try:
+                self.channel.respondError(self.requestId, str(error))
+            except OSError as sendError:
+                print("Failed to send response to", self.channel.address, sendError)
+        elif self.commqueue:
+            self.commqueue.fail(error)
 
 
-def setUp(workGroup=None):
+def setUp(workGroup=None, channel=None):
     global runningOnMaster, workgroup
     if workGroup:
         workgroup = workGroup
         runningOnMaster = True
     else:
         runningOnMaster = False
+        setChannel(channel)
+
+
+def setChannel(newChannel):
+    #Set the channel used to send requests to the master, on the worker server
+    #that's the channel to the master and in tasks it's the channel to the worker server
+    global channel
+    channel = newChannel
+
+
+def getRunningTask():
+    #ID of the task that this process is running, None outside of tasks,
+    #sent with requests that the master must forget if the task gets killed
+    return runningTask
 
 
 def sendRequest(requestType, contents):
     if runningOnMaster:
         workgroup.sendRequest(requestType, contents)
     else:
-        request = Request(requestType, contents)
-        masterSocket = networking.NWSocket()
-        masterSocket.connect(networking.masterAddress)
-        masterSocket.send(request.getType() + pickle.dumps(request.getContents()))
-        masterSocket.close()
+        channel.notify(requestType, contents)
 
 
-def sendRequestWithResponse(requestType, contents):
+def sendRequestWithResponse(requestType, contents, timeout=None):
+    #The timeout is used only when the request goes over the network
     if runningOnMaster:
         return workgroup.sendRequestWithResponse(requestType, contents)
     else:
-        request = Request(requestType, contents)
-        masterSocket = networking.NWSocket()
-        masterSocket.connect(networking.masterAddress)
-        masterSocket.send(request.getType() + pickle.dumps(request.getContents()))
-        receivedData = masterSocket.recv()
-        masterSocket.close()
-        return pickle.loads(receivedData)
\ No newline at end of file
+        return channel.request(requestType, contents, timeout)
+
+
+def sendRequestWithCallback(requestType, contents, callback):
+    #Used on the worker server, callback(response, error) is called from the channel
+    #reader when the master responds, the caller doesn't wait for the response
+    try:
+        channel.requestRaw(requestType, pickle.dumps(contents), partial(unpickleResponse, callback))
+    except OSError as error:
+        callback(None, error)
+
+
+def unpickleResponse(callback, payload, error):
+    if not error:
+        try:
+            payload = pickle.loads(payload)
+        except Exception as failure:
+            payload, error = None, failure
+    callback(payload, error)
+
+
+def forwardRaw(request, toChannel, requestType, payload, timeout):
+    #Used on the worker server, pass a request on to another channel and answer it with
+    #the response still pickled, or with an error if none arrives in timeout seconds,
+    #the handler returns at once so the requests after it don't wait for the other side
+    request.defer()
+    forwarded = {}
+    timer = Timer(timeout, forwardTimedOut, (request, toChannel, forwarded, timeout))
+    timer.daemon = True
+    forwarded["ID"] = toChannel.requestRaw(requestType, payload, partial(forwardedResponse, request, timer))[0]
+    timer.start()
+
+
+def forwardedResponse(request, timer, payload, error):
+    timer.cancel()
+    request.completeRawResponse(payload, error)
+
+
+def forwardTimedOut(request, toChannel, forwarded, timeout):
+    #A response that arrives after this is dropped
+    if toChannel.forget(forwarded["ID"]):
+        request.respondError(ResponseTimeout("No response arrived in " + str(timeout) + " seconds"))
+
+
+def relayRequest(taskChannel, responseExpected, requestId, type, payload):
+    #Used on the worker server to pass requests from tasks to the master, the payload
+    #is passed on as it is and all tasks share the channel to the master
+    try:
+        if responseExpected:
+            channel.requestRaw(type, payload,
+                               lambda response, error: relayResponse(taskChannel, requestId, response, error))
+        else:
+            channel.notifyRaw(type, payload)
+    except OSError as error:
+        if responseExpected:
+            relayResponse(taskChannel, requestId, None, error)
+
+
+def relayResponse(taskChannel, requestId, payload, error):
+    #Pass a response from the master back to the task that requested it,
+    #if the task got killed there's no one to pass it to
+    if taskChannel.closed:
+        return
+    try:
+        if error:
+            taskChannel.respondError(requestId, str(error))
+        else:
+            taskChannel.respondRaw(requestId, payload)
+    except OSError as error:
+        print("Failed to pass a response to a task", error)
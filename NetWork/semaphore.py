@@ -7,30 +7,29 @@ it calls :py:meth:`acquire <NWSemaphore.acquire>` method, if the counter
 value is greater than zero it gets decremented and the task goes on, if
 the value is zero the task is put to sleep until one of the tasks that 
 has acquired the semaphore calls :py:meth:`release <NWSemaphore.release>` 
-method.
+method. If a task gets terminated or its worker dies while it holds the
+semaphore, the semaphore is released for it.
 
 For more info about semaphores see `Python documentation page
 <http://docs.python.org/2/library/threading.html#semaphore-objects>`_
 """
-from multiprocessing import Semaphore, Lock
-from .request import sendRequest
-from .cntcodes import CNT_WORKERS
+from multiprocessing import Lock
+from .request import sendRequest, sendRequestWithResponse, getRunningTask
+from .task import taskKilledHandlers
+from .lock import forgetWaiters
 
-CMD_REGISTER_SEMAPHORE = b"SER"
 CMD_ACQUIRE_SEMAPHORE = b"SEA"
 CMD_RELEASE_SEMAPHORE = b"SEU"
 CNT_SEMAPHORE_COUNT = "SEMAPHORE_COUNT"
 
 runningOnMaster = None
-semaphores = None
 semaphoreHandlers = None
 semaphoreLocks = None
 masterAddress = None
 
 
 def masterInit(workgroup):
-    global semaphores, runningOnMaster, semaphoreLocks, semaphoreHandlers
-    semaphores = {-1: None}
+    global runningOnMaster, semaphoreLocks, semaphoreHandlers
     runningOnMaster = True
     semaphoreLocks = {-1: None}
     semaphoreHandlers = {-1: None}
@@ -38,8 +37,7 @@ def masterInit(workgroup):
 
 
 def workerInit():
-    global runningOnMaster, semaphores
-    semaphores = {-1: None}
+    global runningOnMaster
     runningOnMaster = False
 
 
@@ -59,17 +57,8 @@ class NWSemaphore:
         self.workgroup = workgroup
         self.workgroup.controls[CNT_SEMAPHORE_COUNT] += 1
         self.id = self.workgroup.controls[CNT_SEMAPHORE_COUNT]
-        if runningOnMaster:
-            semaphoreLocks[self.id] = Lock()
-            semaphoreHandlers[self.id] = MasterSemaphoreHandler(self.id, self.value)
-        semaphores[self.id] = Semaphore(self.value)
-        for i in range(self.value):
-            semaphores[self.id].acquire()
-        sendRequest(CMD_REGISTER_SEMAPHORE,
-                    {
-                        "ID": self.id,
-                        "VALUE": self.value
-                    })
+        semaphoreLocks[self.id] = Lock()
+        semaphoreHandlers[self.id] = MasterSemaphoreHandler(self.id, self.value)
 
     def acquire(self):
         """
@@ -77,11 +66,11 @@ class NWSemaphore:
         If the counter is zero sleep until some other task
         releases the semaphore
         """
-        sendRequest(CMD_ACQUIRE_SEMAPHORE,
-                    {
-                        "ID": self.id
-                    })
-        semaphores[self.id].acquire()
+        sendRequestWithResponse(CMD_ACQUIRE_SEMAPHORE,
+                                {
+                                    "ID": self.id,
+                                    "TASK": getRunningTask()
+                                })
 
     def release(self):
         """
@@ -90,7 +79,8 @@ class NWSemaphore:
         """
         sendRequest(CMD_RELEASE_SEMAPHORE,
                     {
-                        "ID": self.id
+                        "ID": self.id,
+                        "TASK": getRunningTask()
                     })
 
     def __setstate__(self, state):
@@ -103,79 +93,82 @@ class NWSemaphore:
 
 class MasterSemaphoreHandler:
     #A class used to hold information about semaphores on the master
-    #It has a waiters list that holds a list of workers waiting to acquire
-    #the semaphore, when the semaphore
-    #is released a message is send to the first waiter in the list
+    #It has a waiters list that holds acquire requests waiting for the semaphore,
+    #when the semaphore is released the first waiter in the list gets the response,
+    #holders has the ID of the task (None for the master) for every acquire that wasn't released
     def __init__(self, id, value):
         semaphoreLocks[id].acquire()
         self.id = id
         self.value = value
         self.waiters = []
+        self.holders = []
         semaphoreLocks[id].release()
 
-    def acquire(self, requester, controlls):
+    def acquire(self, request):
         #Acquire semaphore or wait for release
         semaphoreLocks[self.id].acquire()
         if not self.value:
-            self.waiters.append(requester)
+            self.waiters.append(request)
         else:
             self.value -= 1
-            if requester == -1:
-                semaphores[self.id].release()
-            else:
-                controlls[CNT_WORKERS][requester].sendRequest(CMD_RELEASE_SEMAPHORE,
-                                                              {
-                                                                  "ID": self.id
-                                                              })
+            self.holders.append(request["TASK"])
+            if not request.respond(True):
+                self.holders.remove(request["TASK"])
+                self.wakeNext()
         semaphoreLocks[self.id].release()
 
-    def release(self, controlls):
-        #Release semaphore and wake up the first from the waiting list
+    def release(self, taskId):
+        #Any task can release a semaphore, if the releaser doesn't hold it
+        #the oldest holder is the one that gets forgotten
         semaphoreLocks[self.id].acquire()
-        if self.waiters:
-            id = self.waiters.pop(0)
-            if id == -1:
-                semaphores[self.id].release()
-            else:
-                controlls[CNT_WORKERS][id].sendRequest(CMD_RELEASE_SEMAPHORE,
-                                                       {
-                                                           "ID": self.id
-                                                       })
-        else:
-            self.value += 1
+        if taskId in self.holders:
+            self.holders.remove(taskId)
+        elif self.holders:
+            self.holders.pop(0)
+        self.wakeNext()
         semaphoreLocks[self.id].release()
 
+    def wakeNext(self):
+        #Wake up the first from the waiting list that is still
+        #there to take it, a waiter that can't be told it got the
+        #semaphore doesn't get it, must hold the lock
+        while self.waiters:
+            waiter = self.waiters.pop(0)
+            if waiter.abandoned():
+                continue
+            self.holders.append(waiter["TASK"])
+            if waiter.respond(True):
+                return
+            self.holders.remove(waiter["TASK"])
+        self.value += 1
+
+    def taskKilled(self, taskId):
+        semaphoreLocks[self.id].acquire()
+        forgetWaiters(self.waiters, taskId)
+        while taskId in self.holders:
+            self.holders.remove(taskId)
+            self.wakeNext()
+        semaphoreLocks[self.id].release()
 
-def registerSemaphoreMaster(request, controlls):
-    #A handler used by Workgroup.dispatcher
-    id = request["ID"]
-    value = request["VALUE"]
-    for worker in controlls[CNT_WORKERS]:
-        worker.sendRequest(CMD_REGISTER_SEMAPHORE, {"ID": id, "VALUE": value})
+
+def releaseKilledTask(taskId):
+    if semaphoreHandlers:
+        for handler in list(semaphoreHandlers.values()):
+            if handler:
+                handler.taskKilled(taskId)
 
 
 def acquireSemaphoreMaster(request, controlls):
     #A handler used by Workgroup.dispatcher
-    semaphoreHandlers[request["ID"]].acquire(request.requester, controlls)
+    request.defer()
+    semaphoreHandlers[request["ID"]].acquire(request)
 
 
 def releaseSemaphoreMaster(request, controlls):
     #A handler used by Workgroup.dispatcher
-    semaphoreHandlers[request["ID"]].release(controlls)
-
-
-def registerSemaphoreWorker(request):
-    id = request["ID"]
-    value = request["VALUE"]
-    semaphores[id] = Semaphore(value)
-    for i in range(value):
-        semaphores[id].acquire()
-
-
-def releaseSemaphoreWorker(request):
-    semaphores[request["ID"]].release()
+    semaphoreHandlers[request["ID"]].release(request["TASK"])
 
 
-masterHandlers = {CMD_REGISTER_SEMAPHORE: registerSemaphoreMaster, CMD_ACQUIRE_SEMAPHORE: acquireSemaphoreMaster,
-                  CMD_RELEASE_SEMAPHORE: releaseSemaphoreMaster}
-workerHandlers = {CMD_RELEASE_SEMAPHORE: releaseSemaphoreWorker, CMD_REGISTER_SEMAPHORE: registerSemaphoreWorker}
\ No newline at end of file
+masterHandlers = {CMD_ACQUIRE_SEMAPHORE: acquireSemaphoreMaster, CMD_RELEASE_SEMAPHORE: releaseSemaphoreMaster}
+workerHandlers = {}
+taskKilledHandlers.append(releaseKilledTask)
\ No newline at end of file
@@ -4,12 +4,42 @@ When a task is submited to the workgroup, you get a :py:class:`TaskHandler` obje
 that can be used to control the running task and receive information about
 its state.
 
+When a task finishes the worker tells the master, the master keeps the state of
+finished tasks so on the master :py:meth:`TaskHandler.result` and the other methods
+don't need to ask the worker, and :py:meth:`TaskHandler.wait` can be used to wait
+for a task without polling.
+
+Tasks can depend on other tasks. A task submitted with ``after`` handlers or with
+:py:meth:`outputs <TaskHandler.output>` of other tasks in its arguments waits on the
+master until those tasks finish, it doesn't take a process on a worker while it waits.
+Outputs are replaced by the results of their tasks when the task starts, small results
+are sent with the task and big ones are fetched directly from the worker that made them.
+If one of the tasks it depends on raises an exception or gets terminated the task
+doesn't run, it fails with :py:class:`DependencyError`.
+
+::
+
+    with Workgroup(addresses) as w:
+        data = w.submit(load, ("/data/input",))
+        parts = [w.submit(parse, (data.output(), part)) for part in range(8)]
+        total = w.submit(combine, [part.output() for part in parts])
+        cleanup = w.submit(removeTemporaryFiles, after=[total])
+        total.wait()
+        print(total.result())
+
 """
-import marshal
-from types import FunctionType
-from .request import sendRequest, sendRequestWithResponse
+import pickle
+import time
+import weakref
+from functools import partial
+from threading import Event, Lock, RLock
+from .request import sendRequest, sendRequestWithResponse, sendRequestWithCallback
 from .cntcodes import *
-from .workerprocess import WorkerProcess
+from .channel import ResponseTimeout
+from .worker import DeadWorkerError
+from .workerprocess import WorkerProcess, TaskProcessDied, PICKLED_NONE
+from .placement import currentLoad
+import NetWork.codecache as codecache
 
 CMD_SUBMIT_TASK = b"TSK"
 CMD_TERMINATE_TASK = b"TRM"
@@ -17,30 +47,298 @@ CMD_GET_RESULT = b"RSL"
 CMD_TASK_RUNNING = b"TRN"
 CMD_GET_EXCEPTION = b"EXC"
 CMD_CHECK_EXCEPTION = b"EXR"
+CMD_TASK_FINISHED = b"TFN"
+CMD_WAIT_TASK = b"TWT"
+CMD_BYTES_MOVED = b"TBM"
+CMD_RELEASE_TASK = b"TRL"
+
+#Bigger results are not sent with the notification that a task
+#finished, they stay on the worker until someone asks for them
+PUSHED_RESULT_SIZE = 64 * 1024
 
+runningOnMaster = None
 tasks = {-1: None}
+taskStates = None
+workgroup = None
+#called on the master with the ID of a task that was terminated or died, tools that
+#remember which task holds or waits for something add a function here (see NetWork.lock)
+taskKilledHandlers = []
+#on the worker, reports of finished tasks that were lost with the connection to
+#the master, they are sent again when the master connects again
+unreported = {}
+unreportedLock = Lock()
+
+
+class DependencyError(Exception):
+    """
+    Raised by a task that didn't run because a task that it depends on raised an exception
+    or got terminated
+    """
+    pass
 
 
 class Task:
     #A class used to hold a task given to the workgroup
+    #The target is sent as the hash of its code and the marshalled code, the code is left
+    #out when shipCode is False because the receiver already has it (see codecache.py),
+    #on the receiving side the function is made from the code when it's first used
 
     def __init__(self, target=None, args=(), kwargs={}, id=None):
-        self.target = target
+        self.function = target
         self.args = args
         self.kwargs = kwargs
         self.id = id
+        self.codeHash = None
+        self.code = None
+        self.shipCode = True
+
+    @property
+    def target(self):
+        if self.function is None and self.code is not None:
+            self.function = codecache.getFunction(self.codeHash, self.code, globals())
+        return self.function
+
+    def codeInfo(self):
+        if self.codeHash is None:
+            self.codeHash, self.code = codecache.codeOf(self.function)
+        return self.codeHash, self.code
+
+    def arguments(self):
+        #Arguments with the outputs of other tasks replaced by their results
+        args = [arg.value() if isinstance(arg, TaskOutput) else arg for arg in self.args]
+        kwargs = {name: value.value() if isinstance(value, TaskOutput) else value
+                  for name, value in self.kwargs.items()}
+        return args, kwargs
+
+    def sameTarget(self, args=(), kwargs={}, id=None):
+        #A new task with the target of this one
+        newTask = Task(self.function, args, kwargs, id)
+        newTask.codeHash, newTask.code = self.codeHash, self.code
+        return newTask
 
     def __getstate__(self):
+        codeHash, code = self.codeInfo()
         state = {"args": self.args, "kwargs": self.kwargs, "id": self.id,
-                 "target": marshal.dumps(self.target.__code__)}
+                 "codeHash": codeHash, "code": code if self.shipCode else None}
         return state
 
     def __setstate__(self, state):
         self.args = state["args"]
         self.kwargs = state["kwargs"]
-        self.target = FunctionType(code=marshal.loads(state["target"]),
-                                   globals=globals())
         self.id = state["id"]
+        self.function = None
+        self.shipCode = True
+        self.codeHash = state["codeHash"]
+        if state["code"] is None:
+            self.code = codecache.lookupCode(self.codeHash)
+        else:
+            self.code = state["code"]
+            codecache.storeCode(self.codeHash, self.code)
+
+
+class TaskState:
+    #Kept on the master for every task, filled in when the worker reports that
+    #the task finished, pickledResult is None if the result stayed on the worker,
+    #inputLocation says where the task's inputs from the object store are
+    #users counts TaskHandlers and waiting tasks on the master that need the state,
+    #a finished state that was used and isn't anymore is removed from taskStates,
+    #unless a TaskHandler was pickled (shared) and a worker may still ask about the task,
+    #when the state is removed the worker that ran the task drops it too, unless
+    #a reference to the result was made (referenced), the reference keeps the result
+    def __init__(self, id):
+        self.id = id
+        self.finished = Event()
+        self.terminated = False
+        self.exceptionRaised = False
+        self.exception = None
+        self.pickledResult = None
+        self.resultSize = None
+        self.inputLocation = {}
+        self.bytesMoved = None
+        self.waiters = []
+        self.callbacks = []
+        self.users = 0
+        self.used = False
+        self.shared = False
+        self.referenced = False
+        #handlers can be collected while the lock is held
+        self.lock = RLock()
+
+    def finish(self, pickledResult, exceptionRaised, exception, terminated=False):
+        self.lock.acquire()
+        if self.finished.is_set():
+            self.lock.release()
+            return
+        self.terminated = terminated
+        self.pickledResult = pickledResult
+        self.exceptionRaised = exceptionRaised
+        self.exception = exception
+        self.finished.set()
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+        for waiter in self.waiters:
+            if not waiter.abandoned():
+                waiter.respond(True)
+        self.waiters = []
+        for callback in callbacks:
+            callback()
+        self.evictIfUnused()
+
+    def use(self):
+        self.lock.acquire()
+        self.users += 1
+        self.used = True
+        self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        self.users -= 1
+        self.lock.release()
+        self.evictIfUnused()
+
+    def evictIfUnused(self):
+        self.lock.acquire()
+        unused = self.used and not self.users and not self.shared and self.finished.is_set()
+        self.lock.release()
+        if unused:
+            forgetTaskState(self)
+
+    def countMovedBytes(self, workerId, bytesMoved):
+        #The inputs that weren't on the worker that ran the task had to be fetched
+        local = self.inputLocation.get(workerId, 0)
+        self.bytesMoved = sum(self.inputLocation.values()) - local
+        bytesMoved["MOVED"] += self.bytesMoved
+        bytesMoved["LOCAL"] += local
+
+    def addCallback(self, callback):
+        #callback() is called once the task finishes, usually from the dispatcher
+        #thread so it must not wait for anything, right away if it already has
+        self.lock.acquire()
+        if not self.finished.is_set():
+            self.callbacks.append(callback)
+            self.lock.release()
+            return
+        self.lock.release()
+        callback()
+
+
+class TaskOutput:
+    """
+    Stands for the result of a task in the arguments of tasks that depend on it,
+    see :py:meth:`TaskHandler.output`. Outputs must be given directly as positional
+    or keyword arguments to :py:meth:`Workgroup.submit <NetWork.workgroup.Workgroup.submit>`.
+    """
+
+    def __init__(self, id):
+        self.id = id
+        #filled in on the master when the task finishes
+        self.pickledResult = None
+        self.ref = None
+
+    def bind(self, controls):
+        #The result is sent with the dependent task when the master has it,
+        #otherwise the dependent task fetches it from the worker that ran the task
+        import NetWork.objectstore
+        state = getTaskState(self.id)
+        if state.pickledResult is not None:
+            self.pickledResult = state.pickledResult
+        else:
+            self.ref = NetWork.objectstore.taskResultRef(self.id, controls)
+
+    def value(self):
+        if self.pickledResult is not None:
+            return pickle.loads(self.pickledResult)
+        if self.ref is None:
+            raise DependencyError("The output of task " + str(self.id) +
+                                  " was not given directly in the arguments of Workgroup.submit")
+        return self.ref.get()
+
+
+class WaitingTask:
+    #A task whose dependencies haven't all finished, it's kept on the master and
+    #submitted by the callback of the last dependency to finish, usually in the dispatcher
+    def __init__(self, workgroup, id, target, args, kwargs, affinity, dependencies):
+        self.workgroup = workgroup
+        self.id = id
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.affinity = affinity
+        self.dependencies = dependencies
+        self.started = False
+        self.lock = Lock()
+
+    def start(self):
+        #the states of the dependencies are kept until the task is submitted
+        self.workgroup.controls[CNT_WAITING_TASKS][self.id] = self
+        self.states = {dependency: getTaskState(dependency) for dependency in self.dependencies}
+        for state in self.states.values():
+            state.use()
+        for state in list(self.states.values()):
+            state.addCallback(self.dependencyFinished)
+
+    def dependencyFinished(self):
+        self.lock.acquire()
+        if self.started or not all(state.finished.is_set() for state in self.states.values()):
+            self.lock.release()
+            return
+        self.started = True
+        self.lock.release()
+        try:
+            self.submit()
+        finally:
+            for state in self.states.values():
+                state.release()
+
+    def submit(self):
+        controls = self.workgroup.controls
+        #a terminated task was already taken out
+        if controls[CNT_WAITING_TASKS].pop(self.id, None) is None:
+            return
+        for dependency in sorted(self.dependencies):
+            state = self.states[dependency]
+            if state.exceptionRaised or state.terminated:
+                getTaskState(self.id).finish(PICKLED_NONE, True,
+                                             DependencyError("Task " + str(dependency) + " that this task depends on " +
+                                                             ("got terminated" if state.terminated else "failed")))
+                return
+        try:
+            for output in findOutputs(self.args, self.kwargs):
+                output.bind(controls)
+            self.workgroup.startTask(self.target, self.args, self.kwargs, self.affinity, self.id)
+        except Exception as error:
+            getTaskState(self.id).finish(PICKLED_NONE, True, error)
+
+
+def findOutputs(args, kwargs):
+    return [arg for arg in list(args) + list(kwargs.values()) if isinstance(arg, TaskOutput)]
+
+
+def runChunk(function, items):
+    #The target of tasks that run a function over a chunk of items (see NetWork.mapping),
+    #the function is given as a Task so its code is sent the same way as a task's target
+    start = time.perf_counter()
+    results = [function.target(item) for item in items]
+    return results, time.perf_counter() - start
+
+
+def getTaskState(id):
+    state = taskStates.get(id)
+    if state is None:
+        state = taskStates.setdefault(id, TaskState(id))
+    return state
+
+
+def forgetTaskState(state):
+    #Nothing on the master can ask about the task anymore
+    if taskStates.get(state.id) is state:
+        taskStates.pop(state.id, None)
+        workerId = workgroup.controls[CNT_TASK_EXECUTORS].pop(state.id, None)
+        if workerId is not None and not state.referenced:
+            worker = workgroup.controls[CNT_WORKERS][workerId]
+            if worker.alive:
+                worker.sendRequest(CMD_RELEASE_TASK, {"ID": state.id})
 
 
 class TaskHandler:
@@ -52,6 +350,16 @@ class TaskHandler:
 
     def __init__(self, id):
         self.id = id
+        if runningOnMaster:
+            state = getTaskState(id)
+            state.use()
+            weakref.finalize(self, state.release).atexit = False
+
+    def __reduce__(self):
+        #a handler that leaves the master can ask about the task at any time
+        if runningOnMaster:
+            getTaskState(self.id).shared = True
+        return TaskHandler, (self.id,)
 
     def result(self):
         """
@@ -62,6 +370,12 @@ class TaskHandler:
         :return: return value of the function in the task, ``None`` if the task
           hasn't returned.
         """
+        if runningOnMaster:
+            state = getTaskState(self.id)
+            if not state.finished.is_set():
+                return None
+            if state.pickledResult is not None:
+                return pickle.loads(state.pickledResult)
         return sendRequestWithResponse(CMD_GET_RESULT,
                                        {
                                            "ID": self.id,
@@ -83,6 +397,8 @@ class TaskHandler:
         :rtype: bool
         :return: ``True`` or ``False`` depending on whether the task is running.
         """
+        if runningOnMaster:
+            return not getTaskState(self.id).finished.is_set()
         return sendRequestWithResponse(CMD_TASK_RUNNING,
                                        {
                                            "ID": self.id,
@@ -96,6 +412,8 @@ class TaskHandler:
         :return: exception that the task has raised, ``None`` if there was
           no exception.
         """
+        if runningOnMaster:
+            return getTaskState(self.id).exception
         return sendRequestWithResponse(CMD_GET_EXCEPTION,
                                        {
                                            "ID": self.id,
@@ -109,30 +427,110 @@ class TaskHandler:
         :return: ``True`` or ``False`` depending on whether the task has raised an
           exception.
         """
+        if runningOnMaster:
+            return getTaskState(self.id).exceptionRaised
         return sendRequestWithResponse(CMD_CHECK_EXCEPTION,
                                        {
                                            "ID": self.id,
                                        })
 
+    def output(self):
+        """
+        Get a placeholder for the result of this task. Give it in the arguments of another
+        task and that task will be submitted when this one finishes, it will get the result
+        in place of the placeholder.
+
+        :rtype: :py:class:`TaskOutput`
+        :return: placeholder for the result
+        """
+        return TaskOutput(self.id)
+
+    def bytesMoved(self):
+        """
+        Get the number of bytes of the task's inputs from the object store
+        (see :py:mod:`NetWork.objectstore`) that weren't on the worker that ran
+        the task and had to be fetched from other computers.
+
+        :rtype: int or None
+        :return: number of bytes, ``None`` if the task hasn't finished
+        """
+        if runningOnMaster:
+            return getTaskState(self.id).bytesMoved
+        return sendRequestWithResponse(CMD_BYTES_MOVED,
+                                       {
+                                           "ID": self.id,
+                                       })
+
+    def ref(self):
+        """
+        Wait for the task to finish and get a reference to its result, the result stays on
+        the worker that ran the task and tasks that get the reference fetch it from there,
+        see :py:mod:`NetWork.objectstore`. Raises the exception if the task raised one.
+
+        :rtype: :py:class:`ObjectRef <NetWork.objectstore.ObjectRef>`
+        :return: reference to the result
+        """
+        #imported here because the object store reads results of tasks from this module
+        import NetWork.objectstore
+        self.wait()
+        if self.exceptionRaised():
+            raise self.exception()
+        return NetWork.objectstore.resultRef(self.id)
+
+    def wait(self, timeout=None):
+        """
+        Wait until the task finishes, returns, raises an exception or gets terminated.
+
+        :type timeout: float
+        :param timeout: maximum number of seconds to wait, wait forever if ``None``
+        :rtype: bool
+        :return: ``True`` if the task has finished, ``False`` if the timeout expired first.
+        """
+        if runningOnMaster:
+            return getTaskState(self.id).finished.wait(timeout)
+        try:
+            return sendRequestWithResponse(CMD_WAIT_TASK,
+                                           {
+                                               "ID": self.id
+                                           },
+                                           timeout)
+        except ResponseTimeout:
+            return False
+
 
 def submitTaskMaster(request, controls):
+    #A single task or batches of tasks with the same target, the
+    #target is sent once for every batch and the batch in one message
+    if "BATCHES" in request.getContents():
+        for workerId, batch in request["BATCHES"].items():
+            target = codecache.prepareTask(request["TARGET"].sameTarget(), workerId)
+            controls[CNT_WORKERS][workerId].sendRequest(CMD_SUBMIT_TASK,
+                                                        {
+                                                            "TARGET": target,
+                                                            "TASKS": batch
+                                                        },
+                                                        partial(codecache.codeSent, target, workerId))
+        return
     workerId = request["WORKER"]
-    task = request["TASK"]
-    controls[CNT_WORKERS][workerId].sendRequest(CMD_SUBMIT_TASK, {"TASK": task})
+    task = codecache.prepareTask(request["TASK"], workerId)
+    controls[CNT_WORKERS][workerId].sendRequest(CMD_SUBMIT_TASK, {"TASK": task},
+                                                partial(codecache.codeSent, task, workerId))
 
 
 def taskRunningMaster(request, controls):
-    taskId = request["ID"]
-    workerId = controls[CNT_TASK_EXECUTORS][taskId]
-    request.respond(controls[CNT_WORKERS][workerId].sendRequestWithResponse(CMD_TASK_RUNNING,
-                                                                            {
-                                                                                "ID": taskId
-                                                                            }))
+    request.respond(not getTaskState(request["ID"]).finished.is_set())
 
 
 def terminateTaskMaster(request, controls):
     taskId = request["ID"]
-    workerId = controls[CNT_TASK_EXECUTORS][taskId]
+    workerId = controls[CNT_TASK_EXECUTORS].get(taskId)
+    if workerId is None:
+        #with pull scheduling or dependencies the task may still be waiting on the master
+        if CNT_PENDING_TASKS in controls and controls[CNT_PENDING_TASKS].cancel(taskId):
+            getTaskState(taskId).finish(PICKLED_NONE, False, None, True)
+        elif controls[CNT_WAITING_TASKS].pop(taskId, None) is not None:
+            getTaskState(taskId).finish(PICKLED_NONE, False, None, True)
+        return
     controls[CNT_WORKERS][workerId].sendRequest(CMD_TERMINATE_TASK,
                                                 {
                                                     "ID": taskId
@@ -140,43 +538,189 @@ def terminateTaskMaster(request, controls):
 
 
 def getExceptionMaster(request, controls):
-    taskId = request["ID"]
-    workerId = controls[CNT_TASK_EXECUTORS][taskId]
-    request.respond(controls[CNT_WORKERS][workerId].sendRequestWithResponse(CMD_GET_EXCEPTION,
-                                                                            {
-                                                                                "ID": taskId
-                                                                            }))
+    request.respond(getTaskState(request["ID"]).exception)
 
 
 def checkExceptionMaster(request, controls):
-    taskId = request["ID"]
-    workerId = controls[CNT_TASK_EXECUTORS][taskId]
-    request.respond(controls[CNT_WORKERS][workerId].sendRequestWithResponse(CMD_CHECK_EXCEPTION,
-                                                                            {
-                                                                                "ID": taskId
-                                                                            }))
+    request.respond(getTaskState(request["ID"]).exceptionRaised)
 
 
 def getResultMaster(request, controls):
     taskId = request["ID"]
+    state = getTaskState(taskId)
+    if not state.finished.is_set():
+        request.respond(None)
+        return
+    if state.pickledResult is not None:
+        request.respondRaw(state.pickledResult)
+        return
     workerId = controls[CNT_TASK_EXECUTORS][taskId]
-    request.respond(controls[CNT_WORKERS][workerId].sendRequestWithResponse(CMD_GET_RESULT,
-                                                                            {
-                                                                                "ID": taskId
-                                                                            }))
+    request.defer()
+    #the result stays pickled until it reaches the requester
+    controls[CNT_WORKERS][workerId].sendRequestWithResponse(CMD_GET_RESULT,
+                                                            {
+                                                                "ID": taskId
+                                                            },
+                                                            request.completeRawResponse,
+                                                            rawResponse=True)
+
+
+def taskFinishedMaster(request, controls):
+    #A report is sent again if its confirmation was lost with the connection
+    if request["RESENT"] and (not request["ID"] in taskStates or taskStates[request["ID"]].finished.is_set()):
+        return
+    controls[CNT_PLACEMENT].taskFinished(request.requester, request["LOAD"])
+    state = getTaskState(request["ID"])
+    if not state.finished.is_set():
+        state.resultSize = request["RESULT_SIZE"]
+        state.countMovedBytes(request.requester, controls[CNT_BYTES_MOVED])
+    state.finish(request["RESULT"], request["EXCEPTION_RAISED"], request["EXCEPTION"], request["TERMINATED"])
+    if request["TERMINATED"] or isinstance(request["EXCEPTION"], TaskProcessDied):
+        taskKilled(request["ID"])
+    if CNT_PENDING_TASKS in controls:
+        controls[CNT_PENDING_TASKS].taskFinished(request.requester, controls)
+
+
+def bytesMovedMaster(request, controls):
+    request.respond(getTaskState(request["ID"]).bytesMoved)
+
+
+def waitTaskMaster(request, controls):
+    state = getTaskState(request["ID"])
+    if state.finished.is_set():
+        request.respond(True)
+    else:
+        request.defer()
+        state.waiters.append(request)
+
+
+def failTasksOfWorker(workerId, controls):
+    #Called when a worker dies, its unfinished tasks will never report back
+    for taskId, executor in list(controls[CNT_TASK_EXECUTORS].items()):
+        if executor == workerId and not getTaskState(taskId).finished.is_set():
+            getTaskState(taskId).finish(None, True,
+                                        DeadWorkerError(workerId, "Worker " + str(workerId) +
+                                                        " died while running the task"))
+            taskKilled(taskId)
+
+
+def taskKilled(taskId):
+    #Release what the task held and forget what it waited for
+    for handler in taskKilledHandlers:
+        try:
+            handler(taskId)
+        except Exception as error:
+            print("Failed to release what task", taskId, "held", repr(error))
+
+
+def reportFinishedTask(workerProcess):
+    #Called on the worker when a task finishes or gets terminated
+    pickledResult = workerProcess.getPickledResult()
+    resultSize = len(pickledResult)
+    if resultSize > PUSHED_RESULT_SIZE:
+        pickledResult = None
+    else:
+        pickledResult = bytes(pickledResult)
+    report = {
+        "ID": workerProcess.task.id,
+        "RESULT": pickledResult,
+        "RESULT_SIZE": resultSize,
+        "EXCEPTION_RAISED": workerProcess.exceptionRaised(),
+        "EXCEPTION": workerProcess.getException(),
+        "TERMINATED": workerProcess.terminated,
+        "LOAD": currentLoad(),
+        "RESENT": False
+    }
+    sendRequestWithCallback(CMD_TASK_FINISHED, report, partial(reportConfirmed, report))
+
+
+def reportConfirmed(report, response, error):
+    #A report that wasn't confirmed may not have reached the master, the old channel
+    #is closed before the reports are sent again so this runs before that
+    if isinstance(error, OSError):
+        print("Failed to tell the master that task", report["ID"], "finished", error)
+        unreportedLock.acquire()
+        unreported[report["ID"]] = report
+        unreportedLock.release()
+    elif error:
+        print("The master failed to handle the end of task", report["ID"], error)
+
+
+def resendFinishedReports():
+    #Called on the worker when the master connects again
+    unreportedLock.acquire()
+    reports = list(unreported.values())
+    unreported.clear()
+    unreportedLock.release()
+    for report in reports:
+        report["RESENT"] = True
+    for report in reports:
+        sendRequestWithCallback(CMD_TASK_FINISHED, report, partial(reportConfirmed, report))
+
+
+def startTasks(newTasks, queued=False):
+    #Queued tasks wait for idle pool processes, the others start right away, tasks whose
+    #code isn't on this worker start when the code arrives from the master, so the request
+    #that started them doesn't wait for it
+    newProcesses = []
+    missingCode = {}
+    for newTask in newTasks:
+        newProcess = WorkerProcess(newTask, reportFinishedTask)
+        tasks[newTask.id] = newProcess
+        if newTask.code is None:
+            newTask.code = codecache.lookupCode(newTask.codeHash)
+        if newTask.code is None:
+            missingCode.setdefault(newTask.codeHash, []).append(newProcess)
+        else:
+            newProcesses.append(newProcess)
+    runTasks(newProcesses, queued)
+    for codeHash, waiting in missingCode.items():
+        codecache.fetchCode(codeHash, partial(codeArrived, waiting, queued))
+
+
+def failTasks(newTasks, error):
+    #Report tasks that couldn't be started as failed, the ones that started are left alone
+    for newTask in newTasks:
+        workerProcess = tasks.get(newTask.id)
+        if workerProcess is None:
+            workerProcess = WorkerProcess(newTask, reportFinishedTask)
+            tasks[newTask.id] = workerProcess
+        if not workerProcess.running() and workerProcess.claim():
+            workerProcess.finish(PICKLED_NONE, True, error)
+
+
+def codeArrived(waiting, queued, codeBytes, error):
+    #A task whose code can't be fetched is reported as failed with the reason,
+    #tasks terminated while they waited for the code are already finished
+    if error:
+        for newProcess in waiting:
+            if newProcess.claim():
+                newProcess.finish(PICKLED_NONE, True, error)
+        return
+    for newProcess in waiting:
+        newProcess.task.code = codeBytes
+    runTasks(waiting, queued)
+
+
+def runTasks(newProcesses, queued):
+    if queued:
+        WorkerProcess.startQueued(newProcesses)
+    else:
+        for newProcess in newProcesses:
+            newProcess.start()
 
 
 def executeTaskWorker(request):
-    newTask = request["TASK"]
-    newProcess = WorkerProcess(newTask)
-    tasks[newTask.id] = newProcess
-    tasks[newTask.id].start()
+    if "TASKS" in request.getContents():
+        target = request["TARGET"]
+        startTasks([target.sameTarget(args, kwargs, id) for id, args, kwargs in request["TASKS"]], True)
+    else:
+        startTasks([request["TASK"]])
 
 
 def getResultWorker(request):
     id = request["ID"]
-    result = tasks[id].getResult()
-    request.respond(result)
+    request.respondRaw(tasks[id].getPickledResult())
 
 
 def exceptionRaisedWorker(request):
@@ -196,6 +740,11 @@ def taskRunningWorker(request):
     request.respond(status)
 
 
+def releaseTaskWorker(request):
+    #The master forgot the task, nobody can ask about it anymore
+    tasks.pop(request["ID"], None)
+
+
 def getExceptionWorker(request):
     id = request["ID"]
     exception = tasks[id].getException()
@@ -204,16 +753,23 @@ def getExceptionWorker(request):
 
 masterHandlers = {CMD_SUBMIT_TASK: submitTaskMaster, CMD_GET_RESULT: getResultMaster,
                   CMD_CHECK_EXCEPTION: checkExceptionMaster, CMD_TERMINATE_TASK: terminateTaskMaster,
-                  CMD_TASK_RUNNING: taskRunningMaster, CMD_GET_EXCEPTION: getExceptionMaster}
+                  CMD_TASK_RUNNING: taskRunningMaster, CMD_GET_EXCEPTION: getExceptionMaster,
+                  CMD_TASK_FINISHED: taskFinishedMaster, CMD_WAIT_TASK: waitTaskMaster,
+                  CMD_BYTES_MOVED: bytesMovedMaster}
 
 workerHandlers = {CMD_SUBMIT_TASK: executeTaskWorker, CMD_GET_RESULT: getResultWorker,
                   CMD_CHECK_EXCEPTION: exceptionRaisedWorker, CMD_TERMINATE_TASK: terminateTaskWorker,
-                  CMD_TASK_RUNNING: taskRunningWorker, CMD_GET_EXCEPTION: getExceptionWorker, }
+                  CMD_TASK_RUNNING: taskRunningWorker, CMD_GET_EXCEPTION: getExceptionWorker,
+                  CMD_RELEASE_TASK: releaseTaskWorker}
 
 
-def masterInit(workgroup):
-    pass
+def masterInit(newWorkgroup):
+    global runningOnMaster, taskStates, workgroup
+    runningOnMaster = True
+    taskStates = {}
+    workgroup = newWorkgroup
 
 
 def workerInit():
-    pass
\ No newline at end of file
+    global runningOnMaster
+    runningOnMaster = False
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""
+A transport decides how the master reads incoming frames from the channels
+to its workers (see NetWork.channel), sending is always done by the thread
+that sends the frame.
+
+Available transports:
+
+  * ``"threads"`` every channel has its own reader thread blocked in recv
+  * ``"asyncio"`` a single asyncio event loop (a selector) watches all channels and
+    reads from the ones that have data, messages are put together from whatever
+    arrived so a slow or idle worker never holds a thread
+
+Both transports pass received frames to Channel.frameReceived, so requests from
+workers end up in the same commqueue and are handled by the same handlerList.
+"""
+import asyncio
+from threading import Thread, Event, current_thread
+
+from .networking import MessageAssembler, ConnectionClosed
+
+
+class ThreadTransport:
+    #The default, every channel reads in its own thread
+    def attach(self, channel):
+        channel.start()
+
+    def detach(self, channel):
+        pass
+
+    def stop(self):
+        pass
+
+
+class AsyncioTransport:
+    #One event loop running in its own thread reads from all channels
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self, channel):
+        #Bytes that were received but not used before the channel was attached
+        #(ASCII framing reads ahead) are the start of the first message
+        assembler = MessageAssembler(channel.socket, channel.socket.receiveBuffer)
+        channel.socket.receiveBuffer = b""
+        channel.transport = self
+        self.loop.call_soon_threadsafe(self.loop.add_reader, channel.socket.fileno(),
+                                       self.dataReady, channel, assembler)
+
+    def dataReady(self, channel, assembler):
+        #Called by the event loop when the socket of a channel is readable
+        try:
+            data = channel.socket.recvAvailable()
+            if not data:
+                raise ConnectionClosed("Socket got closed")
+            messages = assembler.feed(data)
+            for message in messages:
+                if channel.closed:
+                    #a frame that broke the protocol closed it
+                    break
+                channel.frameReceived(channel.socket.decode(message))
+        except OSError as error:
+            channel.close(error)
+
+    def detach(self, channel):
+        #Stop watching a channel, must be done before its socket is closed
+        #because the operating system can give the same descriptor to a new socket
+        fileno = channel.socket.fileno()
+        if fileno == -1:
+            return
+        if current_thread() is self.thread:
+            self.loop.remove_reader(fileno)
+            return
+        if not self.loop.is_running():
+            return
+        removed = Event()
+
+        def removeReader():
+            self.loop.remove_reader(fileno)
+            removed.set()
+        try:
+            self.loop.call_soon_threadsafe(removeReader)
+        except RuntimeError:
+            #the loop got closed
+            return
+        removed.wait()
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
+
+
+transports = {"threads": ThreadTransport, "asyncio": AsyncioTransport}
+
+
+def getTransport(name):
+    if not name in transports:
+        raise ValueError("Unknown transport " + str(name))
+    return transports[name]()
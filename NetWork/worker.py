@@ -3,8 +3,18 @@ This file implements a worker class that is used to represent
 one worker computer and send messages to that computer.
 """
 import pickle
+import time
+from threading import Lock, Thread
+from queue import Queue
+from functools import partial
 
 import NetWork.networking
+from .channel import Channel, ChannelClosed, ResponseTimeout
+
+#seconds without anything from a worker before it's pinged
+HEARTBEAT_INTERVAL = 5.0
+#seconds without anything from a worker before its connection is considered broken
+HEARTBEAT_TIMEOUT = 20.0
 
 
 class WorkerUnavailableError(Exception): pass
@@ -18,43 +28,189 @@ class DeadWorkerError(Exception):
 
 class Worker:
 #A class used to handle one worker
-    def __init__(self, address, id):
-        workerAvailable = NetWork.networking.NWSocket.checkAvailability(address)
-        if not workerAvailable[0]:
-            #Need a better message, I know 
-            raise WorkerUnavailableError("Worker " + str(address) + " refused to cooperate")
-        else:
-            self.address = address
-            self.realAddress = workerAvailable[1]
-            self.id = id
-            self.myTasks = {"-1": None}
-            self.alive = True
-
-    def sendRequest(self, type, contents):
-        #Send message to ther worker
-        if not self.alive:
-            raise DeadWorkerError(self.id)
+#All communication with the worker goes through one channel, requests from
+#the worker and its tasks arrive on the same channel and are given to requestHandler,
+#the transport reads from the channel (see NetWork.transport)
+#Requests to the worker are put in an outbox and sent by the outbox thread in order, so
+#whoever sends them (usually the dispatcher) never waits for the worker, the outbox doesn't
+#wait for responses either, the worker handles requests from the master in the order they
+#arrive on the channel, deathHandler(worker) is called once when the worker stops responding
+#The heartbeat thread pings a worker that is silent, if the worker host died or the network
+#broke without closing the connection the channel is closed when the pings go unanswered
+    def __init__(self, address, id, requestHandler, transport, deathHandler):
+        self.address = address
+        self.id = id
+        self.myTasks = {"-1": None}
+        self.alive = True
+        self.requestHandler = requestHandler
+        self.transport = transport
+        self.deathHandler = deathHandler
+        self.channel = None
+        self.closing = False
+        self.connectLock = Lock()
+        try:
+            self.connect()
+        except OSError as error:
+            #Need a better message, I know
+            raise WorkerUnavailableError("Worker " + str(address) + " refused to cooperate", error)
+        self.outbox = Queue()
+        self.outboxThread = Thread(target=self.outboxProcess)
+        self.outboxThread.daemon = True
+        self.outboxThread.start()
+        self.heartbeatThread = Thread(target=self.heartbeatProcess)
+        self.heartbeatThread.daemon = True
+        self.heartbeatThread.start()
+
+    def connect(self):
+        #Open the channel, the worker expects every new connection
+        #from the master to start with COMCODE_CHECKALIVE
+        connection = NetWork.networking.NWSocket()
+        try:
+            connection.connect(self.address)
+            connection.send(NetWork.networking.COMCODE_CHECKALIVE)
+            response = connection.recv()
+        except OSError:
+            connection.close()
+            raise
+        if response != NetWork.networking.COMCODE_ISALIVE:
+            connection.close()
+            raise ConnectionRefusedError("Unexpected response " + str(response[:20]))
+        connection.setTimeout(None)
+        self.realAddress = connection.address
+        self.channel = Channel(connection, self.requestReceived, self.channelClosed)
+        self.transport.attach(self.channel)
+
+    def channelClosed(self, channel):
+        #Called by the channel, the outbox connects again or finds out that the worker is dead
+        if not self.closing and self.alive:
+            self.outbox.put(self.checkConnection)
+
+    def heartbeatProcess(self):
+        while self.alive and not self.closing:
+            time.sleep(HEARTBEAT_INTERVAL / 2)
+            self.checkHeartbeat()
+
+    def checkHeartbeat(self):
+        #Closing the channel makes the outbox connect again, a worker that doesn't
+        #answer the new connection either is dead
+        channel = self.channel
+        if channel.closed:
+            return
+        silence = time.monotonic() - channel.lastReceived
+        if silence > HEARTBEAT_TIMEOUT:
+            channel.abort(ResponseTimeout("Worker " + str(self.address) + " sent nothing in " +
+                                          str(HEARTBEAT_TIMEOUT) + " seconds"))
+        elif silence > HEARTBEAT_INTERVAL:
+            try:
+                channel.ping()
+            except OSError:
+                pass
+
+    def checkConnection(self):
         try:
-            workerSocket = NetWork.networking.NWSocket()
-            workerSocket.connect(self.address)
-            workerSocket.send(type + pickle.dumps(contents))
-            workerSocket.recv()
-            workerSocket.close()
+            self.getChannel()
         except OSError:
+            self.died()
+
+    def died(self):
+        if self.alive:
             self.alive = False
-            raise DeadWorkerError(self.id)
+            self.channel.close()
+            self.deathHandler(self)
+
+    def getChannel(self):
+        #Get the channel, connect again if the connection broke
+        self.connectLock.acquire()
+        try:
+            if self.channel.closed:
+                self.connect()
+            return self.channel
+        finally:
+            self.connectLock.release()
+
+    def requestReceived(self, channel, responseExpected, requestId, type, payload):
+        self.requestHandler(self, channel, responseExpected, requestId, type, payload)
 
-    def sendRequestWithResponse(self, type, contents):
-        #Send message to the worker and get the response
+    def send(self, type, payload, onResponse):
+        #Send a request with pickled contents, a notification if onResponse is None,
+        #a request that wasn't sent because the connection broke is sent once more
+        #on a new connection, one that was sent is never sent again
         if not self.alive:
-            raise DeadWorkerError(self.id)
-        try:
-            workerSocket = NetWork.networking.NWSocket()
-            workerSocket.connect(self.address)
-            workerSocket.send(type + pickle.dumps(contents))
-            response = workerSocket.recv()
-            workerSocket.close()
-            return pickle.loads(response)
+            raise DeadWorkerError(self.id, "Worker " + str(self.address) + " is dead")
+        try:
+            try:
+                self.sendOn(self.getChannel(), type, payload, onResponse)
+            except ChannelClosed:
+                self.sendOn(self.getChannel(), type, payload, onResponse)
         except OSError:
-            self.alive = False
-            raise DeadWorkerError(self.id)
\ No newline at end of file
+            self.died()
+            raise DeadWorkerError(self.id, "Worker " + str(self.address) + " stopped responding")
+
+    def sendOn(self, channel, type, payload, onResponse):
+        if onResponse:
+            channel.requestRaw(type, payload, onResponse)
+        else:
+            channel.notifyRaw(type, payload)
+
+    def outboxProcess(self):
+        #Run queued jobs, usually deliveries of requests
+        job = self.outbox.get()
+        while job:
+            job()
+            job = self.outbox.get()
+
+    def deliver(self, type, contents, callback, pickled=False, rawResponse=False, sent=None):
+        #Send a request from the outbox thread, callback(response, error)
+        #is called by the channel when the response arrives, sent() once the request is sent
+        onResponse = partial(self.responseReceived, callback, rawResponse) if callback else None
+        try:
+            if not pickled:
+                contents = pickle.dumps(contents)
+            self.send(type, contents, onResponse)
+            if sent:
+                sent()
+        except Exception as failure:
+            #anything from a dead worker to contents that can't be pickled
+            if onResponse:
+                onResponse(None, failure)
+            elif not isinstance(failure, DeadWorkerError):
+                print("Failed to deliver a request to worker", self.id, type, failure)
+
+    def responseReceived(self, callback, rawResponse, response, error):
+        try:
+            if not error and not rawResponse:
+                response = pickle.loads(response)
+        except Exception as failure:
+            response, error = None, failure
+        try:
+            callback(response, error)
+        except Exception as failure:
+            print("Failed to pass a response from worker", self.id, failure)
+
+    def sendRequest(self, type, contents, sent=None):
+        #Queue a message for the worker, doesn't wait for it to be delivered,
+        #sent() is called from the outbox thread if the message gets sent
+        self.outbox.put(partial(self.deliver, type, contents, None, sent=sent))
+
+    def sendRawRequest(self, type, payload):
+        #Same as sendRequest but the contents are already pickled, used when
+        #the same message goes to many workers
+        self.outbox.put(partial(self.deliver, type, payload, None, True))
+
+    def sendRequestWithResponse(self, type, contents, callback, rawResponse=False):
+        #Queue a message for the worker, callback(response, error) is called when the
+        #response arrives or with the reason why there isn't one,
+        #with rawResponse the callback gets the response still pickled
+        self.outbox.put(partial(self.deliver, type, contents, callback, False, rawResponse))
+
+    def hold(self, gate):
+        #Queue gate(worker), requests queued after it are sent once it returns
+        self.outbox.put(partial(gate, self))
+
+    def close(self):
+        #Deliver what is left in the outbox and close the channel to the worker
+        self.closing = True
+        self.outbox.put(None)
+        self.outboxThread.join()
+        if self.channel:
+            self.channel.close()
@@ -2,67 +2,512 @@
 This module implements the WorkerProcess class that is used on worker computers
 to represent running tasks it also implements methods to control that task
 and get information about it.
+
+Tasks are run by a pool of long lived processes (see :py:class:`ProcessPool`), the
+server keeps ``size`` idle processes ready so a task doesn't have to wait for a new
+process to start. Every process is connected to the server with a local channel that
+carries tasks to the process, the state of finished tasks back to the server and the
+requests that tasks send to the master. When all processes are busy a new one is
+started, so all tasks submitted to a worker run at the same time like before, idle
+processes above ``size`` exit. Processes are replaced after running ``maxTasks`` tasks
+or when their memory use reaches ``maxRss``, because tasks can leave garbage
+(globals, imported modules...) behind in the process that ran them.
+
+Tasks submitted in a batch (see :py:meth:`Workgroup.submitMany <NetWork.workgroup.Workgroup.submitMany>`)
+don't get extra processes, they wait in a queue and run on the pool processes as they
+become idle, so a batch of thousands of tasks doesn't start thousands of processes.
+
+A new process closes the sockets it inherited from the server, a process holding the
+connection to the master or the listening socket would keep them open after the
+server dies and the master would never find out that the worker is gone.
+
+Processes are forked from the server while its other threads keep running, a lock
+that one of them held at that moment stays locked forever in the new process. Modules
+whose locks are also used in pool processes add a function that replaces them to
+:py:data:`afterForkHandlers`, those functions run in every forked process.
 """
-from multiprocessing import Process, Manager
+from multiprocessing import Process
+from threading import Thread, Lock, Event, Condition
+from queue import Queue
+from collections import deque
+from functools import partial
+import os
+import pickle
+import signal
+import socket
+import stat
+import struct
+
+from .networking import NWSocketTCP
+from .channel import Channel
+from .request import Request
+import NetWork.request
 
-CNT_DONE = 1
-CNT_RETURN = 2
-CNT_EXCEPTION_RAISED = 3
-CNT_EXCEPTION = 4
-CNT_RUNNING = 5
+CMD_RUN_TASK = b"PRN"
+CMD_STOP_PROCESS = b"PST"
+CMD_TASK_DONE = b"PDN"
+CMD_SHARED = b"PSH"
+#checked for inherited sockets where open descriptors can't be listed
+MAX_INHERITED_DESCRIPTOR = 1024
+PICKLED_NONE = pickle.dumps(None)
+#a finished task is reported with the length of the pickled report, the report and the pickled result
+REPORT_LENGTH = struct.Struct("!Q")
+#called in a forked process before anything else runs in it
+afterForkHandlers = []
+
+pool = None
+#type -> handler(request) for requests from tasks that the server handles itself
+#instead of passing them on to the master, each runs in its own thread
+localHandlers = {}
+
+
+class TaskProcessDied(Exception): pass
 
 
 class WorkerProcess:
     #Class to hold and control running task
-    def __init__(self, task):
-        self.manager = Manager().list(range(20))
-        self.manager[CNT_DONE] = False
-        self.manager[CNT_RETURN] = None
-        self.manager[CNT_EXCEPTION_RAISED] = False
-        self.manager[CNT_EXCEPTION] = None
-        self.manager[CNT_RUNNING] = False
-        self.process = Process(target=WorkerProcess.runner,
-                               args=(task, self.manager))
+    #The task runs in one of the processes of the pool, the state of the
+    #task is kept here and updated when the process reports that it's done
+    #The result is kept pickled the way the process sent it and it's passed
+    #on to the master without being unpickled, finishHandler(workerProcess) is
+    #called when the task finishes or gets terminated
+    #A task can be terminated before it starts (while it waits for its code),
+    #startLock makes sure such a task never starts
+    startLock = Lock()
+
+    def __init__(self, task, finishHandler=None):
+        self.task = task
+        self.finishHandler = finishHandler
+        self.poolProcess = None
+        self.pickledResult = PICKLED_NONE
+        self.exception = None
+        self.isExceptionRaised = False
+        self.isDone = False
+        self.isRunning = False
+        self.terminated = False
+        self.finished = Event()
 
     def start(self):
-        self.manager[CNT_RUNNING] = True
-        self.process.start()
+        if self.claim():
+            getPool().run(self)
+
+    @staticmethod
+    def startQueued(workerProcesses):
+        #Start tasks that run only when a pool process is idle
+        getPool().enqueue([workerProcess for workerProcess in workerProcesses if workerProcess.claim()])
 
-    def getResult(self):
-        return self.manager[CNT_RETURN]
+    def claim(self):
+        #Mark the task as running, False if it was terminated before it started
+        WorkerProcess.startLock.acquire()
+        try:
+            if self.isDone:
+                return False
+            self.isRunning = True
+            return True
+        finally:
+            WorkerProcess.startLock.release()
+
+    def finish(self, pickledResult, exceptionRaised, exception):
+        #Called when the process running the task reports the outcome
+        self.pickledResult = pickledResult
+        self.isExceptionRaised = exceptionRaised
+        self.exception = exception
+        self.isDone = True
+        self.isRunning = False
+        self.finished.set()
+        if self.finishHandler:
+            self.finishHandler(self)
+
+    def getPickledResult(self):
+        return self.pickledResult
 
     def running(self):
-        return self.manager[CNT_RUNNING]
+        return self.isRunning
 
     def done(self):
-        return self.manager[CNT_DONE]
+        return self.isDone
 
     def exceptionRaised(self):
-        return self.manager[CNT_EXCEPTION_RAISED]
+        return self.isExceptionRaised
 
     def getException(self):
-        return self.manager[CNT_EXCEPTION]
+        return self.exception
 
     def terminate(self):
-        if self.manager[CNT_RUNNING]:
-            self.process.terminate()
-            self.manager[CNT_RUNNING] = False
+        WorkerProcess.startLock.acquire()
+        running = self.isRunning
+        notStarted = not running and not self.isDone
+        if notStarted:
+            self.isDone = True
+        WorkerProcess.startLock.release()
+        if running:
+            getPool().terminate(self)
+        elif notStarted:
+            self.terminated = True
+            self.finish(PICKLED_NONE, False, None)
 
     def join(self):
-        if self.manager[CNT_RUNNING]:
-            self.process.join()
+        if self.isRunning:
+            self.finished.wait()
 
-    @staticmethod
-    def runner(task, manager):
-        #A function that actualy runs the task
-        returnValue = None
+
+class PoolProcess:
+    #A long lived process that runs tasks one at a time
+    def __init__(self, pool):
+        self.pool = pool
+        self.workerProcess = None
+        self.tasksRun = 0
+        self.processSocket, serverSocket = socket.socketpair()
+        serverSocket = NWSocketTCP(serverSocket)
+        serverSocket.setTimeout(None)
+        self.channel = Channel(serverSocket, self.requestReceived, self.channelClosed)
+        self.process = Process(target=processRunner, args=(self.processSocket,))
+
+    def start(self):
+        self.process.start()
+        self.processSocket.close()
+        self.channel.start()
+
+    def run(self, workerProcess):
+        self.channel.notify(CMD_RUN_TASK, {"TASK": workerProcess.task})
+
+    def stop(self):
+        #Ask the process to exit, it closes the channel when it does
+        try:
+            self.channel.notify(CMD_STOP_PROCESS, {})
+        except OSError:
+            pass
+
+    def kill(self):
+        self.process.terminate()
+        self.channel.close()
+
+    def requestReceived(self, channel, responseExpected, requestId, type, payload):
+        #The process reports finished tasks, all other requests come
+        #from the running task and are passed on to the master
+        if type == CMD_TASK_DONE:
+            reportLength = REPORT_LENGTH.unpack_from(payload)[0]
+            reportEnd = REPORT_LENGTH.size + reportLength
+            report = pickle.loads(payload[REPORT_LENGTH.size:reportEnd])
+            self.pool.taskDone(self, report, payload[reportEnd:])
+        elif type in localHandlers:
+            request = Request(type, pickle.loads(payload), -1, channel, requestId,
+                              responseExpected=responseExpected)
+            handler = Thread(target=handleLocalRequest, args=(request,))
+            handler.daemon = True
+            handler.start()
+        else:
+            NetWork.request.relayRequest(channel, responseExpected, requestId, type, payload)
+
+    def channelClosed(self, channel):
+        self.pool.processExited(self)
+
+
+class ProcessPool:
+    #Keeps processes ready to run tasks, see the module description
+    def __init__(self, size, maxTasks=0, maxRss=0):
+        self.size = size
+        self.maxTasks = maxTasks
+        self.maxRss = maxRss
+        self.idle = []
+        self.processes = set()
+        self.shared = []
+        self.waiting = deque()
+        self.lock = Lock()
+        #notified whenever a task finishes
+        self.changed = Condition(self.lock)
+        self.stopped = False
+        self.lock.acquire()
+        self.fill()
+        self.lock.release()
+
+    def startProcess(self):
+        #Must be called while holding the lock
+        process = PoolProcess(self)
+        process.start()
+        for payload in self.shared:
+            process.channel.notifyRaw(CMD_SHARED, payload)
+        self.processes.add(process)
+        return process
+
+    def fill(self):
+        #Start processes until size of them are idle, must be called while holding the lock
+        while not self.stopped and len(self.idle) < self.size:
+            self.idle.append(self.startProcess())
+
+    def run(self, workerProcess):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                process = self.idle.pop()
+            else:
+                process = self.startProcess()
+            self.assign(process, workerProcess)
+        finally:
+            self.lock.release()
+        self.send([(process, workerProcess)])
+
+    def assign(self, process, workerProcess):
+        #Must be called while holding the lock
+        process.workerProcess = workerProcess
+        workerProcess.poolProcess = process
+
+    def send(self, assigned):
+        #Send tasks to the processes they were assigned to, called without the lock
+        for process, workerProcess in assigned:
+            try:
+                process.run(workerProcess)
+            except OSError:
+                #the task is marked as failed when the channel closes
+                process.kill()
+
+    def startWaiting(self):
+        #Assign queued tasks to idle processes, must be called while holding the lock,
+        #the returned pairs must be passed to send after the lock is released
+        assigned = []
+        while self.waiting and self.idle:
+            process = self.idle.pop()
+            workerProcess = self.waiting.popleft()
+            self.assign(process, workerProcess)
+            assigned.append((process, workerProcess))
+        return assigned
+
+    def enqueue(self, workerProcesses):
+        self.lock.acquire()
+        self.waiting.extend(workerProcesses)
+        assigned = self.startWaiting()
+        self.lock.release()
+        self.send(assigned)
+
+    def taskDone(self, process, report, pickledResult):
+        self.lock.acquire()
+        workerProcess = process.workerProcess
+        process.workerProcess = None
+        process.tasksRun += 1
+        retire = (self.stopped or len(self.idle) >= self.size or
+                  (self.maxTasks and process.tasksRun >= self.maxTasks) or
+                  (self.maxRss and report["RSS"] >= self.maxRss))
+        if not retire:
+            self.idle.append(process)
+        assigned = self.startWaiting()
+        self.lock.release()
+        self.send(assigned)
+        if workerProcess:
+            workerProcess.finish(pickledResult, report["EXCEPTION_RAISED"], report["EXCEPTION"])
+        #after finish so the master hears that the task finished before it's asked for more
+        self.lock.acquire()
+        self.changed.notify_all()
+        self.lock.release()
+        if retire:
+            process.stop()
+
+    def terminate(self, workerProcess):
+        self.lock.acquire()
+        process = workerProcess.poolProcess
+        running = process and process.workerProcess is workerProcess
+        queued = not process and workerProcess in self.waiting
+        if running:
+            process.workerProcess = None
+        elif queued:
+            self.waiting.remove(workerProcess)
+        self.changed.notify_all()
+        self.lock.release()
+        if running:
+            process.kill()
+        if running or queued:
+            workerProcess.terminated = True
+            workerProcess.finish(PICKLED_NONE, False, None)
+
+    def processExited(self, process):
+        #Called when the channel to a process gets closed, whether the process was
+        #stopped, killed or it died, a task that was still running is marked as failed
+        self.lock.acquire()
+        workerProcess = process.workerProcess
+        process.workerProcess = None
+        self.processes.discard(process)
+        if process in self.idle:
+            self.idle.remove(process)
+        self.fill()
+        assigned = self.startWaiting()
+        self.changed.notify_all()
+        self.lock.release()
+        self.send(assigned)
+        if workerProcess:
+            workerProcess.finish(PICKLED_NONE, True, TaskProcessDied("The process running the task exited"))
+
+    def waitForFreeSlots(self, limit):
+        #Wait until fewer than limit tasks are running or queued, return how many more fit
+        self.lock.acquire()
         try:
-            returnValue = task.target(*task.args, **task.kwargs)
-        except (BaseException, Exception) as exception:
-            manager[CNT_EXCEPTION_RAISED] = True
-            manager[CNT_EXCEPTION] = exception
+            while True:
+                busy = len(self.waiting) + len([process for process in self.processes if process.workerProcess])
+                if busy < limit:
+                    return limit - busy
+                self.changed.wait()
         finally:
-            manager[CNT_RETURN] = returnValue
-            manager[CNT_DONE] = True
-            manager[CNT_RUNNING] = False
-            return 0
\ No newline at end of file
+            self.lock.release()
+
+    def steal(self, count):
+        #Take up to count queued tasks that haven't started, the last queued are taken first
+        self.lock.acquire()
+        stolen = []
+        while self.waiting and len(stolen) < count:
+            stolen.append(self.waiting.pop())
+        self.changed.notify_all()
+        self.lock.release()
+        return stolen
+
+    def share(self, handler, contents):
+        #Run handler(request) in all processes, processes started later run it when they start
+        payload = pickle.dumps({"HANDLER": handler, "CONTENTS": contents})
+        self.lock.acquire()
+        self.shared.append(payload)
+        processes = list(self.processes)
+        self.lock.release()
+        for process in processes:
+            try:
+                process.channel.notifyRaw(CMD_SHARED, payload)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.lock.acquire()
+        self.stopped = True
+        processes = list(self.processes)
+        self.lock.release()
+        for process in processes:
+            process.kill()
+
+
+def handleLocalRequest(request):
+    try:
+        localHandlers[request.getType()](request)
+    except Exception as error:
+        print("Failed to handle a request from a task", request.getType(), error)
+        if request.responseExpected and not request.responseSent:
+            request.respondError(error)
+    request.close()
+
+
+def startPool(size=None, maxTasks=0, maxRss=0):
+    """
+    Start the process pool used to run tasks on this worker.
+
+    :type size: int
+    :param size: number of idle processes kept ready, number of CPUs by default
+    :type maxTasks: int
+    :param maxTasks: replace a process after it runs this many tasks, 0 means never
+    :type maxRss: int
+    :param maxRss: replace a process when its resident memory reaches this many bytes, 0 means never
+    """
+    global pool
+    pool = ProcessPool(size or os.cpu_count() or 1, maxTasks, maxRss)
+    return pool
+
+
+def getPool():
+    if pool is None:
+        startPool()
+    return pool
+
+
+def shareWithProcesses(handler, contents):
+    #Used by plugins that keep state on the worker which tasks need, handler
+    #must be a module level function, it's called with a Request holding the contents
+    if pool:
+        pool.share(handler, contents)
+
+
+def currentRss():
+    #Resident memory of this process in bytes
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def runTask(task):
+    #Run a task and return the report and the result, both pickled, the result
+    #is pickled only here, the server and the master pass it on as it is
+    report = {"EXCEPTION_RAISED": False, "EXCEPTION": None}
+    pickledResult = PICKLED_NONE
+    NetWork.request.runningTask = task.id
+    try:
+        args, kwargs = task.arguments()
+        pickledResult = pickle.dumps(task.target(*args, **kwargs), pickle.HIGHEST_PROTOCOL)
+    except BaseException as exception:
+        report["EXCEPTION_RAISED"] = True
+        report["EXCEPTION"] = exception
+    finally:
+        NetWork.request.runningTask = None
+    report["RSS"] = currentRss()
+    try:
+        return pickle.dumps(report), pickledResult
+    except Exception as error:
+        report["EXCEPTION"] = pickle.PicklingError("Failed to send the exception raised by the task: " + str(error))
+        return pickle.dumps(report), pickledResult
+
+
+def processRequestReceived(tasks, channel, responseExpected, requestId, type, payload):
+    #Tasks are run by the main thread of the process, one at a time
+    if type == CMD_RUN_TASK:
+        tasks.put(pickle.loads(payload)["TASK"])
+    elif type == CMD_STOP_PROCESS:
+        tasks.put(None)
+    elif type == CMD_SHARED:
+        shared = pickle.loads(payload)
+        shared["HANDLER"](Request(type, shared["CONTENTS"], -1, responseExpected=False))
+
+
+def closeInheritedSockets(keep):
+    #Close all sockets except the one with the file descriptor keep, the descriptors
+    #are pointed at os.devnull instead of being closed because socket objects copied
+    #from the server still hold them and would close them again when they get collected
+    try:
+        descriptors = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        descriptors = range(3, MAX_INHERITED_DESCRIPTOR)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in descriptors:
+        if fd <= 2 or fd == keep or fd == devnull:
+            continue
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.dup2(devnull, fd)
+        except OSError:
+            pass
+    os.close(devnull)
+
+
+def processForked():
+    for handler in afterForkHandlers:
+        handler()
+
+
+os.register_at_fork(after_in_child=processForked)
+
+
+def processRunner(processSocket):
+    #The main function of pool processes, Ctrl+C on the worker stops the
+    #server and the server stops its processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    closeInheritedSockets(processSocket.fileno())
+    processSocket = NWSocketTCP(processSocket)
+    processSocket.setTimeout(None)
+    tasks = Queue()
+    channel = Channel(processSocket, partial(processRequestReceived, tasks),
+                      lambda channel: tasks.put(None))
+    channel.start()
+    NetWork.request.setChannel(channel)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        report, pickledResult = runTask(task)
+        try:
+            channel.notifyRaw(CMD_TASK_DONE, REPORT_LENGTH.pack(len(report)), report, pickledResult)
+        except OSError:
+            break
+    channel.close()
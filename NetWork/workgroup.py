@@ -3,17 +3,24 @@ The Workgroup class is defined in this file, along with accompanying classes
 and functions.
 """
 
-from multiprocessing import Queue
-from threading import Thread
+from queue import Queue
+from threading import Thread, Lock
+from functools import partial
 
 import NetWork.networking
-from .handlers import receiveSocketData, handlerList, plugins
-from .worker import Worker, WorkerUnavailableError, DeadWorkerError
-from .task import Task, TaskHandler, CMD_SUBMIT_TASK
+from .handlers import receiveWorkerRequest, reportDeadWorker, joinHandler, handlerList, plugins
+from .worker import Worker, WorkerUnavailableError
+from .task import Task, TaskHandler, WaitingTask, CMD_SUBMIT_TASK, getTaskState, findOutputs
 from .commcodes import *
 from .cntcodes import *
-from NetWork.queue import NWQueue
-from .request import Request
+from .request import Request, LocalResponse
+from .transport import getTransport
+from .broadcast import setUpRelays
+from .placement import getPlacement, setUpPlacement
+from .pull import setUpPulling, CMD_QUEUE_TASKS
+from .mapping import ChunkedMap
+from .broadcastvalue import BroadcastValue
+from .objectstore import put, inputLocation
 import NetWork.request
 
 
@@ -27,8 +34,8 @@ class Workgroup:
     and concurrency. Handles :py:mod:`Locks <NetWork.lock>`, :py:mod:`Queues NetWork.queue`,
     :py:mod:`Managers <NetWork.manager>`, :py:mod:`Events <NetWork.event>` and other tools.
     
-    In order for the Workgroup to be functional, the ``dispatcher`` and ``listener`` 
-    threads must be started and they must be terminated properly on exit. The
+    In order for the Workgroup to be functional, the ``dispatcher``
+    thread must be started and they must be terminated properly on exit. The
     recomended way to do this is to use the ``with`` statement, it will ensure
     proper termination even in case of an exception.
     
@@ -72,10 +79,8 @@ class Workgroup:
       SSL certificates.
       Items to put in this dictionary:
         
-          * ``"ListenerAES"`` AES key used to decrypt messages from workers,
-            must be specified if AES is enabled
-          * ``"ListenerHMAC"`` HMAC key used to verify messages from the workers,
-            must be specified if HMAC is enabled
+          * ``"ListenerAES"`` and ``"ListenerHMAC"`` are accepted for compatibility but no longer used,
+            all messages to and from a worker are protected with the keys of that worker
           * ``PeerCertFile`` A file that contains SSL certificates that will be used to
             verify workers, you must provide PeerCertFile or PeerCertDir
           * ``PeerCertDir`` A folder that contains SSL certificates that will be used to
@@ -83,27 +88,69 @@ class Workgroup:
           * ``LocalCert`` SSL certificate used to let workers verify this master (mandatory is SSL is enabled)
           * ``LocalKey`` Private SSL key for this master (mandatory if SSL is enabled)
           * ``LocalKeyPassword`` Password used to decrypt local key if it's encrypted (optional)
+          * ``Framing`` How message lengths are sent, ``"BINARY"`` (default) sends a fixed size binary
+            length and receives messages into a single preallocated buffer, ``"ASCII"`` is the old
+            format, the workers must use the same framing (``--framing`` parameter of server.py)
+          * ``ReadSize`` Maximum number of bytes received from the network in one call (optional)
+          * ``MaxMessageLength`` Longest message in bytes accepted from a worker, 1 GiB by default, longer
+            messages close the connection (``--max_message_length`` parameter of server.py, in megabytes)
+
+    :type relayFanout: int
+    :param relayFanout: When set, requests that go to all workers (registering NetObject
+      classes) are relayed through a tree of workers where every worker passes the request
+      on to at most this many others, instead of the master sending it to every worker. Useful with
+      many workers. Works only with the default ``"TCP"`` socket type and is ignored otherwise.
+
+    :type transport: str
+    :param transport: How messages from the workers are received. ``"threads"`` (default) reads
+      every worker connection in its own thread, ``"asyncio"`` reads all of them in one asyncio
+      event loop, which uses less threads and scales better with many workers and bursty traffic.
+
+    :type placement: str
+    :param placement: How a worker is chosen for every submitted task, ``"round-robin"`` (default),
+      ``"least-outstanding"``, ``"capacity"`` or ``"two-choices"``,
+      see :py:mod:`NetWork.placement` for a description of the policies.
+
+    :type scheduling: str
+    :param scheduling: ``"push"`` (default) sends every task to a worker when it's submitted,
+      ``"pull"`` keeps submitted tasks on the master until a worker has room for them and moves
+      tasks that didn't start from busy workers to idle ones, see :py:mod:`NetWork.pull`.
+      Better when tasks take very different amounts of time.
 
     """
 
     def __init__(self, workerAddresses, skipBadWorkers=False,
-                 socketType="TCP", socketParams={}):
+                 socketType="TCP", socketParams={}, transport="threads", relayFanout=0,
+                 placement="round-robin", scheduling="push"):
+        if not scheduling in ("push", "pull"):
+            raise ValueError("Unknown scheduling " + str(scheduling))
         self.controls = dict()
         self.controls[CNT_WORKER_COUNT] = 0
         self.controls[CNT_TASK_COUNT] = 0
         self.controls[CNT_TASK_EXECUTORS] = {-1: None}
         self.controls[CNT_DEAD_WORKERS] = set()
+        self.controls[CNT_BYTES_MOVED] = {"MOVED": 0, "LOCAL": 0}
+        self.controls[CNT_WAITING_TASKS] = {}
+        self.controls[CNT_NET_CLASSES] = []
         self.currentWorker = -1
+        #tasks whose dependencies finished are submitted by the dispatcher thread
+        self.selectLock = Lock()
+        self.placement = getPlacement(placement)
+        self.scheduling = scheduling
         for plugin in plugins:
             plugin.masterInit(self)
-        NetWork.networking.setUp(socketType, socketParams)
+        NetWork.networking.setUp(socketType, socketParams, listening=False)
         NetWork.request.setUp(workGroup=self)
-        self.listenerSocket = NetWork.networking.NWSocket()
+        self.commqueue = Queue()
+        self.transport = getTransport(transport)
         self.workerList = []
         for workerAddress in workerAddresses:
             try:
                 newWorker = Worker(workerAddress,
-                                   self.controls[CNT_WORKER_COUNT])
+                                   self.controls[CNT_WORKER_COUNT],
+                                   partial(receiveWorkerRequest, self.commqueue),
+                                   self.transport,
+                                   partial(reportDeadWorker, self.commqueue))
                 self.workerList.append(newWorker)
                 self.controls[CNT_WORKER_COUNT] += 1
             except WorkerUnavailableError as workerError:
@@ -112,11 +159,11 @@ class Workgroup:
         if not self.controls[CNT_WORKER_COUNT]:
             raise NoWorkersError("No workers were successfully added to workgroup")
         self.controls[CNT_WORKERS] = self.workerList
-        self.commqueue = Queue()
-        self.networkListener = Thread(target=self.listenerProcess,
-                                      args=(self.listenerSocket, self.commqueue,
-                                            self.controls))
-        self.networkListener.daemon = True
+        self.joinLock = Lock()
+        setUpRelays(self.controls, relayFanout)
+        setUpPlacement(self.controls, self.placement)
+        if scheduling == "pull":
+            setUpPulling(self.controls)
         self.dispatcher = Thread(target=self.dispatcherProcess,
                                  args=(self.commqueue, self.controls))
         self.running = False
@@ -131,27 +178,75 @@ class Workgroup:
     def deadWorkers(self):
         return self.controls[CNT_DEAD_WORKERS]
 
+    def addWorker(self, address):
+        """
+        Add a worker to the workgroup, it can be done while the workgroup is working.
+        Broadcast values (see :py:meth:`broadcast`) sent before the worker was added
+        are not sent to it, NetObject classes registered before are.
+
+        :type address: str
+        :param address: address of the worker
+
+        :rtype: int
+        :return: ID of the new worker
+        """
+        self.joinLock.acquire()
+        try:
+            newWorker = Worker(address,
+                               len(self.workerList),
+                               partial(receiveWorkerRequest, self.commqueue),
+                               self.transport,
+                               partial(reportDeadWorker, self.commqueue))
+            request = Request(CMD_WORKER_JOINED, {"WORKER": newWorker}, overNetwork=False,
+                              commqueue=LocalResponse())
+            if self.running:
+                self.commqueue.put(request)
+            else:
+                joinHandler(request, self.controls)
+            return request.getResponse()
+        finally:
+            self.joinLock.release()
+
     def startServing(self):
         """
-        Start the dipatcher and listener threads, the workgroup is ready
+        Start the dipatcher thread, the workgroup is ready
         for work after this.
         Instead of running this method manually it is recomened to use
         the ``with`` statement
         """
         self.dispatcher.start()
-        self.networkListener.start()
         self.running = True
 
-    def selectNextWorker(self):
+    def selectNextWorker(self, location={}, affinity=None):
+        #location says how many bytes of the task's inputs each worker holds
         if self.controls[CNT_WORKER_COUNT] == 0:
             raise NoWorkersError("All workers have died")
-        self.currentWorker += 1
-        self.currentWorker %= self.controls[CNT_WORKER_COUNT]
-        while not self.controls[CNT_WORKERS][self.currentWorker].alive:
-            self.currentWorker += 1
-            self.currentWorker %= self.controls[CNT_WORKER_COUNT]
+        liveWorkers = [worker for worker in self.controls[CNT_WORKERS] if worker.alive]
+        if not liveWorkers:
+            raise NoWorkersError("All workers have died")
+        self.selectLock.acquire()
+        try:
+            if affinity is not None:
+                workerId = self.placement.selectByKey(liveWorkers, affinity)
+            elif location:
+                workerId = self.placement.selectFor(liveWorkers, location)
+            else:
+                workerId = self.placement.select(liveWorkers)
+            self.placement.taskStarted(workerId)
+            self.currentWorker = workerId
+            return workerId
+        finally:
+            self.selectLock.release()
 
-    def submit(self, target, args=(), kwargs={}):
+    def newTaskId(self):
+        #Tasks can be submitted from many threads at once
+        self.selectLock.acquire()
+        self.controls[CNT_TASK_COUNT] += 1
+        id = self.controls[CNT_TASK_COUNT]
+        self.selectLock.release()
+        return id
+
+    def submit(self, target, args=(), kwargs={}, affinity=None, after=()):
         """
         Submit a task to be executed by the workgroup
 
@@ -164,52 +259,193 @@ class Workgroup:
         :type kwargs: dict
         :param kwargs: optional dictionary of keyword arguments
 
+        :type affinity: hashable
+        :param affinity: optional key, all tasks with the same key run on the same worker while
+          it's alive, see :py:mod:`NetWork.placement`. With pull scheduling these tasks are
+          sent to their worker right away like with push scheduling.
+
+        :type after: iterable
+        :param after: optional :py:class:`TaskHandlers <NetWork.task.TaskHandler>` of tasks that
+          must finish before this task starts, the task also waits for the tasks whose
+          :py:meth:`outputs <NetWork.task.TaskHandler.output>` are in its arguments
+
         :rtype: :py:class:`TaskHandler <NetWork.task.TaskHandler>`
         :return: handler used for controling the task
         """
-        self.selectNextWorker()
-        self.controls[CNT_TASK_COUNT] += 1
-        newTask = Task(target=target, args=args, kwargs=kwargs,
-                       id=self.controls[CNT_TASK_COUNT])
+        dependencies = set(handler.id for handler in after)
+        dependencies.update(output.id for output in findOutputs(args, kwargs))
+        if dependencies:
+            id = self.newTaskId()
+            WaitingTask(self, id, target, args, kwargs, affinity, dependencies).start()
+            return TaskHandler(id)
+        return TaskHandler(self.startTask(target, args, kwargs, affinity))
+
+    def startTask(self, target, args, kwargs, affinity, id=None):
+        #Send a task to a worker or to the queue of pull scheduling and return its id,
+        #tasks that waited for dependencies already have an id
+        location = inputLocation(args, kwargs)
+        if self.scheduling == "pull" and affinity is None:
+            if id is None:
+                id = self.newTaskId()
+            newTask = Task(target=target, args=args, kwargs=kwargs, id=id)
+            getTaskState(newTask.id).inputLocation = location
+            self.sendRequest(CMD_QUEUE_TASKS, {"TASKS": [newTask]})
+            return newTask.id
+        workerId = self.selectNextWorker(location, affinity)
+        if id is None:
+            id = self.newTaskId()
+        newTask = Task(target=target, args=args, kwargs=kwargs, id=id)
+        getTaskState(newTask.id).inputLocation = location
         self.sendRequest(CMD_SUBMIT_TASK,
                          {
-                             "WORKER": self.currentWorker,
+                             "WORKER": workerId,
                              "TASK": newTask
                          })
         executors = self.controls[CNT_TASK_EXECUTORS]
-        executors[newTask.id] = self.currentWorker
+        executors[newTask.id] = workerId
         self.controls[CNT_TASK_EXECUTORS] = executors
-        return TaskHandler(newTask.id)
+        return newTask.id
+
+    def submitMany(self, target, argsList, kwargs={}):
+        """
+        Submit many tasks that run the same function with different arguments.
+        The tasks are spread over the workers like with :py:meth:`submit` but every
+        worker gets all of its tasks in one message, which is much faster than
+        submitting them one by one. On a worker the tasks of a batch don't all start
+        at once, they wait until one of the processes that run tasks is free.
+
+        :type target: function
+        :param target: function to be executed
+
+        :type argsList: iterable
+        :param argsList: a tuple of positional arguments for every task
+
+        :type kwargs: dict
+        :param kwargs: optional dictionary of keyword arguments given to every task
+
+        :rtype: list
+        :return: a :py:class:`TaskHandler <NetWork.task.TaskHandler>` for every task
+        """
+        if self.scheduling == "pull":
+            newTasks = []
+            for args in argsList:
+                newTasks.append(Task(target, args, kwargs, self.newTaskId()))
+                getTaskState(newTasks[-1].id).inputLocation = inputLocation(args, kwargs)
+            if newTasks:
+                self.sendRequest(CMD_QUEUE_TASKS, {"TASKS": newTasks})
+            return [TaskHandler(newTask.id) for newTask in newTasks]
+        batches = {}
+        handlers = []
+        executors = self.controls[CNT_TASK_EXECUTORS]
+        for args in argsList:
+            location = inputLocation(args, kwargs)
+            workerId = self.selectNextWorker(location)
+            id = self.newTaskId()
+            getTaskState(id).inputLocation = location
+            batches.setdefault(workerId, []).append((id, args, kwargs))
+            executors[id] = workerId
+            handlers.append(TaskHandler(id))
+        if batches:
+            self.sendRequest(CMD_SUBMIT_TASK,
+                             {
+                                 "TARGET": Task(target=target),
+                                 "BATCHES": batches
+                             })
+        return handlers
+
+    def map(self, function, iterable, chunksize=None, window=None):
+        """
+        Run the function for every item of the iterable and return the results in a list,
+        like the builtin ``map`` but the items are processed by the workgroup. Items are sent
+        to the workers in chunks, every chunk is run as one task.
+
+        :type function: function
+        :param function: function that takes one argument
+
+        :type iterable: iterable
+        :param iterable: items to run the function for
+
+        :type chunksize: int
+        :param chunksize: number of items in one task, when not given it's adapted so that a chunk
+          runs for about :py:const:`NetWork.mapping.CHUNK_DURATION` seconds
+
+        :type window: int
+        :param window: maximum number of chunks that are running or whose results wait to be used,
+          twice the number of workers by default, more items are taken from the iterable only when
+          results are used
+
+        :rtype: list
+        :return: results in the order of the items
+
+        If the function raises an exception for any item it's raised here.
+        """
+        return list(self.imap(function, iterable, chunksize, window))
+
+    def imap(self, function, iterable, chunksize=None, window=None):
+        """
+        Same as :py:meth:`map` but returns an iterator that gives the results as they arrive,
+        in the order of the items. Useful when the iterable is big or endless.
+        """
+        return ChunkedMap(self, function, iterable, chunksize, window).ordered()
+
+    def imap_unordered(self, function, iterable, chunksize=None, window=None):
+        """
+        Same as :py:meth:`imap` but the results are given in the order in which
+        their chunks finish.
+        """
+        return ChunkedMap(self, function, iterable, chunksize, window).unordered()
+
+    def broadcast(self, value):
+        """
+        Send a big read-only value to all workers once, tasks get the returned handle
+        in their arguments instead of the value and read the value from its ``value`` attribute,
+        see :py:mod:`NetWork.broadcastvalue`.
+
+        :type value: object
+        :param value: a picklable value
+
+        :rtype: :py:class:`BroadcastValue <NetWork.broadcastvalue.BroadcastValue>`
+        :return: handle of the value
+        """
+        return BroadcastValue(value, self)
+
+    def put(self, value):
+        """
+        Put an object in the object store of the master, tasks that get the returned
+        reference fetch the object when they need it, see :py:mod:`NetWork.objectstore`.
+
+        :rtype: :py:class:`ObjectRef <NetWork.objectstore.ObjectRef>`
+        :return: reference to the object
+        """
+        return put(value)
+
+    def bytesMoved(self):
+        """
+        Get how much input data of the finished tasks from the object store had to be
+        fetched from other computers and how much was already on the worker that ran
+        the task, see :py:meth:`TaskHandler.bytesMoved <NetWork.task.TaskHandler.bytesMoved>`.
+
+        :rtype: tuple
+        :return: bytes moved and bytes used where they were
+        """
+        bytesMoved = self.controls[CNT_BYTES_MOVED]
+        return bytesMoved["MOVED"], bytesMoved["LOCAL"]
 
     def sendRequest(self, type, contents):
         self.commqueue.put(Request(type, contents, overNetwork=False))
 
     def sendRequestWithResponse(self, type, contents):
-        responseQueue = NWQueue(self)
-        request = Request(type, contents, overNetwork=False, commqueue=responseQueue)
+        request = Request(type, contents, overNetwork=False, commqueue=LocalResponse())
         self.commqueue.put(request)
         return request.getResponse()
 
     def stopServing(self):
         """
-        Stop the dispatcher and listener threads
+        Stop the dispatcher thread and close connections to the workers,
         also invoked when exiting whe ``with`` block
         """
         Workgroup.onExit(self)
 
-    @staticmethod
-    def listenerProcess(listenerSocket, commqueue, controls):
-        #A process that receives network requests
-        listenerSocket.listen()
-        while True:
-            try:
-                receivedRequest = listenerSocket.accept()
-                handlerThread = Thread(target=receiveSocketData,
-                                       args=(receivedRequest, commqueue, controls))
-                handlerThread.start()
-            except OSError as error:
-                print("There was a connection attempt but a network error occured", error)
-
     @staticmethod
     def dispatcherProcess(commqueue, controls):
         #A process that handles requests
@@ -218,8 +454,11 @@ class Workgroup:
             #print(request)
             try:
                 handlerList[request.getType()](request, controls)
-            except DeadWorkerError as error:
-                commqueue.put(Request(CMD_WORKER_DIED, {"WORKER": error.id}))
+            except Exception as error:
+                #a failing handler must not stop the dispatcher
+                print("Failed to handle a request", request.getType(), repr(error))
+                if request.responseExpected and not request.responseSent and not request.deferred:
+                    request.respondError(error)
             request.close()
             request = commqueue.get()
 
@@ -229,5 +468,7 @@ class Workgroup:
         if target.running:
             target.commqueue.put(CMD_HALT)
             target.dispatcher.join()
-            target.listenerSocket.close()
+            for worker in target.workerList:
+                worker.close()
+            target.transport.stop()
             target.running = False
@@ -0,0 +1,82 @@
+"""
+Measures how many requests per second the Workgroup dispatcher can take from its
+commqueue, with the in-process queue.Queue it uses now and with the
+multiprocessing.Queue it used before.
+
+Producer threads put requests on the queue the same way worker channels and
+Workgroup.sendRequest do, the handler does nothing so only the queue is measured.
+
+Usage:
+
+    python3 benchmarks/dispatcher_benchmark.py --requests 100000 --producers 1 4
+"""
+import os
+import sys
+import time
+import multiprocessing
+import queue
+from argparse import ArgumentParser
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NetWork.workgroup import Workgroup
+from NetWork.handlers import handlerList
+from NetWork.request import Request
+from NetWork.commcodes import CMD_HALT
+
+CMD_BENCHMARK = b"BEN"
+CMD_BENCHMARK_DONE = b"BED"
+
+queueTypes = {"queue.Queue": queue.Queue, "multiprocessing.Queue": multiprocessing.Queue}
+finished = Event()
+
+
+def doNothing(request, controls):
+    pass
+
+
+def finish(request, controls):
+    finished.set()
+
+
+def producer(commqueue, requests, contents):
+    for i in range(requests):
+        commqueue.put(Request(CMD_BENCHMARK, contents, overNetwork=False, responseExpected=False))
+
+
+def measure(queueType, requests, producers, contents):
+    commqueue = queueType()
+    finished.clear()
+    dispatcher = Thread(target=Workgroup.dispatcherProcess, args=(commqueue, {}))
+    dispatcher.start()
+    threads = [Thread(target=producer, args=(commqueue, requests // producers, contents))
+               for i in range(producers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    #the dispatcher handles requests in order, once this one is handled all are
+    commqueue.put(Request(CMD_BENCHMARK_DONE, {}, overNetwork=False, responseExpected=False))
+    finished.wait()
+    elapsed = time.perf_counter() - start
+    commqueue.put(CMD_HALT)
+    dispatcher.join()
+    return requests / elapsed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measure requests per second handled by the Workgroup dispatcher")
+    parser.add_argument("--requests", type=int, default=100000, help="Number of requests to send")
+    parser.add_argument("--producers", type=int, nargs="+", default=[1, 4],
+                        help="Numbers of threads putting requests on the queue")
+    parser.add_argument("--payload", type=int, default=64, help="Size of the data carried by every request")
+    args = parser.parse_args()
+    handlerList[CMD_BENCHMARK] = doNothing
+    handlerList[CMD_BENCHMARK_DONE] = finish
+    contents = {"ID": 1, "DATA": b"x" * args.payload}
+    print("producers".rjust(10), *(name.rjust(24) for name in queueTypes))
+    for producers in args.producers:
+        results = [measure(queueType, args.requests, producers, contents) for queueType in queueTypes.values()]
+        print(str(producers).rjust(10), *(("%.0f req/s" % result).rjust(24) for result in results))
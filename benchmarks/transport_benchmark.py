@@ -0,0 +1,110 @@
+"""
+Compares the master transports (see NetWork.transport) by measuring how many
+requests per second the master can take from many connections at once.
+
+Client processes open connections to the master over loopback TCP, every connection
+sends requests as fast as the master answers them (with a limited number of requests
+in flight), the master answers every request as soon as it's received.
+
+Usage:
+
+    python3 benchmarks/transport_benchmark.py --connections 1 16 64 256 --requests 2000
+"""
+import os
+import sys
+import socket
+import time
+from argparse import ArgumentParser
+from multiprocessing import Process, Event
+from threading import Semaphore, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NetWork.networking import NWSocketTCP
+from NetWork.channel import Channel
+from NetWork.transport import transports
+
+REQUEST_TYPE = b"BEN"
+CLIENT_PROCESSES = 8
+
+
+def answer(channel, responseExpected, requestId, type, payload):
+    if responseExpected:
+        channel.respondRaw(requestId, payload)
+
+
+def runConnection(port, requests, window, payload):
+    rawSocket = socket.create_connection(("127.0.0.1", port))
+    connection = NWSocketTCP(rawSocket, ("127.0.0.1", port))
+    connection.setTimeout(None)
+    channel = Channel(connection)
+    channel.start()
+    inFlight = Semaphore(window)
+    pending = None
+    for i in range(requests):
+        inFlight.acquire()
+        pending = channel.requestRaw(REQUEST_TYPE, payload,
+                                     lambda response, error: inFlight.release())[1]
+    pending.wait()
+    channel.close()
+
+
+def runClient(port, connections, requests, window, payloadSize, start):
+    payload = b"x" * payloadSize
+    threads = [Thread(target=runConnection, args=(port, requests, window, payload))
+               for i in range(connections)]
+    start.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def measure(transportName, connections, requests, window, payloadSize):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(connections)
+    port = listener.getsockname()[1]
+    start = Event()
+    processCount = min(connections, CLIENT_PROCESSES)
+    clients = []
+    for i in range(processCount):
+        share = connections // processCount + (i < connections % processCount)
+        client = Process(target=runClient, args=(port, share, requests, window, payloadSize, start))
+        client.start()
+        clients.append(client)
+    transport = transports[transportName]()
+    channels = []
+    start.set()
+    began = time.perf_counter()
+    for i in range(connections):
+        rawSocket, address = listener.accept()
+        connection = NWSocketTCP(rawSocket, address)
+        connection.setTimeout(None)
+        channel = Channel(connection, answer)
+        transport.attach(channel)
+        channels.append(channel)
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - began
+    for channel in channels:
+        channel.close()
+    transport.stop()
+    listener.close()
+    return connections * requests / elapsed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Measure requests per second handled by the master transports")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 16, 64, 256],
+                        help="Numbers of connections to test with")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests sent on every connection")
+    parser.add_argument("--window", type=int, default=32, help="Requests in flight on every connection")
+    parser.add_argument("--payload", type=int, default=64, help="Size of every request in bytes")
+    parser.add_argument("--transports", nargs="+", default=sorted(transports), choices=sorted(transports))
+    args = parser.parse_args()
+    print("connections".rjust(12), *(name.rjust(14) for name in args.transports))
+    for connections in args.connections:
+        results = [measure(name, connections, args.requests, args.window, args.payload)
+                   for name in args.transports]
+        print(str(connections).rjust(12), *(("%.0f req/s" % result).rjust(14) for result in results))
@@ -4,16 +4,35 @@ It is responsible for running tasks and passing them data sent from the master.
 
 When it starts, it waits for the first message from the master, which should
 be COMCODE_CHECKALIVE and it responds with COMCODE_ISALIVE.
-Once the master is registered the mainloop starts receiving messages
-from the master. The messages start with a 3 letter code that determines
-their type, the mainloop reads that code and runs a handler function associated
-with that code. Core message codes can be seen in NetWork.commcodes.
+Once the master is registered the connection stays open and becomes a channel
+(see NetWork.channel) that carries all requests from the master and to the master.
+The requests start with a 3 letter code that determines their type, the server
+reads that code and runs a handler function associated with that code.
+Core message codes can be seen in NetWork.commcodes.
+If the connection breaks the master connects again and the new connection
+replaces the old one.
+Other workers of the workgroup also connect, starting with COMCODE_CHECKPEER, to relay
+broadcasts and to fetch stored objects (see NetWork.peers).
+Requests are handled by a fixed number of handler threads (--handler_threads),
+requests from one channel are handled one at a time in the order they arrived, so
+the master can send many requests without waiting for the responses, requests from
+different channels are handled in parallel. Handlers that wait for another computer
+(relaying a broadcast, fetching code or stored objects) send the request on and
+respond when the answer arrives, so the requests after them don't wait. Requests waiting to be handled are kept
+in a bounded queue for each channel (--handler_queue_length), when that queue is full
+the channel stops reading so the master has to wait instead of the server piling up requests.
+Tasks are run by a pool of processes that are started in advance and run many
+tasks each (see NetWork.workerprocess), its size is set with --pool_size.
 """
-from threading import Thread
+from threading import Thread, Lock, Condition, Timer
+from functools import partial
+from queue import Queue
+from collections import deque
 import atexit
 import pickle
+import time
 
-from NetWork.networking import COMCODE_CHECKALIVE, COMCODE_ISALIVE
+from NetWork.networking import COMCODE_CHECKALIVE, COMCODE_ISALIVE, COMCODE_CHECKPEER
 import NetWork.queue as queue
 import NetWork.event as event
 import NetWork.lock as lock
@@ -22,45 +41,303 @@ import NetWork.semaphore as semaphore
 import NetWork.netprint as netprint
 import NetWork.netobject as netobject
 import NetWork.task as task
+import NetWork.pull as pull
+import NetWork.codecache as codecache
+import NetWork.broadcastvalue as broadcastvalue
+import NetWork.objectstore as objectstore
+import NetWork.workerprocess as workerprocess
 from NetWork.request import Request
+from NetWork.channel import Channel
+from NetWork.commcodes import CMD_RELAY, CMD_SET_PEERS, CMD_WORKER_INFO
+from NetWork.broadcast import splitRoute, relayedRequests, RELAY_TIMEOUT_SHRINK
+from NetWork.placement import currentLoad
 from NetWork import networking
 from NetWork.args import getArgs
 from NetWork.autodiscovery import startDiscoveryServer
 import NetWork.request
+import NetWork.peers as peers
+
+
+LANE_WAIT = 0.1
 
 
 class BadRequestError(Exception): pass
 
 
-plugins = [event, queue, lock, manager, semaphore, netprint, netobject, task]
+plugins = [event, queue, lock, manager, semaphore, netprint, netobject, task, pull, codecache, broadcastvalue, objectstore]
 
 running = False
+masterChannel = None
+masterChannelLock = Lock()
+requestQueue = None
+laneLength = None
 
 
 def checkAlive(request):
-    if requestSocket.address == masterAddress:
-        request.respond(COMCODE_ISALIVE)
+    request.respond(COMCODE_ISALIVE)
+
+
+def workerInfo(request):
+    #Used by the master to decide how many tasks to give this worker
+    request.respond({"SLOTS": workerprocess.getPool().size, "LOAD": currentLoad()})
+
+
+def setPeers(request):
+    #Workers that are allowed to connect, the ID of this worker and
+    #whether other workers may ask it to relay broadcasts
+    peers.setPeers(request["PEERS"], request["SELF"])
+    if request["RELAY"]:
+        peers.acceptedRequests.add(CMD_RELAY)
+    else:
+        peers.acceptedRequests.discard(CMD_RELAY)
+
+
+def relayBroadcast(request):
+    #Handle a broadcast from the master and pass it on to the workers in its route,
+    #respond with the addresses of workers that it didn't reach, the workers in the route
+    #are given a shorter timeout so this one responds before whoever sent it the broadcast gives up
+    #The broadcast is handled here before the handler returns, the responses of the
+    #workers in the route are collected by a Relay so the lane doesn't wait for them
+    type = request["TYPE"]
+    if not type in relayedRequests:
+        raise BadRequestError("Request " + str(type) + " can't be relayed")
+    payload = request["PAYLOAD"]
+    fanout = request["FANOUT"]
+    relay = Relay(request, time.monotonic() + request["TIMEOUT"])
+    request.defer()
+    for route in splitRoute(request["ROUTE"], fanout):
+        contents = {"TYPE": type, "PAYLOAD": payload, "ROUTE": route[1:], "FANOUT": fanout,
+                    "TIMEOUT": request["TIMEOUT"] * RELAY_TIMEOUT_SHRINK}
+        index = relay.add(route)
+        try:
+            channel = peers.getPeerChannel(route[0])
+            requestId = channel.requestRaw(CMD_RELAY, pickle.dumps(contents),
+                                           partial(relay.responded, index))[0]
+            relay.sent(index, channel, requestId)
+        except OSError as error:
+            relay.responded(index, None, error)
+    try:
+        handlers[type](Request(type, pickle.loads(payload), -1, responseExpected=False))
+    except Exception as error:
+        print("Failed to handle a broadcast", type, error)
+    relay.start()
+
 
-handlers = {b"ALV": checkAlive}
+class Relay:
+    #Responses of the workers a broadcast was passed on to, the broadcast is answered
+    #once all of them responded or when the deadline passes, whichever comes first
+    def __init__(self, request, deadline):
+        self.request = request
+        self.deadline = deadline
+        self.lock = Lock()
+        self.added = 0
+        self.routes = {}
+        self.requests = {}
+        self.failed = []
+        self.started = False
+        self.done = False
+        self.timer = None
+
+    def add(self, route):
+        self.lock.acquire()
+        index = self.added
+        self.added += 1
+        self.routes[index] = route
+        self.lock.release()
+        return index
+
+    def sent(self, index, channel, requestId):
+        self.lock.acquire()
+        if index in self.routes:
+            self.requests[index] = (channel, requestId)
+        self.lock.release()
+
+    def responded(self, index, payload, error):
+        self.lock.acquire()
+        route = self.routes.pop(index, None)
+        self.requests.pop(index, None)
+        if route is None or self.done:
+            self.lock.release()
+            return
+        if not error:
+            try:
+                self.failed.extend(pickle.loads(payload))
+            except Exception as failure:
+                error = failure
+        if error:
+            print("Relaying a broadcast through", route[0], "failed", error)
+            self.failed.extend(route)
+        self.finishIfAnswered()
+
+    def start(self):
+        #Called once the broadcast was sent to every route and handled here
+        self.lock.acquire()
+        self.started = True
+        if self.routes:
+            self.timer = Timer(max(self.deadline - time.monotonic(), 0), self.timedOut)
+            self.timer.daemon = True
+            self.timer.start()
+        self.finishIfAnswered()
+
+    def finishIfAnswered(self):
+        #Called with the lock held, releases it
+        if not self.started or self.routes or self.done:
+            self.lock.release()
+            return
+        self.done = True
+        if self.timer:
+            self.timer.cancel()
+        self.lock.release()
+        self.request.respond(self.failed)
+
+    def timedOut(self):
+        self.lock.acquire()
+        if self.done:
+            self.lock.release()
+            return
+        self.done = True
+        for index, route in self.routes.items():
+            print("Relaying a broadcast through", route[0], "failed, no response arrived in time")
+            self.failed.extend(route)
+            if index in self.requests:
+                channel, requestId = self.requests[index]
+                channel.forget(requestId)
+        self.routes.clear()
+        self.lock.release()
+        self.request.respond(self.failed)
+
+handlers = {b"ALV": checkAlive, CMD_SET_PEERS: setPeers, CMD_RELAY: relayBroadcast,
+            CMD_WORKER_INFO: workerInfo}
 
 
 def requestHandler(request):
-    handlers[request.getType()](request)
+    try:
+        handlers[request.getType()](request)
+    except Exception as error:
+        print("Failed to handle a request", request.getType(), error)
+        if request.responseExpected and not request.responseSent:
+            request.channel.respondError(request.requestId, str(error))
+            request.responseSent = True
     request.close()
 
 
-def requestReceiver(requestSocket):
+class Lane:
+    #Requests from one channel, handled one at a time in the order they arrived
+    #by whichever handler thread is free, a lane with requests waits in requestQueue
+    def __init__(self, channel):
+        self.channel = channel
+        self.requests = deque()
+        self.condition = Condition()
+        self.scheduled = False
+
+    def put(self, request):
+        #Blocks the channel reader while the lane is full, unless something on this
+        #worker waits for a response on the channel, the reader has to pass it on
+        self.condition.acquire()
+        while len(self.requests) >= laneLength and not self.channel.pending:
+            self.condition.wait(LANE_WAIT)
+        self.requests.append(request)
+        schedule = not self.scheduled
+        self.scheduled = True
+        self.condition.release()
+        if schedule:
+            requestQueue.put(self)
+
+    def run(self):
+        self.condition.acquire()
+        while self.requests:
+            request = self.requests.popleft()
+            self.condition.notify()
+            self.condition.release()
+            requestHandler(request)
+            self.condition.acquire()
+        self.scheduled = False
+        self.condition.release()
+
+
+def handlerThread():
+    while True:
+        requestQueue.get().run()
+
+
+def startHandlerThreads(threadCount, queueLength):
+    global requestQueue, laneLength
+    requestQueue = Queue()
+    laneLength = queueLength
+    for i in range(threadCount):
+        newThread = Thread(target=handlerThread)
+        newThread.daemon = True
+        newThread.start()
+
+
+def masterRequestReceived(channel, responseExpected, requestId, type, payload):
+    #Called for every request that arrives from the master
+    if not type in handlers:
+        print("Request came with an invalid identifier code", type)
+        if responseExpected:
+            channel.respondError(requestId, "Invalid identifier code " + str(type))
+        return
+    request = Request(type, pickle.loads(payload), -1, channel, requestId,
+                      responseExpected=responseExpected)
+    channel.lane.put(request)
+
+
+def openMasterChannel(masterSocket):
+    #All requests from the master and to the master go through this channel,
+    #if the master connects again the old channel is replaced
+    global masterChannel
+    masterSocket.setTimeout(None)
+    channel = Channel(masterSocket, masterRequestReceived)
+    channel.lane = Lane(channel)
+    masterChannelLock.acquire()
+    oldChannel = masterChannel
+    masterChannel = channel
+    NetWork.request.setUp(channel=channel)
+    masterChannelLock.release()
+    channel.start()
+    if oldChannel:
+        oldChannel.close()
+    task.resendFinishedReports()
+    pull.masterConnected.set()
+
+
+def peerRequestReceived(channel, responseExpected, requestId, type, payload):
+    #Other workers can only send some requests
+    if not type in peers.acceptedRequests:
+        print("A worker sent a request that workers can't send", type)
+        if responseExpected:
+            channel.respondError(requestId, "Request " + str(type) + " is not accepted from workers")
+        return
+    masterRequestReceived(channel, responseExpected, requestId, type, payload)
+
+
+def openPeerChannel(peerSocket):
+    peerSocket.setTimeout(None)
+    channel = Channel(peerSocket, peerRequestReceived)
+    channel.lane = Lane(channel)
+    channel.start()
+
+
+def connectionReceiver(requestSocket):
+    #Every connection from the master starts with COMCODE_CHECKALIVE and
+    #every connection from another worker with COMCODE_CHECKPEER
     try:
         receivedData = requestSocket.recv()
+        if receivedData == COMCODE_CHECKALIVE and requestSocket.address == masterAddress:
+            openChannel = openMasterChannel
+        elif receivedData == COMCODE_CHECKPEER and requestSocket.address in peers.allowed:
+            openChannel = openPeerChannel
+        else:
+            raise BadRequestError
+        requestSocket.send(COMCODE_ISALIVE)
     except OSError as error:
         print("Communication failed from", requestSocket.address, error)
-        return
-    if receivedData == b"ALV" and requestSocket.address == masterAddress:
-        requestSocket.send(COMCODE_ISALIVE)
-    elif not receivedData[:3] in handlers:
-        print("Request came with an invalid identifier code", receivedData[:3])
+        requestSocket.close()
+    except BadRequestError:
+        print("A request was received but it was not valid:", receivedData[:3])
+        requestSocket.close()
     else:
-        requestHandler(Request(receivedData[:3], pickle.loads(receivedData[3:]), -1, requestSocket))
+        openChannel(requestSocket)
 
 
 def onExit(listenerSocket):
@@ -78,6 +355,12 @@ if __name__ == "__main__":
         print("Failed to start listening on the network", error)
         listenerSocket.close()
         exit()
+    for plugin in plugins:
+        plugin.workerInit()
+        handlers.update(plugin.workerHandlers)
+    pool = workerprocess.startPool(args.pool_size, args.pool_max_tasks, args.pool_max_rss * 1024 * 1024)
+    atexit.register(pool.stop)
+    startHandlerThreads(args.handler_threads, args.handler_queue_length)
     masterRegistered = False
     if args.auto_discovery:
         startDiscoveryServer(args.auto_discovery_method)
@@ -89,17 +372,7 @@ if __name__ == "__main__":
                 #Register the master
                 requestSocket.send(COMCODE_ISALIVE)
                 masterAddress = requestSocket.address
-                if args.socket_type == "AES+HMAC":
-                    networking.masterAddress = (masterAddress, args.master_hmac_key,
-                                                args.master_aes_key)
-                elif args.socket_type == "HMAC":
-                    networking.masterAddress = (masterAddress, args.master_hmac_key)
-                elif args.socket_type == "AES":
-                    networking.masterAddress = (masterAddress, args.master_aes_key)
-                else:
-                    networking.masterAddress = masterAddress
-                requestSocket.close()
-                NetWork.request.setUp()
+                openMasterChannel(requestSocket)
                 print("MASTER REGISTERED with address", masterAddress)
                 masterRegistered = True
             else:
@@ -111,9 +384,6 @@ if __name__ == "__main__":
             print("A request was received but it was not valid:", request)
         except KeyboardInterrupt:
             exit()
-    for plugin in plugins:
-        plugin.workerInit()
-        handlers.update(plugin.workerHandlers)
     #Start receiving requests
     running = True
     atexit.register(onExit, listenerSocket)
@@ -124,7 +394,8 @@ if __name__ == "__main__":
             except OSError as error:
                 print("There was a connection attempt but a network error occured", error)
                 continue
-            handlerThread = Thread(target=requestReceiver, args=(requestSocket,))
-            handlerThread.start()
+            receiverThread = Thread(target=connectionReceiver, args=(requestSocket,))
+            receiverThread.daemon = True
+            receiverThread.start()
     except KeyboardInterrupt:
         exit()
@@ -0,0 +1,37 @@
+"""
+Runs server.py on one loopback address, used by the tests to start many workers on
+one computer. Workers are told apart by their addresses, so the server listens on the
+given address and also connects to other workers from it.
+
+Usage:
+
+    python3 tests/runworker.py 127.0.0.2 --pool_size 2
+"""
+import os
+import runpy
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import NetWork.networking as networking
+
+
+def bindTo(address):
+    connect = networking.NWSocketTCP.connect
+
+    def boundConnect(self, *args, **kwargs):
+        try:
+            self.internalSocket.bind((address, 0))
+        except OSError:
+            pass
+        connect(self, *args, **kwargs)
+    networking.NWSocketTCP.connect = boundConnect
+
+
+if __name__ == "__main__":
+    address = sys.argv.pop(1)
+    networking.DEFAULT_LISTENING_ADDRESS = address
+    bindTo(address)
+    sys.argv[0] = os.path.join(root, "server.py")
+    runpy.run_path(sys.argv[0], run_name="__main__")
@@ -0,0 +1,43 @@
+import pickle
+import unittest
+
+from workers import LocalWorkers
+
+
+def size(table):
+    return len(memoryview(table.value["blob"]))
+
+
+def firstBytes(table):
+    return bytes(memoryview(table.value["blob"])[:4])
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class BroadcastValueTest(unittest.TestCase):
+    def testOutOfBandBuffers(self):
+        #values with out-of-band buffers (numpy arrays and others) are sent to workers
+        blob = pickle.PickleBuffer(bytearray(b"abcd" * 1000000))
+        with workers.workgroup() as w:
+            table = w.broadcast({"blob": blob})
+            handlers = [w.submit(size, (table,)) for i in range(4)] + [w.submit(firstBytes, (table,))]
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+                self.assertFalse(handler.exceptionRaised(), handler.exception())
+            self.assertEqual([handler.result() for handler in handlers], [4000000] * 4 + [b"abcd"])
+            self.assertTrue(w.dispatcher.is_alive())
+            table.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
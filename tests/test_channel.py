@@ -0,0 +1,84 @@
+import pickle
+import socket
+import unittest
+from threading import Event
+
+import workers
+from NetWork.networking import NWSocketTCP
+from NetWork.channel import Channel, ChannelClosed, RemoteError, FRAME_HEADER, FRAME_REQUEST
+
+
+def channelPair(requestHandler=None):
+    first, second = socket.socketpair()
+    client = Channel(NWSocketTCP(first, "client"))
+    server = Channel(NWSocketTCP(second, "server"), requestHandler)
+    client.start()
+    server.start()
+    return client, server
+
+
+def echo(channel, responseExpected, requestId, type, payload):
+    if responseExpected:
+        channel.respondRaw(requestId, payload)
+
+
+class ChannelTest(unittest.TestCase):
+    def testRequests(self):
+        client, server = channelPair(echo)
+        self.assertEqual(client.request(b"ECH", {"A": 1}, 10), {"A": 1})
+        arrived = Event()
+        responses = []
+        client.requestRaw(b"ECH", pickle.dumps(2), lambda payload, error: (responses.append(pickle.loads(payload)),
+                                                                          arrived.set()))
+        self.assertTrue(arrived.wait(10))
+        self.assertEqual(responses, [2])
+        client.close()
+        server.close()
+
+    def testNotSentAfterClose(self):
+        #a request that wasn't sent raises, so it can be sent again on a new channel
+        client, server = channelPair(echo)
+        client.close()
+        self.assertRaises(ChannelClosed, client.requestRaw, b"ECH", pickle.dumps(1))
+        self.assertEqual(client.pending, {})
+        server.close()
+
+    def testSentRequestFailsWhenClosed(self):
+        #a request that was sent gets the error instead of being sent again
+        received = Event()
+        client, server = channelPair(lambda *request: received.set())
+        requestId, pending = client.requestRaw(b"NOP", pickle.dumps(1))
+        self.assertTrue(received.wait(10))
+        server.close()
+        self.assertRaises(ChannelClosed, pending.wait, 10)
+        client.close()
+
+    def assertClosesServer(self, *parts):
+        closed = Event()
+        client, server = channelPair(echo)
+        server.closeHandler = lambda channel: closed.set()
+        client.socket.send(list(parts))
+        self.assertTrue(closed.wait(10))
+        client.close()
+
+    def testTruncatedFrame(self):
+        self.assertClosesServer(b"\x01")
+        self.assertClosesServer(FRAME_HEADER.pack(FRAME_REQUEST, 1), b"E")
+
+    def testUnknownFrameKind(self):
+        self.assertClosesServer(FRAME_HEADER.pack(99, 1))
+
+    def testBrokenRequest(self):
+        #a request that can't be unpickled gets an error, the channel stays open
+        def unpickle(channel, responseExpected, requestId, type, payload):
+            channel.respond(requestId, pickle.loads(payload))
+
+        client, server = channelPair(unpickle)
+        self.assertRaises(RemoteError, client.exchangeRaw, b"ECH", b"not a pickle", 10)
+        self.assertEqual(client.request(b"ECH", 1, 10), 1)
+        client.close()
+        server.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
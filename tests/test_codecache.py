@@ -0,0 +1,94 @@
+import gc
+import os
+import signal
+import time
+import unittest
+
+from workers import LocalWorkers
+import NetWork.codecache as codecache
+from NetWork.task import Task
+
+
+def compiled(source):
+    namespace = {}
+    exec(source, namespace)
+    return namespace["function"]
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(1).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class CodeCacheTest(unittest.TestCase):
+    def testDroppedWithTheCode(self):
+        #equal code compiled twice has one hash, it's kept while any of it is alive
+        first = compiled("def function(): return 'dropped'")
+        second = compiled("def function(): return 'dropped'")
+        codeHash = codecache.codeOf(first)[0]
+        self.assertEqual(codecache.codeOf(second)[0], codeHash)
+        first = None
+        gc.collect()
+        self.assertIn(codeHash, codecache.masterCode)
+        second = None
+        gc.collect()
+        self.assertNotIn(codeHash, codecache.masterCode)
+
+    def testKnownOnlyAfterSent(self):
+        function = compiled("def function(): return 'sent'")
+        task = codecache.prepareTask(Task(target=function), "worker")
+        self.assertTrue(task.shipCode)
+        #the first task wasn't sent, the next one still carries the code
+        task = codecache.prepareTask(Task(target=function), "worker")
+        self.assertTrue(task.shipCode)
+        codecache.codeSent(task, "worker")
+        self.assertFalse(codecache.prepareTask(Task(target=function), "worker").shipCode)
+        codeHash = task.codeHash
+        function = task = None
+        gc.collect()
+        self.assertNotIn(codeHash, codecache.knownCode["worker"])
+
+    def testCodeGoneFromTheMaster(self):
+        #the master thinks the worker has the code, the worker asks for it and
+        #the master doesn't have it anymore, the tasks fail instead of waiting forever
+        function = compiled("def function(): return 'gone'")
+        with workers.workgroup() as w:
+            codeHash, codeBytes = codecache.codeOf(function)
+            codecache.knownCode.setdefault(0, set()).add(codeHash)
+            del codecache.masterCode[codeHash]
+            try:
+                handlers = [w.submit(function)] + w.submitMany(function, [(), ()])
+                for handler in handlers:
+                    self.assertTrue(handler.wait(30))
+                    self.assertTrue(handler.exceptionRaised())
+                    self.assertIn("isn't on the master", str(handler.exception()))
+            finally:
+                codecache.masterCode[codeHash] = codeBytes
+
+    def testLockFreeAfterFork(self):
+        #a server thread holds the lock while a pool process is forked
+        codecache.lock.acquire()
+        pid = os.fork()
+        if pid == 0:
+            codecache.storeCode(b"forked", b"code")
+            os._exit(0)
+        codecache.lock.release()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                return
+            time.sleep(0.1)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.fail("The forked process waited for the lock")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import time
+import unittest
+
+from workers import LocalWorkers
+from NetWork.task import DependencyError
+
+
+def value(x):
+    return x
+
+
+def add(a, b):
+    return a + b
+
+
+def multiply(a, b):
+    return a * b
+
+
+def fail():
+    raise ValueError("failed on purpose")
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class DependencyTest(unittest.TestCase):
+    def assertDependencyFailed(self, handler):
+        self.assertTrue(handler.wait(30))
+        self.assertTrue(handler.exceptionRaised())
+        self.assertIsInstance(handler.exception(), DependencyError)
+
+    def testDiamond(self):
+        for scheduling in ("push", "pull"):
+            with workers.workgroup(scheduling=scheduling) as w:
+                first = w.submit(value, (2,))
+                left = w.submit(add, (first.output(), 1))
+                right = w.submit(multiply, (first.output(), 10))
+                last = w.submit(add, (left.output(), right.output()))
+                self.assertTrue(last.wait(30))
+                self.assertFalse(last.exceptionRaised(), last.exception())
+                self.assertEqual(last.result(), 23)
+
+    def testFailedDependency(self):
+        with workers.workgroup() as w:
+            failed = w.submit(fail)
+            dependent = w.submit(add, (failed.output(), 1))
+            after = w.submit(value, (1,), after=[dependent])
+            self.assertDependencyFailed(dependent)
+            self.assertDependencyFailed(after)
+            self.assertIsInstance(failed.exception(), ValueError)
+
+    def testTerminatedDependency(self):
+        with workers.workgroup() as w:
+            running = w.submit(sleep, (30,))
+            dependent = w.submit(value, (1,), after=[running])
+            time.sleep(0.5)
+            running.terminate()
+            self.assertDependencyFailed(dependent)
+            self.assertFalse(running.exceptionRaised())
+
+    def testTerminatedWaitingTask(self):
+        with workers.workgroup() as w:
+            running = w.submit(sleep, (30,))
+            waiting = w.submit(value, (1,), after=[running])
+            dependent = w.submit(value, (2,), after=[waiting])
+            waiting.terminate()
+            self.assertDependencyFailed(dependent)
+            running.terminate()
+            self.assertTrue(running.wait(30))
+
+
+if __name__ == "__main__":
+    unittest.main()
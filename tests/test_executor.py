@@ -0,0 +1,94 @@
+import time
+import unittest
+from concurrent.futures import TimeoutError
+
+from workers import LocalWorkers
+from NetWork import Executor
+
+
+def square(x):
+    return x * x
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class ExecutorTest(unittest.TestCase):
+    def testSubmit(self):
+        with workers.workgroup() as w:
+            with Executor(w) as executor:
+                futures = [executor.submit(square, i) for i in range(10)]
+                self.assertEqual([future.result(30) for future in futures], [i * i for i in range(10)])
+
+    def testExceptionsReachFutures(self):
+        with workers.workgroup() as w:
+            with Executor(w) as executor:
+                future = executor.submit(fail, "from the task")
+                self.assertIsInstance(future.exception(30), ValueError)
+                with self.assertRaises(ValueError) as raised:
+                    future.result(30)
+                self.assertIn("from the task", str(raised.exception))
+
+    def testMap(self):
+        with workers.workgroup() as w:
+            with Executor(w) as executor:
+                self.assertEqual(list(executor.map(square, range(10), timeout=30)), [i * i for i in range(10)])
+
+    def testMapTimeout(self):
+        with workers.workgroup() as w:
+            with Executor(w) as executor:
+                results = executor.map(sleep, [0, 3], timeout=1)
+                self.assertEqual(next(results), 0)
+                with self.assertRaises(TimeoutError):
+                    next(results)
+
+    def testShutdownWaits(self):
+        with workers.workgroup() as w:
+            executor = Executor(w)
+            futures = [executor.submit(sleep, 0.5) for i in range(4)]
+            executor.shutdown(wait=True)
+            self.assertTrue(all(future.done() for future in futures))
+            self.assertEqual([future.result() for future in futures], [0.5] * 4)
+            with self.assertRaises(RuntimeError):
+                executor.submit(square, 1)
+
+    def testShutdownWithoutWaiting(self):
+        #the tasks keep running and their futures are completed later
+        with workers.workgroup() as w:
+            executor = Executor(w)
+            future = executor.submit(sleep, 1)
+            executor.shutdown(wait=False)
+            self.assertFalse(future.done())
+            self.assertEqual(future.result(30), 1)
+
+    def testCancelFuturesIsIgnored(self):
+        #submitted tasks are already running, their futures can't be cancelled
+        with workers.workgroup() as w:
+            executor = Executor(w)
+            future = executor.submit(sleep, 0.5)
+            self.assertFalse(future.cancel())
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.assertFalse(future.cancelled())
+            self.assertEqual(future.result(), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
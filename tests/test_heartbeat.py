@@ -0,0 +1,49 @@
+import time
+import unittest
+
+from workers import LocalWorkers
+import NetWork.worker as worker
+from NetWork.worker import DeadWorkerError
+from NetWork.cntcodes import CNT_TASK_EXECUTORS
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+workers = None
+heartbeat = None
+
+
+def setUpModule():
+    global workers, heartbeat
+    heartbeat = worker.HEARTBEAT_INTERVAL, worker.HEARTBEAT_TIMEOUT
+    worker.HEARTBEAT_INTERVAL, worker.HEARTBEAT_TIMEOUT = 0.2, 1.0
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    worker.HEARTBEAT_INTERVAL, worker.HEARTBEAT_TIMEOUT = heartbeat
+    workers.__exit__(None, None, None)
+
+
+class HeartbeatTest(unittest.TestCase):
+    def testIdleWorkersStayAlive(self):
+        with workers.workgroup() as w:
+            time.sleep(3)
+            self.assertEqual(w.deadWorkers(), set())
+
+    def testStalledWorker(self):
+        #the connection stays open but the worker doesn't answer anymore
+        with workers.workgroup() as w:
+            handler = w.submit(sleep, (60,))
+            time.sleep(0.5)
+            workerId = w.controls[CNT_TASK_EXECUTORS][handler.id]
+            workers.stop(workers.addresses[workerId])
+            self.assertTrue(handler.wait(30))
+            self.assertIsInstance(handler.exception(), DeadWorkerError)
+            self.assertEqual(w.deadWorkers(), {workerId})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import pickle
+import time
+import unittest
+from threading import Event
+
+from workers import LocalWorkers
+from NetWork.commcodes import CMD_RELAY
+from NetWork.broadcastvalue import CMD_RELEASE_VALUE
+from NetWork.networking import COMCODE_ISALIVE
+from NetWork.cntcodes import CNT_TASK_EXECUTORS
+
+
+def size(table):
+    return len(table.value)
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class LaneTest(unittest.TestCase):
+    def testRelayDoesntHoldTheLane(self):
+        #the worker a broadcast is relayed to stalls, the requests sent after
+        #the broadcast are still handled while the relay waits for it
+        responses = {}
+        arrived = {"RELAY": Event(), "ALIVE": Event()}
+
+        def responseReceived(name, response, error):
+            responses[name] = (response, error, time.monotonic())
+            arrived[name].set()
+
+        with workers.workgroup(relayFanout=1) as w:
+            #the relay opens the channel between the workers before one of them stalls
+            table = w.broadcast(list(range(10)))
+            handlers = [w.submit(size, (table,)) for i in range(6)]
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+            self.assertEqual(len(set(w.controls[CNT_TASK_EXECUTORS][handler.id] for handler in handlers)), 2)
+            table.release()
+            workers.stop(workers.addresses[1])
+            sent = time.monotonic()
+            w.workerList[0].sendRequestWithResponse(CMD_RELAY,
+                                                    {
+                                                        "TYPE": CMD_RELEASE_VALUE,
+                                                        "PAYLOAD": pickle.dumps({"KEY": "missing"}),
+                                                        "ROUTE": workers.addresses[1:],
+                                                        "FANOUT": 1,
+                                                        "TIMEOUT": 5.0
+                                                    },
+                                                    lambda response, error: responseReceived("RELAY", response, error))
+            w.workerList[0].sendRequestWithResponse(b"ALV", {},
+                                                    lambda response, error: responseReceived("ALIVE", response, error))
+            self.assertTrue(arrived["ALIVE"].wait(30))
+            self.assertEqual(responses["ALIVE"][0], COMCODE_ISALIVE)
+            self.assertLess(responses["ALIVE"][2] - sent, 3)
+            self.assertTrue(arrived["RELAY"].wait(30))
+            self.assertEqual(responses["RELAY"][:2], (workers.addresses[1:], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+
+from workers import LocalWorkers
+from NetWork import Lock, Semaphore, Queue, Event
+import NetWork.lock
+import NetWork.semaphore
+import NetWork.queue
+
+
+def holdForever(tool, acquired):
+    tool.acquire()
+    acquired.set()
+    time.sleep(300)
+
+
+def acquireAndRelease(tool):
+    tool.acquire()
+    tool.release()
+    return True
+
+
+def getForever(queue, waiting):
+    waiting.set()
+    return queue.get()
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class KilledTaskTest(unittest.TestCase):
+    def assertReleasedAfterTerminate(self, w, tool):
+        acquired = Event(w)
+        holder = w.submit(holdForever, (tool, acquired))
+        acquired.wait()
+        holder.terminate()
+        self.assertTrue(holder.wait(30))
+        next = w.submit(acquireAndRelease, (tool,))
+        self.assertTrue(next.wait(30))
+        self.assertFalse(next.exceptionRaised(), next.exception())
+        self.assertTrue(next.result())
+
+    def testLockReleased(self):
+        with workers.workgroup() as w:
+            self.assertReleasedAfterTerminate(w, Lock(w))
+
+    def testSemaphoreReleased(self):
+        with workers.workgroup() as w:
+            self.assertReleasedAfterTerminate(w, Semaphore(w, 1))
+
+    def testQueueWaiterForgotten(self):
+        #an item put after the getter was killed stays on the queue
+        with workers.workgroup() as w:
+            queue = Queue(w)
+            waiting = Event(w)
+            getter = w.submit(getForever, (queue, waiting))
+            waiting.wait()
+            time.sleep(0.5)
+            getter.terminate()
+            self.assertTrue(getter.wait(30))
+            queue.put(1)
+            self.assertEqual(queue.get(), 1)
+
+
+class FakeRequest(dict):
+    #An acquire or get request, one that isn't reachable fails to get the response
+    def __init__(self, taskId, reachable=True):
+        dict.__init__(self, TASK=taskId)
+        self.reachable = reachable
+        self.responses = []
+
+    def abandoned(self):
+        return False
+
+    def respond(self, response):
+        if self.reachable:
+            self.responses.append(response)
+        return self.reachable
+
+
+class UnsentResponseTest(unittest.TestCase):
+    #the connection of a waiter broke but the master didn't notice yet
+    def setUp(self):
+        for module, name in ((NetWork.lock, "lockLocks"), (NetWork.semaphore, "semaphoreLocks")):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, {0: threading.Lock()})
+
+    def testLock(self):
+        handler = NetWork.lock.MasterLockHandler(0)
+        handler.acquire(FakeRequest(None, False))
+        self.assertFalse(handler.locked)
+        handler.acquire(FakeRequest(1))
+        handler.acquire(FakeRequest(2, False))
+        waiter = FakeRequest(3)
+        handler.acquire(waiter)
+        handler.release()
+        self.assertEqual(handler.owner, 3)
+        self.assertEqual(waiter.responses, [True])
+        handler.release()
+        self.assertFalse(handler.locked)
+
+    def testSemaphore(self):
+        handler = NetWork.semaphore.MasterSemaphoreHandler(0, 1)
+        handler.acquire(FakeRequest(None, False))
+        self.assertEqual((handler.value, handler.holders), (1, []))
+        handler.acquire(FakeRequest(1))
+        handler.acquire(FakeRequest(2, False))
+        waiter = FakeRequest(3)
+        handler.acquire(waiter)
+        handler.release(1)
+        self.assertEqual(handler.holders, [3])
+        self.assertEqual(waiter.responses, [True])
+        handler.release(3)
+        self.assertEqual((handler.value, handler.holders), (1, []))
+
+    def testQueue(self):
+        handler = NetWork.queue.MasterQueueHandler(0)
+        handler.putWaiter(FakeRequest(1, False))
+        handler.putItem("first")
+        handler.distributeContents(None)
+        self.assertEqual(handler.items, ["first"])
+        waiter = FakeRequest(2)
+        handler.putWaiter(FakeRequest(3, False))
+        handler.putWaiter(waiter)
+        handler.distributeContents(None)
+        self.assertEqual(waiter.responses, ["first"])
+        self.assertEqual(handler.items, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import time
+import unittest
+
+from workers import LocalWorkers
+
+
+def square(x):
+    return x * x
+
+
+def slowFirst(x):
+    if x == 0:
+        time.sleep(2)
+    return x
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class MapTest(unittest.TestCase):
+    def testResults(self):
+        with workers.workgroup() as w:
+            self.assertEqual(w.map(square, range(100)), [x * x for x in range(100)])
+            self.assertEqual(sorted(w.imap_unordered(square, range(100), chunksize=7)),
+                             [x * x for x in range(100)])
+
+    def testSlowChunkHoldsTheWindow(self):
+        #chunks that finish before a slow one wait for it instead of making room for more
+        taken = []
+
+        def items():
+            for x in range(1000):
+                taken.append(x)
+                yield x
+
+        with workers.workgroup() as w:
+            results = w.imap(slowFirst, items(), chunksize=1, window=3)
+            self.assertEqual(next(results), 0)
+            self.assertLessEqual(len(taken), 4)
+            self.assertEqual(list(results), list(range(1, 1000)))
+
+    def testBadWindow(self):
+        with workers.workgroup() as w:
+            self.assertRaises(ValueError, w.imap, square, range(10), None, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
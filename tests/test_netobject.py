@@ -0,0 +1,47 @@
+import unittest
+
+from workers import LocalWorkers
+from NetWork import NetObject
+from NetWork.cntcodes import CNT_TASK_EXECUTORS
+
+
+class Counter:
+    def __init__(self, start):
+        self.start = start
+
+    def next(self):
+        return self.start + 1
+
+
+def nextOf(counter):
+    return counter.next()
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class NetObjectTest(unittest.TestCase):
+    def testClassesReachJoinedWorkers(self):
+        #the class was registered before the second worker joined
+        with workers.workgroup(workers.addresses[:1]) as w:
+            counter = NetObject(Counter, w)(1)
+            w.addWorker(workers.addresses[1])
+            handlers = [w.submit(nextOf, (counter,), affinity=key) for key in range(20)]
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+                self.assertFalse(handler.exceptionRaised(), handler.exception())
+            self.assertEqual([handler.result() for handler in handlers], [2] * 20)
+            self.assertEqual(set(w.controls[CNT_TASK_EXECUTORS][handler.id] for handler in handlers), {0, 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
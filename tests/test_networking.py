@@ -0,0 +1,61 @@
+import socket
+import unittest
+
+import workers
+from NetWork import networking
+from NetWork.networking import (NWSocketTCP, NWSocketHMAC, MessageAssembler, BINARY_LENGTH_HEADER,
+                                HEADER_TAG_LENGTH, LengthIndicatorTooLong, UnauthenticatedMessage, KeyNotSet)
+
+
+def socketPair(socketClass, *parameters):
+    first, second = socket.socketpair()
+    return socketClass(first, *parameters), socketClass(second, *parameters)
+
+
+class MessageLengthTest(unittest.TestCase):
+    def testTooLong(self):
+        sender, receiver = socketPair(NWSocketTCP)
+        receiver.maxMessageLength = 100
+        sender.send(b"x" * 100)
+        self.assertEqual(receiver.recv(), b"x" * 100)
+        sender.send(b"x" * 101)
+        self.assertRaises(LengthIndicatorTooLong, receiver.recv)
+
+    def testHMACRoundTrip(self):
+        sender, receiver = socketPair(NWSocketHMAC, ("127.0.0.1", b"key"))
+        sender.send([b"abc", b"def"])
+        self.assertEqual(bytes(receiver.recv()), b"abcdef")
+        sender.send(b"ghi")
+        data = receiver.internalSocket.recv(1024)
+        self.assertEqual([bytes(receiver.decode(message)) for message in MessageAssembler(receiver).feed(data)],
+                         [b"ghi"])
+
+    def testForgedLength(self):
+        #the length is checked before a buffer for the message is allocated
+        sender, receiver = socketPair(NWSocketHMAC, ("127.0.0.1", b"key"))
+        sender.internalSocket.sendall(BINARY_LENGTH_HEADER.pack(2 ** 39) + b"\0" * HEADER_TAG_LENGTH)
+        self.assertRaises(UnauthenticatedMessage, receiver.recv)
+        self.assertRaises(UnauthenticatedMessage, MessageAssembler(receiver).feed,
+                          BINARY_LENGTH_HEADER.pack(2 ** 39) + b"\0" * HEADER_TAG_LENGTH)
+
+    def testWrongKey(self):
+        sender, receiver = socketPair(NWSocketHMAC, ("127.0.0.1", b"key"))
+        sender.HMACKey = b"other key"
+        sender.send(b"abc")
+        self.assertRaises(UnauthenticatedMessage, receiver.recv)
+
+
+class SetUpTest(unittest.TestCase):
+    def testListenerKeyRequired(self):
+        #only a master, which never listens, may leave the listener key out
+        self.addCleanup(setattr, networking, "NWSocket", networking.NWSocket)
+        self.addCleanup(setattr, NWSocketHMAC, "listenerHMAC", NWSocketHMAC.listenerHMAC)
+        self.assertRaises(KeyNotSet, networking.setUp, "HMAC", {})
+        networking.setUp("HMAC", {}, listening=False)
+        self.assertIsNone(NWSocketHMAC.listenerHMAC)
+        networking.setUp("HMAC", {"ListenerHMAC": b"key"})
+        self.assertEqual(NWSocketHMAC.listenerHMAC, b"key")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import random
+import unittest
+
+import workers
+from NetWork.placement import HashRing, RoundRobin, LeastOutstanding, CapacityWeighted, PowerOfTwoChoices
+
+
+class FakeWorker:
+    def __init__(self, id):
+        self.id = id
+        self.address = "10.0.0." + str(id + 1)
+        self.alive = True
+
+
+def owners(ring, liveWorkers, keys):
+    return {key: ring.select(liveWorkers, key) for key in keys}
+
+
+class HashRingTest(unittest.TestCase):
+    keys = ["key" + str(i) for i in range(2000)]
+
+    def testKeysMoveOnlyToJoinedWorker(self):
+        ring = HashRing()
+        liveWorkers = [FakeWorker(i) for i in range(3)]
+        before = owners(ring, liveWorkers, self.keys)
+        after = owners(ring, liveWorkers + [FakeWorker(3)], self.keys)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertEqual(set(after[key] for key in moved), {3})
+
+    def testKeysMoveOnlyFromDeadWorker(self):
+        ring = HashRing()
+        liveWorkers = [FakeWorker(i) for i in range(4)]
+        before = owners(ring, liveWorkers, self.keys)
+        after = owners(ring, liveWorkers[:1] + liveWorkers[2:], self.keys)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertEqual(set(before[key] for key in moved), {1})
+        self.assertEqual(len(moved), list(before.values()).count(1))
+
+    def testSameAfterRejoining(self):
+        ring = HashRing()
+        liveWorkers = [FakeWorker(i) for i in range(3)]
+        before = owners(ring, liveWorkers, self.keys)
+        owners(ring, liveWorkers[1:], self.keys)
+        self.assertEqual(owners(ring, liveWorkers, self.keys), before)
+
+
+def run(placement, liveWorkers, count):
+    #Start count tasks, none of them finishes, return the number each worker got
+    given = {worker.id: 0 for worker in liveWorkers}
+    for i in range(count):
+        workerId = placement.select(liveWorkers)
+        placement.taskStarted(workerId)
+        given[workerId] += 1
+    return given
+
+
+class PlacementTest(unittest.TestCase):
+    def setUp(self):
+        self.liveWorkers = [FakeWorker(i) for i in range(3)]
+        self.addCleanup(random.setstate, random.getstate())
+
+    def testRoundRobin(self):
+        placement = RoundRobin()
+        placement.outstanding = {0: 10}
+        self.assertEqual([placement.select(self.liveWorkers) for i in range(6)], [0, 1, 2, 0, 1, 2])
+
+    def testLeastOutstanding(self):
+        placement = LeastOutstanding()
+        self.assertEqual(run(placement, self.liveWorkers, 9), {0: 3, 1: 3, 2: 3})
+        placement.taskFinished(1)
+        placement.taskFinished(1)
+        self.assertEqual(placement.select(self.liveWorkers), 1)
+
+    def testCapacityWeighted(self):
+        #a worker with 8 times more slots gets 8 times more tasks
+        placement = CapacityWeighted()
+        placement.workerInfo(0, {"SLOTS": 8, "LOAD": 0.0})
+        placement.workerInfo(1, {"SLOTS": 64, "LOAD": 0.0})
+        self.assertEqual(run(placement, self.liveWorkers[:2], 72), {0: 8, 1: 64})
+
+    def testCapacityWeightedAvoidsLoadedWorkers(self):
+        placement = CapacityWeighted()
+        for worker in self.liveWorkers:
+            placement.workerInfo(worker.id, {"SLOTS": 4, "LOAD": 0.0})
+        placement.taskFinished(2, 3.0)
+        given = run(placement, self.liveWorkers, 8)
+        self.assertEqual(given[2], 0)
+        self.assertEqual(given[0] + given[1], 8)
+
+    def testPowerOfTwoChoices(self):
+        #of the two workers compared the less busy one gets the task
+        placement = PowerOfTwoChoices()
+        placement.outstanding = {0: 10}
+        given = run(placement, self.liveWorkers[:2], 10)
+        self.assertEqual(given, {0: 0, 1: 10})
+        self.assertEqual(placement.select(self.liveWorkers[:1]), 0)
+
+    def testPowerOfTwoChoicesSpreadsTasks(self):
+        random.seed(1)
+        placement = PowerOfTwoChoices()
+        given = run(placement, self.liveWorkers, 30)
+        self.assertLessEqual(max(given.values()) - min(given.values()), 2)
+
+    def testCounts(self):
+        #every started task is counted until it finishes, counts don't go below zero
+        placement = LeastOutstanding()
+        run(placement, self.liveWorkers, 6)
+        self.assertEqual(placement.outstanding, {0: 2, 1: 2, 2: 2})
+        for worker in self.liveWorkers:
+            placement.taskFinished(worker.id, 0.5)
+            placement.taskFinished(worker.id)
+        self.assertEqual(placement.outstanding, {0: 0, 1: 0, 2: 0})
+        placement.taskFinished(0)
+        self.assertEqual(placement.outstanding[0], 0)
+        self.assertEqual(placement.load, {0: 0.5, 1: 0.5, 2: 0.5})
+
+    def testSlotsReported(self):
+        placement = CapacityWeighted()
+        placement.workerInfo(0, {"SLOTS": 0, "LOAD": 0.25})
+        self.assertEqual(placement.slots[0], 1)
+        self.assertEqual(placement.load[0], 0.25)
+
+    def testDataMovesTasks(self):
+        #a task goes to the worker holding its inputs unless that worker is much busier
+        placement = LeastOutstanding()
+        placement.outstanding = {0: 0, 1: 2, 2: 0}
+        self.assertEqual(placement.selectFor(self.liveWorkers, {1: 1024 ** 3}), 1)
+        self.assertIn(placement.selectFor(self.liveWorkers, {1: 1024}), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
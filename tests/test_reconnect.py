@@ -0,0 +1,63 @@
+import time
+import unittest
+from threading import Event
+
+from workers import LocalWorkers
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(1).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class ReconnectTest(unittest.TestCase):
+    def testFinishedWhileDisconnected(self):
+        #the task finishes while the master isn't connected, the worker
+        #tells the master about it once the master connects again
+        with workers.workgroup() as w:
+            handler = w.submit(sleep, (1,))
+            self.assertTrue(w.submit(sleep, (0,)).wait(30))
+            worker = w.workerList[0]
+            #everything queued before is sent, the master can't connect again until reconnect is set
+            held = Event()
+            reconnect = Event()
+            worker.outbox.put(lambda: held.set() or reconnect.wait())
+            try:
+                self.assertTrue(held.wait(30))
+                worker.channel.abort(ConnectionResetError("Closed by the test"))
+                time.sleep(2)
+                self.assertFalse(handler.wait(0))
+            finally:
+                reconnect.set()
+            self.assertTrue(handler.wait(30))
+            self.assertEqual(handler.result(), 1)
+            self.assertEqual(w.deadWorkers(), set())
+
+    def testPullingAcrossReconnects(self):
+        #the connection breaks while the worker waits for the master to give it tasks
+        with workers.workgroup(scheduling="pull") as w:
+            self.assertTrue(w.submit(sleep, (0,)).wait(30))
+            time.sleep(0.5)
+            w.workerList[0].channel.abort(ConnectionResetError("Closed by the test"))
+            time.sleep(0.5)
+            handlers = [w.submit(sleep, (0.2,)) for i in range(20)]
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+            self.assertEqual([handler.result() for handler in handlers], [0.2] * 20)
+            self.assertEqual(w.deadWorkers(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import pickle
+import unittest
+from threading import Event
+
+from workers import LocalWorkers
+from NetWork.commcodes import CMD_RELAY, CMD_SET_PEERS
+
+
+def size(table):
+    return len(table.value)
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(3).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class RelayTest(unittest.TestCase):
+    def testRelayedBroadcast(self):
+        #with a fanout of 1 the broadcast goes from one worker to the next
+        with workers.workgroup(relayFanout=1) as w:
+            table = w.broadcast(list(range(1000)))
+            handlers = [w.submit(size, (table,)) for i in range(6)]
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+                self.assertFalse(handler.exceptionRaised(), handler.exception())
+            self.assertEqual([handler.result() for handler in handlers], [1000] * 6)
+            self.assertEqual(w.deadWorkers(), set())
+            table.release()
+
+    def testOnlyBroadcastsAreRelayed(self):
+        #a worker refuses to relay requests that tools don't broadcast
+        responses = []
+        arrived = Event()
+
+        def responseReceived(response, error):
+            responses.append((response, error))
+            arrived.set()
+
+        with workers.workgroup(relayFanout=1) as w:
+            w.workerList[0].sendRequestWithResponse(CMD_RELAY,
+                                                    {
+                                                        "TYPE": CMD_SET_PEERS,
+                                                        "PAYLOAD": pickle.dumps({"PEERS": [], "SELF": 0,
+                                                                                 "RELAY": False}),
+                                                        "ROUTE": workers.addresses[1:],
+                                                        "FANOUT": 1,
+                                                        "TIMEOUT": 5.0
+                                                    },
+                                                    responseReceived)
+            self.assertTrue(arrived.wait(30))
+            response, error = responses[0]
+            self.assertIsNone(response)
+            self.assertIn("can't be relayed", str(error))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from threading import Thread
+
+from workers import LocalWorkers
+from NetWork.cntcodes import CNT_TASK_EXECUTORS
+
+
+def add(a, b):
+    return a + b
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class SubmitTest(unittest.TestCase):
+    def testSubmitMany(self):
+        for scheduling in ("push", "pull"):
+            with workers.workgroup(scheduling=scheduling) as w:
+                handlers = w.submitMany(add, [(i,) for i in range(50)], {"b": 1})
+                for handler in handlers:
+                    self.assertTrue(handler.wait(30))
+                self.assertEqual([handler.result() for handler in handlers], list(range(1, 51)))
+                self.assertEqual(set(w.controls[CNT_TASK_EXECUTORS][handler.id] for handler in handlers), {0, 1})
+
+    def testSubmittedFromManyThreads(self):
+        #every task gets its own id
+        with workers.workgroup() as w:
+            handlers = []
+
+            def submitter(first):
+                submitted = w.submitMany(add, [(first + i, 0) for i in range(50)])
+                submitted += [w.submit(add, (first + 50 + i, 0)) for i in range(50)]
+                handlers.extend(submitted)
+            submitters = [Thread(target=submitter, args=(100 * i,)) for i in range(8)]
+            for thread in submitters:
+                thread.start()
+            for thread in submitters:
+                thread.join()
+            self.assertEqual(len(set(handler.id for handler in handlers)), 800)
+            for handler in handlers:
+                self.assertTrue(handler.wait(30))
+            self.assertEqual(sorted(handler.result() for handler in handlers), list(range(800)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import gc
+import unittest
+from queue import Queue
+
+from workers import LocalWorkers
+import NetWork.task as task
+from NetWork.cntcodes import CNT_TASK_EXECUTORS
+from NetWork.channel import RemoteError
+
+
+def value(x):
+    return x
+
+
+def add(a, b):
+    return a + b
+
+
+def waitFor(handler):
+    return handler.wait(30)
+
+
+workers = None
+
+
+def setUpModule():
+    global workers
+    workers = LocalWorkers(2).__enter__()
+
+
+def tearDownModule():
+    workers.__exit__(None, None, None)
+
+
+class TaskStateTest(unittest.TestCase):
+    def testEvictedWhenHandlersAreGone(self):
+        with workers.workgroup() as w:
+            handlers = [w.submit(value, (i,)) for i in range(20)] + w.submitMany(value, [(i,) for i in range(20)])
+            self.assertTrue(all(handler.wait(30) for handler in handlers))
+            self.assertEqual(len(task.taskStates), 40)
+            handlers = None
+            gc.collect()
+            self.assertEqual(len(task.taskStates), 0)
+            self.assertEqual(w.controls[CNT_TASK_EXECUTORS], {-1: None})
+
+    def testDroppedOnTheWorker(self):
+        #the worker forgets a task once the master does, unless its result has a reference
+        with workers.workgroup(workers.addresses[:1]) as w:
+            forgotten = w.submit(value, (1,))
+            referenced = w.submit(value, (2,))
+            ref = referenced.ref()
+            self.assertTrue(forgotten.wait(30))
+            ids = forgotten.id, referenced.id
+            forgotten = referenced = None
+            gc.collect()
+            self.assertIsInstance(self.resultOnWorker(w, ids[0]), RemoteError)
+            self.assertEqual(self.resultOnWorker(w, ids[1]), 2)
+            self.assertEqual(ref.get(), 2)
+
+    def resultOnWorker(self, w, taskId):
+        #the worker's answer or the error, CMD_GET_RESULT fails once the worker dropped the task
+        responses = Queue()
+        w.workerList[0].sendRequestWithResponse(task.CMD_GET_RESULT, {"ID": taskId},
+                                                lambda response, error: responses.put(error or response))
+        return responses.get(timeout=30)
+
+    def testKeptForDependents(self):
+        #the handler of the first task is gone before the dependent task starts
+        with workers.workgroup() as w:
+            last = w.submit(add, (w.submit(value, (1,)).output(), 1))
+            gc.collect()
+            self.assertTrue(last.wait(30))
+            self.assertEqual(last.result(), 2)
+            last = None
+            gc.collect()
+            self.assertEqual(len(task.taskStates), 0)
+
+    def testKeptForSharedHandlers(self):
+        #a worker that got a handler can still ask about the task
+        with workers.workgroup() as w:
+            first = w.submit(value, (1,))
+            waiter = w.submit(waitFor, (first,))
+            self.assertTrue(waiter.wait(30))
+            self.assertTrue(waiter.result())
+            firstId = first.id
+            first = waiter = None
+            gc.collect()
+            self.assertIn(firstId, task.taskStates)
+
+
+if __name__ == "__main__":
+    unittest.main()
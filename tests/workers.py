@@ -0,0 +1,61 @@
+"""
+Starting worker servers on loopback addresses (127.0.0.2, 127.0.0.3...) for the tests,
+works where the whole 127.0.0.0/8 block is on the loopback interface (Linux).
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import NetWork.networking as networking
+from NetWork import Workgroup
+from NetWork.worker import WorkerUnavailableError
+
+networking.DEFAULT_LISTENING_ADDRESS = "127.0.0.1"
+STARTUP_TIMEOUT = 20.0
+
+
+class LocalWorkers:
+    #Worker servers running in subprocesses, stopped when the block ends
+    def __init__(self, count, poolSize=2):
+        self.addresses = ["127.0.0.%d" % (i + 2) for i in range(count)]
+        self.poolSize = poolSize
+        self.processes = {}
+
+    def start(self, address):
+        self.processes[address] = subprocess.Popen([sys.executable, os.path.join(root, "tests", "runworker.py"),
+                                                    address, "--pool_size", str(self.poolSize)],
+                                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def kill(self, address):
+        self.processes[address].kill()
+        self.processes[address].wait()
+
+    def stop(self, address):
+        #The server stalls without closing its connections, like a host that froze
+        self.processes[address].send_signal(signal.SIGSTOP)
+
+    def workgroup(self, addresses=None, **kwargs):
+        #The servers need a moment to start listening
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            try:
+                return Workgroup(addresses or self.addresses, **kwargs)
+            except WorkerUnavailableError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def __enter__(self):
+        for address in self.addresses:
+            self.start(address)
+        return self
+
+    def __exit__(self, exceptionType, exceptionValue, traceBack):
+        for process in self.processes.values():
+            process.kill()
+            process.wait()